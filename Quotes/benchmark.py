@@ -0,0 +1,298 @@
+###
+# Copyright (c) 2014, Sergio Conde
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+"""
+Load generator for the quote databases. It fills synthetic channels and
+measures the latency percentiles and throughput of the database API with one
+or more threads. Quotes/test.py runs it, see QuotesBenchmarkTestCase.
+"""
+
+import time
+import random
+import sqlite3
+import threading
+
+import supybot.conf as conf
+import supybot.plugins as plugins
+
+operations = ('insertQuote', 'addQuote', 'getQuoteById', 'getQuoteById hot',
+              'getQuoteRandom', 'getQuoteLast', 'getQuotesByNick',
+              'getQuotesBetween', 'getQuoteStats', 'searchQuote',
+              'searchQuotes', 'fuzzySearchQuotes', 'delQuoteById',
+              'dedupeQuotes', 'importQuotes', 'upgrade', 'compressQuotes',
+              'getQuoteById zlib')
+
+# Quotes read by the hot lookups, which the quote cache can hold.
+hotQuotes = 50
+
+# Quotes imported by each importQuotes call.
+importBatch = 50
+
+# Operations called once per channel instead of count times.
+perChannel = ('dedupeQuotes', 'upgrade', 'compressQuotes')
+
+words = ('irc', 'bot', 'python', 'quote', 'channel', 'server', 'network',
+         'nick', 'lag', 'netsplit', 'topic', 'kick', 'ban', 'op', 'voice',
+         'coffee', 'monday', 'deploy', 'bug', 'feature', 'release', 'linux')
+
+
+def makeLine(rng, nick):
+    return '<%s> %s' % (nick, ' '.join(rng.choice(words)
+                                       for w in range(rng.randint(3, 15))))
+
+
+def makeQuote(rng, i):
+    nick = 'nick%s' % rng.randint(0, 99)
+    if rng.random() < 0.1:
+        # A pasted conversation, the quotes worth compressing.
+        text = '  '.join(makeLine(rng, 'nick%s' % rng.randint(0, 99))
+                         for l in range(rng.randint(3, 10)))
+    else:
+        text = makeLine(rng, nick)
+    return (text, nick, 1400000000 + i * 60)
+
+
+def misspell(rng, word):
+    """Swaps two adjacent letters of word, like a typo in a search."""
+    if len(word) < 2:
+        return word
+    i = rng.randint(0, len(word) - 2)
+    return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+
+
+def makeLegacyDb(filename, quotes):
+    """Creates filename with the version 1 schema, a single FTS4 table,
+    holding the (text, nick, ts) quotes, and returns a connection to it."""
+    conn = sqlite3.connect(filename)
+    conn.execute("""CREATE VIRTUAL TABLE quotes USING fts4(
+    text TEXT,
+    nick TEXT,
+    ts INTEGER
+    )""")
+    conn.executemany("""INSERT INTO quotes (text, nick, ts)
+    VALUES (?, ?, ?)""", quotes)
+    conn.commit()
+    return conn
+
+
+def supported(db, operation):
+    """Whether operation can be measured on db, a database or its class."""
+    if operation == 'fuzzySearchQuotes':
+        # Fuzzy searches need SQLite 3.34.
+        return db.trigram
+    elif operation == 'upgrade':
+        # Only channel databases were created with the version 1 schema.
+        return not db.consolidated
+    elif operation in ('compressQuotes', 'getQuoteById zlib'):
+        # FTS4 indexes read the quotes as stored.
+        return db.fts5
+    return True
+
+
+def fill(db, channels, size, seed=0):
+    """Imports size synthetic quotes in each of channels."""
+    rng = random.Random(seed)
+    for channel in channels:
+        db.importQuotes(channel, [makeQuote(rng, i) for i in range(size)])
+
+
+def percentile(latencies, p):
+    """Nearest-rank percentile p of the sorted latencies."""
+    if not latencies:
+        return 0.0
+    return latencies[min(len(latencies) - 1,
+                         int(p / 100.0 * len(latencies)))]
+
+
+def measure(call, count, threads):
+    """Runs call(i) for i in range(count) split between threads and returns
+    the sorted latencies and the elapsed time."""
+    latencies = []
+    lock = threading.Lock()
+
+    def work(indexes):
+        mine = []
+        for i in indexes:
+            start = time.time()
+            call(i)
+            mine.append(time.time() - start)
+        with lock:
+            latencies.extend(mine)
+
+    L = [threading.Thread(target=work, args=(range(t, count, threads),))
+         for t in range(threads)]
+    start = time.time()
+    for t in L:
+        t.start()
+    for t in L:
+        t.join()
+    elapsed = time.time() - start
+    latencies.sort()
+    return (latencies, elapsed)
+
+
+def run(db, backend, size, count=1000, threads=(1,), channels=1, seed=0,
+        compress=200):
+    """Fills channels synthetic channels of size quotes in db and measures
+    count calls of each supported operation for each number of threads.
+
+    The quotes added by addQuote are already stored, it only checks their
+    hash. Hot lookups read the same hotQuotes quotes over and over. Imports
+    are done by batches of importBatch quotes in other channels. The upgrade
+    of a version 1 channel database of size quotes, on its first read, is
+    measured once per channel. So is compressQuotes, with a compressThreshold
+    of compress, on other channels of size quotes stored uncompressed, whose
+    quotes are then read by the zlib lookups. Its results have the size of
+    the stored texts in bytes before and after.
+
+    Returns a list of result dicts, ready to be dumped as JSON."""
+    threshold = conf.supybot.plugins.Quotes.compressThreshold
+    names = ['#dbbench%s' % i for i in range(channels)]
+    fill(db, names, size, seed)
+    rng = random.Random(seed)
+    # Each delete needs a quote of its own, half of them are kept.
+    deletable = dict((name, rng.sample(range(1, size + 1), size))
+                     for name in names)
+    results = []
+    for n in threads:
+        ids = [rng.randint(1, size) for i in range(count)]
+        nicks = ['nick%s' % rng.randint(0, 99) for i in range(count)]
+        # Days of quotes, makeQuote adds one every minute.
+        days = [1400000000 + rng.randint(0, size) * 60 for i in range(count)]
+        searches = [rng.choice(words) for i in range(count)]
+        typos = [misspell(rng, rng.choice(words)) for i in range(count)]
+        quotes = [makeQuote(rng, size + i) for i in range(count)]
+        stored = [db.getQuoteRandom(names[i % channels])[1:]
+                  for i in range(count)]
+        deletes = []
+        for i in range(count):
+            name = names[i % channels]
+            if len(deletable[name]) > size // 2:
+                deletes.append((name, deletable[name].pop()))
+        imports = ['#dbimport%s-%s' % (n, i) for i in range(channels)]
+        batches = [[makeQuote(rng, size + i * importBatch + j)
+                    for j in range(importBatch)] for i in range(count)]
+        legacy = ['#dblegacy%s-%s' % (n, i) for i in range(channels)]
+        if supported(db, 'upgrade'):
+            for name in legacy:
+                makeLegacyDb(plugins.makeChannelFilename(db.filename, name),
+                             [makeQuote(rng, i) for i in range(size)]).close()
+        packed = ['#dbcompress%s-%s' % (n, i) for i in range(channels)]
+        if supported(db, 'compressQuotes'):
+            with threshold.context(0):
+                fill(db, packed, size, seed)
+        sizes = []
+        functions = {
+            'insertQuote': lambda i: db.insertQuote(names[i % channels],
+                                                    *quotes[i]),
+            'addQuote': lambda i: db.addQuote(names[i % channels],
+                                              *stored[i]),
+            'getQuoteById': lambda i: db.getQuoteById(names[i % channels],
+                                                      ids[i]),
+            'getQuoteById hot': lambda i: db.getQuoteById(
+                names[i % channels], i % min(size, hotQuotes) + 1),
+            'getQuoteRandom': lambda i: db.getQuoteRandom(names[i % channels]),
+            'getQuoteLast': lambda i: db.getQuoteLast(names[i % channels]),
+            'getQuotesByNick': lambda i: db.getQuotesByNick(
+                names[i % channels], nicks[i], 5),
+            'getQuotesBetween': lambda i: db.getQuotesBetween(
+                names[i % channels], days[i], days[i] + 86400, 5),
+            'getQuoteStats': lambda i: db.getQuoteStats(names[i % channels],
+                                                        5, 12),
+            'searchQuote': lambda i: db.searchQuote(names[i % channels],
+                                                    searches[i]),
+            'searchQuotes': lambda i: db.searchQuotes(names[i % channels],
+                                                      searches[i], 5),
+            'fuzzySearchQuotes': lambda i: db.fuzzySearchQuotes(
+                names[i % channels], typos[i], 5),
+            'delQuoteById': lambda i: db.delQuoteById(*deletes[i]),
+            'dedupeQuotes': lambda i: db.dedupeQuotes(names[i]),
+            'importQuotes': lambda i: db.importQuotes(imports[i % channels],
+                                                      batches[i]),
+            'upgrade': lambda i: db.getQuoteLast(legacy[i]),
+            'compressQuotes': lambda i: sizes.append(
+                db.compressQuotes(packed[i])),
+            'getQuoteById zlib': lambda i: db.getQuoteById(
+                packed[i % channels], ids[i]),
+        }
+        for operation in operations:
+            if not supported(db, operation):
+                continue
+            if operation == 'delQuoteById':
+                calls = len(deletes)
+            elif operation in perChannel:
+                calls = channels
+            else:
+                calls = count
+            with threshold.context(compress):
+                (latencies, elapsed) = measure(functions[operation], calls,
+                                               n)
+            results.append({
+                'backend': backend,
+                'size': size,
+                'channels': channels,
+                'threads': n,
+                'operation': operation,
+                'count': calls,
+                'seconds': elapsed,
+                'throughput': calls / elapsed if elapsed else 0.0,
+                'mean_ms': 1000 * sum(latencies) / len(latencies)
+                           if latencies else 0.0,
+                'p50_ms': 1000 * percentile(latencies, 50),
+                'p90_ms': 1000 * percentile(latencies, 90),
+                'p99_ms': 1000 * percentile(latencies, 99),
+                'max_ms': 1000 * (latencies[-1] if latencies else 0.0),
+            })
+            if operation == 'compressQuotes':
+                results[-1]['bytes_before'] = sum(s[1] for s in sizes)
+                results[-1]['bytes_after'] = sum(s[2] for s in sizes)
+    return results
+
+
+def formatResults(results):
+    """Returns the results as a text table."""
+    lines = ['%-14s %7s %3s %-17s %9s %8s %8s %8s %8s' %
+             ('backend', 'size', 'thr', 'operation', 'ops/s', 'p50 ms',
+              'p90 ms', 'p99 ms', 'max ms')]
+    for r in results:
+        lines.append('%-14s %7s %3s %-17s %9.0f %8.3f %8.3f %8.3f %8.3f' %
+                     (r['backend'], r['size'], r['threads'], r['operation'],
+                      r['throughput'], r['p50_ms'], r['p90_ms'], r['p99_ms'],
+                      r['max_ms']))
+    for r in results:
+        if 'bytes_before' in r:
+            lines.append('%s, %s threads: compressQuotes stored %.1f KiB '
+                         'in %.1f KiB' % (r['backend'], r['threads'],
+                                          r['bytes_before'] / 1024.0,
+                                          r['bytes_after'] / 1024.0))
+    return '\n'.join(lines)
+
+
+# vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
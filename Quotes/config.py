@@ -40,9 +40,119 @@ except:
 def configure(advanced):
     conf.registerPlugin('Quotes', True)
 
+
+class Synchronous(registry.OnlySomeStrings):
+    validStrings = ('off', 'normal', 'full', 'extra')
+
+
+class Duplicates(registry.OnlySomeStrings):
+    validStrings = ('reject', 'link', 'allow')
+
 Quotes = conf.registerPlugin('Quotes')
 conf.registerChannelValue(Quotes, 'enabled',
                           registry.Boolean(True,
                                            _("Enable quotes on the channel.")))
 
+conf.registerChannelValue(Quotes, 'duplicates',
+                          Duplicates('allow', _("""What addquote does with a
+                          quote already stored, ignoring case, whitespace and
+                          a leading timestamp: 'reject' gives an error,
+                          'link' replies with the id of the stored quote and
+                          'allow' stores it again.""")))
+
+conf.registerChannelValue(Quotes, 'searchLimit',
+                          registry.PositiveInteger(5, _("""Number of quotes
+                          shown by each page of findquote results.""")))
+
+conf.registerGlobalValue(Quotes, 'maxSearchLimit',
+                         registry.PositiveInteger(20, _("""Maximum number of
+                         quotes findquote shows in a page, whatever --limit
+                         is given.""")))
+
+conf.registerGlobalValue(Quotes, 'fuzzyResults',
+                         registry.PositiveInteger(100, _("""Maximum number of
+                         quotes a findquote --fuzzy search finds.""")))
+
+conf.registerGlobalValue(Quotes, 'fuzzyBudget',
+                         registry.PositiveInteger(20000, _("""Maximum number
+                         of trigram index entries a findquote --fuzzy search
+                         reads to rank the quotes. The trigrams of the search
+                         found in too many quotes are left out.""")))
+
+conf.registerGlobalValue(Quotes, 'synchronous',
+                         Synchronous('normal', _("""SQLite synchronous mode of
+                         the databases. With 'normal' a crash can lose the
+                         last quotes added but never corrupts the database,
+                         'full' syncs the disk on every commit.""")))
+
+conf.registerGlobalValue(Quotes, 'cacheSize',
+                         registry.PositiveInteger(2000, _("""SQLite page cache
+                         size of each database connection, in KiB.""")))
+
+conf.registerGlobalValue(Quotes, 'mmapSize',
+                         registry.NonNegativeInteger(0, _("""Size of the
+                         databases read through memory mapping, in MiB. 0
+                         disables memory mapping.""")))
+
+conf.registerGlobalValue(Quotes, 'quoteCacheSize',
+                         registry.NonNegativeInteger(500, _("""Number of
+                         quotes kept in memory for quote <id>, lastquote and
+                         quoteinfo. 0 disables the cache.""")))
+
+conf.registerGlobalValue(Quotes, 'maintenanceInterval',
+                         registry.NonNegativeInteger(3600, _("""Number of
+                         seconds between the maintenances of the databases
+                         changed since the last one. 0 disables them. Takes
+                         effect when the plugin is reloaded.""")))
+
+conf.registerGlobalValue(Quotes, 'maintenanceIdle',
+                         registry.NonNegativeInteger(300, _("""Number of
+                         seconds a database must have been unused to be
+                         maintained by the scheduled maintenance.""")))
+
+conf.registerGlobalValue(Quotes, 'maxOpen',
+                         registry.PositiveInteger(50, _("""Maximum number of
+                         channel databases kept open, the least recently
+                         used ones are closed first.""")))
+
+conf.registerGlobalValue(Quotes, 'idleTimeout',
+                         registry.NonNegativeInteger(600, _("""Number of
+                         seconds after which an unused channel database is
+                         closed. 0 keeps them open.""")))
+
+conf.registerGlobalValue(Quotes, 'snapshotDirectory',
+                         registry.String('snapshots', _("""Directory,
+                         relative to the data directory, where the snapshots
+                         of the databases are published and read by the
+                         replicas.""")))
+
+conf.registerGlobalValue(Quotes, 'snapshotInterval',
+                         registry.NonNegativeInteger(0, _("""Number of
+                         seconds between the snapshots of the databases
+                         changed since their last one. 0 disables them.
+                         Takes effect when the plugin is reloaded.""")))
+
+conf.registerGlobalValue(Quotes, 'replica',
+                         registry.Boolean(False, _("""Serve the quotes from
+                         the snapshots published by another bot in
+                         snapshotDirectory, read-only, instead of the
+                         databases. Takes effect when the plugin is
+                         reloaded.""")))
+
+conf.registerGlobalValue(Quotes, 'refreshInterval',
+                         registry.PositiveInteger(60, _("""Number of seconds
+                         between the checks of a replica for newer
+                         snapshots. Takes effect when the plugin is
+                         reloaded.""")))
+
+conf.registerGlobalValue(Quotes, 'compressThreshold',
+                         registry.NonNegativeInteger(0, _("""Number of
+                         characters from which the quotes are stored
+                         compressed with zlib, when the database has an FTS5
+                         index. 0 disables the compression. Existing quotes
+                         are rewritten with the compressquotes command. Once
+                         a database has stored quotes compressed, its indexes
+                         need the plugin's SQL functions and other tools can
+                         no longer write to it.""")))
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -28,13 +28,37 @@
 
 ###
 
+import io
 import os
+import re
+import csv
 import sys
+import json
+import math
 import time
-from datetime import datetime
+import random
+import zlib
+import struct
+import hashlib
 import sqlite3
+import calendar
+import threading
+import contextlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
 
+if sys.version_info[0] < 3:
+    from urllib import pathname2url
+    _blob = buffer
+else:
+    from urllib.request import pathname2url
+    _blob = (bytes, memoryview)
+
+import supybot.conf as conf
+import supybot.log as log
+import supybot.utils as utils
 import supybot.ircdb as ircdb
+import supybot.schedule as schedule
 from supybot.commands import *
 import supybot.plugins as plugins
 import supybot.ircutils as ircutils
@@ -47,85 +71,1923 @@ except ImportError:
     _ = lambda x: x
 
 
+def _bm25(matchinfo, k1=1.2, b=0.75):
+    """Okapi BM25 of a row from its FTS4 matchinfo(..., 'pcnalx'), negated
+    so rows sort best first like FTS5's bm25()."""
+    info = struct.unpack('@%dI' % (len(matchinfo) // 4), matchinfo)
+    (phrases, cols, rows) = info[:3]
+    avgs = info[3:3 + cols]
+    lens = info[3 + cols:3 + 2 * cols]
+    hits = info[3 + 2 * cols:]
+    score = 0.0
+    for p in range(phrases):
+        for c in range(cols):
+            (here, _, docs) = hits[3 * (p * cols + c):3 * (p * cols + c) + 3]
+            if not here:
+                continue
+            idf = max(math.log((rows - docs + 0.5) / (docs + 0.5)), 1e-6)
+            norm = 1 - b + b * lens[c] / float(max(avgs[c], 1))
+            score += idf * here * (k1 + 1) / (here + k1 * norm)
+    return -score
+
+
+def _rollback(cur):
+    try:
+        cur.execute("""ROLLBACK""")
+    except sqlite3.OperationalError:
+        # The transaction was never started or already rolled back.
+        pass
+
+
+def _bounds(since, until):
+    """Replaces the None bounds of a timestamp range by the extreme values
+    SQLite integers can take."""
+    if since is None:
+        since = -2 ** 63
+    if until is None:
+        until = 2 ** 63 - 1
+    return (since, until)
+
+
+def _modified(filename):
+    """Returns the last time the database filename or its write-ahead log
+    was modified."""
+    times = [os.stat(filename).st_mtime]
+    if os.path.exists(filename + '-wal'):
+        times.append(os.stat(filename + '-wal').st_mtime)
+    return max(times)
+
+
+def _hasFts5(options=''):
+    try:
+        sqlite3.connect(':memory:').execute(
+            """CREATE VIRTUAL TABLE t USING fts5(x%s)""" % options)
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def _trigrams(text):
+    """Returns the distinct trigrams of the words of text of at least 3
+    letters, lowercased and with a space on each side like the trigram
+    tokenizer sees them in the quotes."""
+    grams = []
+    for word in re.findall(r'\w{3,}', text.lower(), re.U):
+        word = ' %s ' % word
+        for i in range(len(word) - 2):
+            if word[i:i + 3] not in grams:
+                grams.append(word[i:i + 3])
+    return grams
+
+
+def _similarity(grams, text):
+    """Returns the fraction of the trigrams grams found in text."""
+    text = ' %s ' % ' '.join(re.findall(r'\w+', text.lower(), re.U))
+    found = set(text[i:i + 3] for i in range(len(text) - 2))
+    return len([g for g in grams if g in found]) / float(len(grams))
+
+
+# Time a quote copied from a client or a log often begins with, like
+# "[12:34]", "12:34:56" or "[2014-01-01 12:34:56]".
+_timestampPrefix = re.compile(r'^\s*[\[(]?(\d{4}-\d\d-\d\d[ T])?\d?\d:\d\d'
+                              r'(:\d\d)?[\])]?\s+')
+
+
+def _normalizeQuote(text):
+    """Returns text lowercased, without its leading timestamp and with its
+    whitespace collapsed, the same for the copies of a quote."""
+    return ' '.join(_timestampPrefix.sub('', text).lower().split())
+
+
+def _pack(text, threshold):
+    """Returns text, or the value stored for it, compressed with zlib as a
+    BLOB if it has at least threshold characters and compressing it saves
+    space, else as text. A threshold of 0 never compresses."""
+    text = _unpack(text)
+    if not threshold or len(text) < threshold:
+        return text
+    data = text if isinstance(text, bytes) else text.encode('utf-8')
+    packed = zlib.compress(data)
+    if len(packed) >= len(data):
+        return text
+    return sqlite3.Binary(packed)
+
+
+def _unpack(value):
+    """Returns the text of a quote as stored by _pack."""
+    if isinstance(value, _blob):
+        return zlib.decompress(bytes(value)).decode('utf-8')
+    return value
+
+
+def _quoteHash(text):
+    """Returns the content hash of text, the first 64 bits of the SHA-1 of
+    its normalized form as a signed integer SQLite can store."""
+    text = _normalizeQuote(_unpack(text))
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8', 'replace')
+    return struct.unpack('>q', hashlib.sha1(text).digest()[:8])[0]
+
+
+class QuotesFile(object):
+    """Connections to a channel database: a writer that commits the writes
+    of concurrent threads together and a pool of readers that, thanks to
+    WAL, are not blocked by it. Snapshots are opened read-only, as immutable
+    files SQLite reads without locking them."""
+    # Idle readers kept open, the extra ones are closed when released.
+    maxReaders = 4
+
+    def __init__(self, filename, pragmas, snapshot=False):
+        self.filename = filename
+        self.pragmas = pragmas
+        self.snapshot = snapshot
+        self.ftsKind = None
+        self.lock = threading.Lock()
+        self.readers = []
+        self.pending = []
+        self.writing = False
+        self.writes = 0
+        self.batches = 0
+        # Held while the schema is upgraded, see prepare.
+        self.prepareLock = threading.Lock()
+        # Managed by SqliteQuotesDB.
+        self.users = 0
+        self.lastUsed = 0
+        self.evicted = False
+        self.writer = self.connect()
+        if snapshot:
+            # Identifies the snapshot file, replaced by newer ones.
+            self.mtime = os.stat(filename).st_mtime
+            return
+        # Only applies to new databases, and must be set before WAL.
+        self.writer.execute("""PRAGMA auto_vacuum = INCREMENTAL""")
+        self.writer.execute("""PRAGMA journal_mode = WAL""")
+
+    def connect(self):
+        # Transactions are handled explicitly.
+        if self.snapshot:
+            db = sqlite3.connect('file:%s?mode=ro&immutable=1' %
+                                 pathname2url(os.path.abspath(self.filename)),
+                                 check_same_thread=False,
+                                 isolation_level=None, uri=True)
+        else:
+            db = sqlite3.connect(self.filename, timeout=30,
+                                 check_same_thread=False,
+                                 isolation_level=None)
+        db.text_factory = str
+        db.create_function('bm25fts4', 1, _bm25)
+        db.create_function('quotehash', 1, _quoteHash)
+        db.create_function('quotetext', 1, _unpack)
+        db.create_function('quotepack', 2, _pack)
+        for (name, value) in sorted(self.pragmas.items()):
+            db.execute("""PRAGMA %s = %s""" % (name, value))
+        return db
+
+    def prepare(self, upgrade):
+        """Runs upgrade(writer) and detects the full-text index on first
+        use. Concurrent users wait for it, the other databases don't."""
+        with self.prepareLock:
+            if self.ftsKind is None:
+                if not self.snapshot:
+                    upgrade(self.writer)
+                self.detectFts()
+
+    def detectFts(self):
+        cur = self.writer.cursor()
+        cur.execute("""SELECT sql FROM sqlite_master
+        WHERE name = 'quotes_fts'""")
+        self.ftsKind = 'fts5' if 'fts5' in cur.fetchone()[0] else 'fts4'
+
+    def close(self):
+        with self.lock:
+            for db in self.readers:
+                db.close()
+            self.readers = []
+        self.writer.close()
+
+    @contextlib.contextmanager
+    def reader(self):
+        with self.lock:
+            db = self.readers.pop() if self.readers else None
+        if db is None:
+            db = self.connect()
+        try:
+            yield db
+        finally:
+            with self.lock:
+                if len(self.readers) < self.maxReaders:
+                    self.readers.append(db)
+                    db = None
+            if db is not None:
+                db.close()
+
+    def write(self, f, transaction=True):
+        """Runs f(cursor) in a write transaction and returns its result.
+        Writes coming from other threads meanwhile are queued and the first
+        of them commits them all at once, each in its own savepoint so a
+        failing write doesn't undo the others. Without transaction, f runs
+        alone in autocommit mode, for statements like VACUUM."""
+        op = _Write(f, transaction)
+        with self.lock:
+            self.pending.append(op)
+            lead = not self.writing
+            self.writing = True
+        if not lead:
+            op.ready.wait()
+        if not op.done:
+            with self.lock:
+                (batch, self.pending) = (self.pending, [])
+            grouped = [o for o in batch if o.transaction]
+            if grouped:
+                self._commit(grouped)
+            for o in batch:
+                if not o.transaction:
+                    self._run(o)
+            with self.lock:
+                if self.pending:
+                    self.pending[0].ready.set()
+                else:
+                    self.writing = False
+        if op.error is not None:
+            raise op.error
+        return op.result
+
+    def _commit(self, batch):
+        cur = self.writer.cursor()
+        try:
+            cur.execute("""BEGIN IMMEDIATE""")
+            for op in batch:
+                cur.execute("""SAVEPOINT quotes_write""")
+                try:
+                    op.result = op.f(cur)
+                except Exception as e:
+                    op.error = e
+                    cur.execute("""ROLLBACK TO quotes_write""")
+                cur.execute("""RELEASE quotes_write""")
+            cur.execute("""COMMIT""")
+        except Exception as e:
+            _rollback(cur)
+            for op in batch:
+                if op.error is None:
+                    op.error = e
+        self.writes += len(batch)
+        self.batches += 1
+        for op in batch:
+            op.done = True
+            op.ready.set()
+
+    def _run(self, op):
+        try:
+            op.result = op.f(self.writer.cursor())
+        except Exception as e:
+            op.error = e
+        self.writes += 1
+        op.done = True
+        op.ready.set()
+
+
+class QuoteCache(object):
+    """Thread-safe LRU cache of quote rows. Writes bump the generation so
+    rows read before them are not cached afterwards."""
+    def __init__(self, size):
+        self.size = size
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self):
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def configure(self, size):
+        with self._lock:
+            self.size = size
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """Caches value, unless generation is given and the cache was
+        invalidated since."""
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data.pop(key, None)
+            if self.size > 0:
+                self._data[key] = value
+                self._evict()
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+
+
+class _Write(object):
+    def __init__(self, f, transaction):
+        self.f = f
+        self.transaction = transaction
+        self.result = None
+        self.error = None
+        self.done = False
+        self.ready = threading.Event()
+
+
 class SqliteQuotesDB(object):
+    # Version 1 was a single FTS4 table holding text, nick and ts, version 2
+    # had no quote counts, version 3 no prefix and trigram indexes and
+    # version 4 no content hashes.
+    schemaVersion = 5
+    # Whether all the channels are in a single database.
+    consolidated = False
+    fts5 = _hasFts5()
+    # Whether the trigram index of fuzzy searches can be built, it needs
+    # SQLite 3.34.
+    trigram = _hasFts5(", tokenize='trigram'")
+    # Quotes sharing less of the trigrams of a fuzzy search are not shown.
+    minSimilarity = 1 / 3.0
+    # Whether snapshots can be published, SQLite's backup API is available
+    # since Python 3.7.
+    snapshots = hasattr(sqlite3.Connection, 'backup')
+    # Random ids tried before falling back to the next existing one.
+    randomTries = 8
+    # Quotes read at once by compressQuotes.
+    compressBatch = 1000
+    # Trigger indexing new quotes, dropped during imports that index all
+    # the imported quotes at once, like quotes_stats_ai and
+    # quotes_trigram_ai. {0} is the text of the new quote.
+    insertTriggers = {
+        'fts5': """CREATE TRIGGER quotes_ai AFTER INSERT ON quotes
+            BEGIN
+                INSERT INTO quotes_fts (rowid, text) VALUES (new.id, {0});
+            END""",
+        'fts4': """CREATE TRIGGER quotes_ai AFTER INSERT ON quotes
+            BEGIN
+                INSERT INTO quotes_fts (docid, text) VALUES (new.id, {0});
+            END""",
+    }
+    trigramInsertTrigger = """CREATE TRIGGER quotes_trigram_ai
+            AFTER INSERT ON quotes
+            BEGIN
+                INSERT INTO quotes_trigram (rowid, text) VALUES (new.id, {0});
+            END"""
+    # Columns of quotes_stats besides month and count, the quotes are
+    # counted by month and by their values.
+    statsColumns = (('nick', 'TEXT NOT NULL COLLATE NOCASE'),)
+    # Finds the quotes with the same content hash, to detect duplicates.
+    hashIndex = """CREATE INDEX quotes_hash ON quotes (hash)"""
+
     def __init__(self, filename):
-        self.dbs = ircutils.IrcDict()
+        # Open channel databases, least recently used first.
+        self.dbs = OrderedDict()
         self.filename = filename
+        self.lock = threading.Lock()
+        self.opened = 0
+        self.evicted = 0
+        self.expired = 0
+        self.cache = QuoteCache(conf.supybot.plugins.Quotes.quoteCacheSize())
+        # Databases written since they were last maintained.
+        self.changed = set()
+        # Whether the quotes are read from the snapshots published by
+        # another bot instead of the databases.
+        self.replica = conf.supybot.plugins.Quotes.replica()
+        # Databases written since their last snapshot.
+        self.unpublished = set()
+        # Modification time of the snapshots read, by filename.
+        self.snapshotTimes = {}
+        self.published = 0
+        self.refreshed = 0
 
     def close(self):
-        for db in (self.dbs.itervalues() if sys.version_info[0] < 3
-                   else self.dbs.values()):
-            db.close()
+        with self.lock:
+            for db in self.dbs.values():
+                db.close()
+            self.dbs.clear()
+
+    def _pragmas(self):
+        config = conf.supybot.plugins.Quotes
+        return {'synchronous': config.synchronous().upper(),
+                'cache_size': -config.cacheSize(),
+                'mmap_size': config.mmapSize() * 1024 * 1024}
+
+    def _channel(self, channel):
+        return ircutils.toLower(plugins.getChannel(channel))
 
-    def _getDb(self, channel):
-        filename = plugins.makeChannelFilename(self.filename, channel)
+    def _channelFilename(self, channel, create):
+        if create:
+            return plugins.makeChannelFilename(self.filename, channel)
+        # Same as makeChannelFilename without creating the directory.
+        channelSpecific = conf.supybot.databases.plugins.channelSpecific
+        channel = channelSpecific.getChannelLink(channel)
+        channel = utils.file.sanitizeName(ircutils.toLower(channel))
+        return os.path.join(conf.supybot.directories.data.dirize(channel),
+                            os.path.basename(self.filename))
 
-        if filename in self.dbs:
-            return self.dbs[filename]
+    def _open(self, channel, create=True):
+        """Returns the database of channel, opening it if needed, or None if
+        it doesn't exist and create is False. It must be given back to
+        _release once used."""
+        return self._openFile(self._channelFilename(channel, create), create)
 
-        if os.path.exists(filename):
-            db = sqlite3.connect(filename, check_same_thread=False)
-            db.text_factory = str
+    def _openFile(self, filename, create=True):
+        if self.replica:
+            filename = self._snapshotFilename(filename)
+            create = False
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            db = self.dbs.pop(filename, None)
+            if db is None:
+                if not create and not os.path.exists(filename):
+                    return None
+                db = QuotesFile(filename, self._pragmas(), self.replica)
+                if self.replica:
+                    self.snapshotTimes[filename] = db.mtime
+                self.opened += 1
             self.dbs[filename] = db
-            return db
+            db.users += 1
+            db.lastUsed = now
+            while len(self.dbs) > conf.supybot.plugins.Quotes.maxOpen():
+                self._evict(next(iter(self.dbs)))
+                self.evicted += 1
+        # Migrating a large database must not block the other channels.
+        try:
+            db.prepare(self._upgrade)
+        except:
+            with self.lock:
+                if self.dbs.get(filename) is db:
+                    self._evict(filename)
+            self._release(db)
+            raise
+        return db
 
-        db = sqlite3.connect(filename, check_same_thread=False)
-        db.text_factory = str
-        self.dbs[filename] = db
+    def _release(self, db):
+        with self.lock:
+            db.users -= 1
+            if db.evicted and not db.users:
+                db.close()
+
+    def _evict(self, filename):
+        db = self.dbs.pop(filename)
+        db.evicted = True
+        if not db.users:
+            db.close()
+
+    def _expire(self, now):
+        timeout = conf.supybot.plugins.Quotes.idleTimeout()
+        if not timeout:
+            return
+        for (filename, db) in list(self.dbs.items()):
+            if db.lastUsed >= now - timeout:
+                # The others were used later.
+                break
+            if not db.users:
+                self._evict(filename)
+                self.expired += 1
 
+    def closeIdle(self):
+        """Closes the databases unused for longer than idleTimeout."""
+        with self.lock:
+            self._expire(time.time())
+
+    def stats(self):
+        with self.lock:
+            return {'open': len(self.dbs),
+                    'readers': sum(len(db.readers)
+                                   for db in self.dbs.values()),
+                    'busy': sum(1 for db in self.dbs.values() if db.users),
+                    'opened': self.opened,
+                    'evicted': self.evicted,
+                    'expired': self.expired}
+
+    @contextlib.contextmanager
+    def _reader(self, channel):
+        """Yields the full-text index kind and a reader connection of the
+        database of channel, or (None, None) if it doesn't exist."""
+        db = self._open(channel, create=False)
+        if db is None:
+            yield (None, None)
+            return
+        try:
+            with db.reader() as conn:
+                yield (db.ftsKind, conn)
+        finally:
+            self._release(db)
+
+    def _write(self, channel, f):
+        """Runs f(cursor, ftsKind) in a write transaction on the database of
+        channel and returns its result."""
+        if self.replica:
+            raise sqlite3.OperationalError('attempt to write a read-only '
+                                           'replica')
+        db = self._open(channel)
+        try:
+            result = db.write(lambda cur: f(cur, db.ftsKind))
+        finally:
+            self._release(db)
+        with self.lock:
+            self.changed.add(db.filename)
+            self.unpublished.add(db.filename)
+        return result
+
+    def _databaseFiles(self, directory):
+        """Returns the filenames of the channel databases in directory."""
+        basename = os.path.basename(self.filename)
+        if not os.path.isdir(directory):
+            return []
+        return [path for path in (os.path.join(directory, name, basename)
+                                  for name in sorted(os.listdir(directory)))
+                if os.path.isfile(path)]
+
+    def _snapshotDirectory(self):
+        return conf.supybot.directories.data.dirize(
+            conf.supybot.plugins.Quotes.snapshotDirectory())
+
+    def _snapshotFilename(self, filename):
+        """Returns the filename of the snapshot of the database filename, at
+        the same place in the snapshot directory as in the data one."""
+        return os.path.join(self._snapshotDirectory(), os.path.relpath(
+            filename, conf.supybot.directories.data()))
+
+    def publishSnapshots(self):
+        """Copies the databases written since their last snapshot, or newer
+        than it, to the snapshot directory with SQLite's backup API, which
+        reads them like any reader without blocking the writes. Each
+        snapshot replaces the previous one at once, so the replicas never
+        see a partial copy. Returns the filenames of the new snapshots."""
+        published = []
+        for filename in self._databaseFiles(conf.supybot.directories.data()):
+            target = self._snapshotFilename(filename)
+            with self.lock:
+                if filename not in self.unpublished and \
+                   os.path.exists(target) and \
+                   os.stat(target).st_mtime >= _modified(filename):
+                    continue
+                self.unpublished.discard(filename)
+            db = self._openFile(filename, create=False)
+            if db is None:
+                continue
+            try:
+                self._backup(db, target)
+            except:
+                with self.lock:
+                    self.unpublished.add(filename)
+                raise
+            finally:
+                self._release(db)
+            published.append(target)
+        with self.lock:
+            self.published += len(published)
+        return published
+
+    def _backup(self, db, target):
+        directory = os.path.dirname(target)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temp = target + '.tmp'
+        if os.path.exists(temp):
+            os.remove(temp)
+        copy = sqlite3.connect(temp)
+        try:
+            with db.reader() as conn:
+                conn.backup(copy)
+            # Replicas read the snapshot as an immutable file, without the
+            # write-ahead log.
+            copy.execute("""PRAGMA journal_mode = DELETE""")
+        finally:
+            copy.close()
+        os.rename(temp, target)
+
+    def refreshSnapshots(self):
+        """Closes the snapshots replaced since they were opened, once they
+        are no longer used, and empties the quote cache, so the next reads
+        get the newer ones. Returns how many were replaced."""
+        with self.lock:
+            replaced = []
+            for (filename, mtime) in list(self.snapshotTimes.items()):
+                try:
+                    if os.stat(filename).st_mtime == mtime:
+                        continue
+                except OSError:
+                    # Deleted, the channel is gone.
+                    pass
+                replaced.append(filename)
+                del self.snapshotTimes[filename]
+                if filename in self.dbs:
+                    self._evict(filename)
+            self.refreshed += len(replaced)
+        if replaced:
+            self.cache.clear()
+        return len(replaced)
+
+    def snapshotInfo(self):
+        """Returns the number of snapshots in the snapshot directory and the
+        age in seconds of the oldest and the newest, or None."""
+        now = time.time()
+        ages = [now - os.stat(f).st_mtime
+                for f in self._databaseFiles(self._snapshotDirectory())]
+        if not ages:
+            return (0, None, None)
+        return (len(ages), max(ages), min(ages))
+
+    def maintain(self, channel=None, idle=0):
+        """Merges the full-text index segments, gives the free pages back to
+        the file system, refreshes the query planner statistics and checks
+        the integrity of the database of channel, or of every database
+        changed since it was last maintained that wasn't used in the last
+        idle seconds. Returns a dict of the timings and results by file."""
+        if self.replica:
+            # The snapshots are maintained by the bot publishing them.
+            return {}
+        if channel is not None:
+            filenames = [self._channelFilename(channel, False)]
+        else:
+            with self.lock:
+                filenames = sorted(self.changed)
+        results = {}
+        for filename in filenames:
+            with self.lock:
+                db = self.dbs.get(filename)
+                if idle and db is not None and \
+                   (db.users or db.lastUsed > time.time() - idle):
+                    continue
+                self.changed.discard(filename)
+            db = self._openFile(filename, create=False)
+            if db is None:
+                continue
+            try:
+                results[filename] = db.write(
+                    lambda cur: self._maintain(cur, db.ftsKind),
+                    transaction=False)
+            finally:
+                self._release(db)
+        return results
+
+    def _maintain(self, cur, kind):
+        result = {'problems': []}
+        start = time.time()
+        trigram = self._hasTrigramIndex(cur)
+        cur.execute("""INSERT INTO quotes_fts (quotes_fts)
+        VALUES ('optimize')""")
+        if trigram:
+            cur.execute("""INSERT INTO quotes_trigram (quotes_trigram)
+            VALUES ('optimize')""")
+        result['optimize'] = time.time() - start
+
+        start = time.time()
+        cur.execute("""PRAGMA freelist_count""")
+        free = cur.fetchone()[0]
+        cur.execute("""PRAGMA auto_vacuum""")
+        if cur.fetchone()[0] == 2:
+            # Each step of the pragma frees a page.
+            cur.execute("""PRAGMA incremental_vacuum""").fetchall()
+        elif free:
+            # Databases created before auto_vacuum was enabled need to be
+            # rebuilt once to switch to it.
+            cur.execute("""PRAGMA auto_vacuum = INCREMENTAL""")
+            cur.execute("""VACUUM""")
+        cur.execute("""PRAGMA freelist_count""")
+        result['freed'] = free - cur.fetchone()[0]
+        cur.execute("""PRAGMA optimize""")
+        result['vacuum'] = time.time() - start
+
+        start = time.time()
+        cur.execute("""PRAGMA quick_check""")
+        result['problems'] = [r[0] for r in cur.fetchall() if r[0] != 'ok']
+        try:
+            if kind == 'fts5':
+                # Also compares the index with the quotes table.
+                cur.execute("""INSERT INTO quotes_fts (quotes_fts, rank)
+                VALUES ('integrity-check', 1)""")
+            else:
+                cur.execute("""INSERT INTO quotes_fts (quotes_fts)
+                VALUES ('integrity-check')""")
+        except sqlite3.DatabaseError as e:
+            result['problems'].append('full-text index: %s' % e)
+        try:
+            if trigram:
+                cur.execute("""INSERT INTO quotes_trigram (quotes_trigram, rank)
+                VALUES ('integrity-check', 1)""")
+        except sqlite3.DatabaseError as e:
+            result['problems'].append('trigram index: %s' % e)
+        result['check'] = time.time() - start
+        return result
+
+    def _quoteText(self, packed, row):
+        """Returns the SQL expression of the text of the quote named row,
+        uncompressed by quotetext() if the indexes read packed texts."""
+        if packed:
+            return 'quotetext(%s.text)' % row
+        return '%s.text' % row
+
+    def _hasPackedIndexes(self, cur):
+        """Returns whether the indexes read the texts through quotes_plain,
+        so that they can be compressed."""
+        cur.execute("""SELECT name FROM sqlite_master
+        WHERE name = 'quotes_plain'""")
+        return cur.fetchone() is not None
+
+    def _createFts(self, cur, packed=False):
+        """Creates the full-text index over the text of the quotes and the
+        triggers keeping it in sync with the quotes table. With packed, the
+        FTS5 index reads the texts through quotes_plain, which uncompresses
+        them with quotetext(): the database can then only be written to
+        where the function is defined."""
+        (new, old) = (self._quoteText(packed, 'new'),
+                      self._quoteText(packed, 'old'))
+        if self.fts5:
+            if packed:
+                cur.execute("""CREATE VIEW quotes_plain AS
+                SELECT id, quotetext(text) AS text FROM quotes""")
+            cur.execute("""CREATE VIRTUAL TABLE quotes_fts USING fts5(
+            text, content='%s', content_rowid='id', prefix='2 3'
+            )""" % ('quotes_plain' if packed else 'quotes'))
+            cur.execute(self.insertTriggers['fts5'].format(new))
+            cur.execute("""CREATE TRIGGER quotes_ad AFTER DELETE ON quotes
+            BEGIN
+                INSERT INTO quotes_fts (quotes_fts, rowid, text)
+                VALUES ('delete', old.id, {0});
+            END""".format(old))
+            cur.execute("""CREATE TRIGGER quotes_au AFTER UPDATE ON quotes
+            BEGIN
+                INSERT INTO quotes_fts (quotes_fts, rowid, text)
+                VALUES ('delete', old.id, {0});
+                INSERT INTO quotes_fts (rowid, text) VALUES (new.id, {1});
+            END""".format(old, new))
+        else:
+            cur.execute("""CREATE VIRTUAL TABLE quotes_fts USING fts4(
+            text, content='quotes', prefix='2,3'
+            )""")
+            cur.execute(self.insertTriggers['fts4'].format('new.text'))
+            cur.execute("""CREATE TRIGGER quotes_bd BEFORE DELETE ON quotes
+            BEGIN
+                DELETE FROM quotes_fts WHERE docid = old.id;
+            END""")
+            cur.execute("""CREATE TRIGGER quotes_bu BEFORE UPDATE ON quotes
+            BEGIN
+                DELETE FROM quotes_fts WHERE docid = old.id;
+            END""")
+            cur.execute("""CREATE TRIGGER quotes_au AFTER UPDATE ON quotes
+            BEGIN
+                INSERT INTO quotes_fts (docid, text) VALUES (new.id, new.text);
+            END""")
+        cur.execute("""INSERT INTO quotes_fts (quotes_fts)
+        VALUES ('rebuild')""")
+
+    def _dropFts(self, cur):
+        """Drops the full-text and trigram indexes and their triggers, to
+        create them again with other options."""
+        for trigger in ('quotes_ai', 'quotes_ad', 'quotes_au', 'quotes_bd',
+                        'quotes_bu', 'quotes_trigram_ai', 'quotes_trigram_ad',
+                        'quotes_trigram_au'):
+            cur.execute("""DROP TRIGGER IF EXISTS %s""" % trigger)
+        cur.execute("""DROP TABLE quotes_fts""")
+        cur.execute("""DROP TABLE IF EXISTS quotes_trigram""")
+        cur.execute("""DROP VIEW IF EXISTS quotes_plain""")
+
+    def _addHashes(self, cur):
+        """Adds the content hash column to a quotes table lacking it and
+        hashes every quote. The indexes must have been dropped so the
+        updates don't reindex the quotes."""
+        cur.execute("""PRAGMA table_info(quotes)""")
+        if 'hash' not in [c[1] for c in cur.fetchall()]:
+            cur.execute("""ALTER TABLE quotes ADD COLUMN hash INTEGER""")
+            cur.execute(self.hashIndex)
+        cur.execute("""UPDATE quotes SET hash = quotehash(text)""")
+
+    def _missingTrigram(self, cur):
+        """Returns whether the trigram index can be built but the database
+        lacks it, like those created without SQLite 3.34."""
+        return self.trigram and not self._hasTrigramIndex(cur)
+
+    def _createTrigram(self, cur, packed=False):
+        """Creates the trigram index of fuzzy searches, which matches any
+        part of the words of the quotes, and its triggers. packed is like
+        for _createFts."""
+        (new, old) = (self._quoteText(packed, 'new'),
+                      self._quoteText(packed, 'old'))
+        cur.execute("""CREATE VIRTUAL TABLE quotes_trigram USING fts5(
+        text, content='%s', content_rowid='id', tokenize='trigram'
+        )""" % ('quotes_plain' if packed else 'quotes'))
+        cur.execute(self.trigramInsertTrigger.format(new))
+        cur.execute("""CREATE TRIGGER quotes_trigram_ad AFTER DELETE ON quotes
+            BEGIN
+                INSERT INTO quotes_trigram (quotes_trigram, rowid, text)
+                VALUES ('delete', old.id, {0});
+            END""".format(old))
+        cur.execute("""CREATE TRIGGER quotes_trigram_au AFTER UPDATE ON quotes
+            BEGIN
+                INSERT INTO quotes_trigram (quotes_trigram, rowid, text)
+                VALUES ('delete', old.id, {0});
+                INSERT INTO quotes_trigram (rowid, text) VALUES (new.id, {1});
+            END""".format(old, new))
+        cur.execute("""INSERT INTO quotes_trigram (quotes_trigram)
+        VALUES ('rebuild')""")
+
+    def _statsKey(self, row):
+        """Returns the columns of quotes_stats counting a quote and their
+        values for the quote named row."""
+        columns = [c for (c, t) in self.statsColumns] + ['month']
+        values = ['%s.%s' % (row, c) for (c, t) in self.statsColumns]
+        values.append("strftime('%%Y-%%m', %s.ts, 'unixepoch')" % row)
+        return (columns, values)
+
+    def _countQuotes(self, row, n):
+        """Returns the statements of a trigger adding n to the count of the
+        quote named row, removing the count when it drops to 0."""
+        (columns, values) = self._statsKey(row)
+        where = ' AND '.join(['%s = %s' % c for c in zip(columns, values)])
+        sql = """INSERT OR IGNORE INTO quotes_stats ({0}, count)
+                VALUES ({1}, 0);
+                UPDATE quotes_stats SET count = count + {2} WHERE {3};
+                """.format(', '.join(columns), ', '.join(values), n, where)
+        if n < 0:
+            sql += """DELETE FROM quotes_stats WHERE {0} AND count = 0;
+                """.format(where)
+        return sql
+
+    def _statsInsertTrigger(self):
+        return """CREATE TRIGGER quotes_stats_ai AFTER INSERT ON quotes
+            BEGIN
+                {0}
+            END""".format(self._countQuotes('new', 1))
+
+    def _createStats(self, cur):
+        """Creates quotes_stats, counting the quotes by month and
+        statsColumns, and the triggers keeping the counts up to date, so
+        the stats don't need to read every quote."""
+        cur.execute("""CREATE TABLE quotes_stats ({0},
+        month TEXT NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY ({1}, month)
+        ) WITHOUT ROWID""".format(
+            ', '.join(['%s %s' % c for c in self.statsColumns]),
+            ', '.join([c for (c, t) in self.statsColumns])))
+        cur.execute(self._statsInsertTrigger())
+        cur.execute("""CREATE TRIGGER quotes_stats_ad AFTER DELETE ON quotes
+            BEGIN
+                {0}
+            END""".format(self._countQuotes('old', -1)))
+        cur.execute("""CREATE TRIGGER quotes_stats_au
+            AFTER UPDATE OF {0}, ts ON quotes
+            BEGIN
+                {1}
+                {2}
+            END""".format(', '.join([c for (c, t) in self.statsColumns]),
+                          self._countQuotes('old', -1),
+                          self._countQuotes('new', 1)))
+        self._addStats(cur, 0)
+
+    def _addStats(self, cur, last):
+        """Counts the quotes whose id is greater than last."""
+        (columns, values) = self._statsKey('quotes')
+        cur.execute("""SELECT count(*), {0} FROM quotes WHERE id > ?
+        GROUP BY {0}""".format(', '.join(values)), (last,))
+        counts = cur.fetchall()
+        cur.executemany("""INSERT OR IGNORE INTO quotes_stats ({0}, count)
+        VALUES ({1}, 0)""".format(', '.join(columns),
+                                  ', '.join(['?'] * len(columns))),
+                        [c[1:] for c in counts])
+        cur.executemany("""UPDATE quotes_stats SET count = count + ?
+        WHERE {0}""".format(' AND '.join(['%s = ?' % c for c in columns])),
+                        counts)
+
+    def _dropInsertTriggers(self, cur):
+        """Drops the triggers indexing and counting each inserted quote,
+        before inserting many of them."""
+        cur.execute("""DROP TRIGGER quotes_ai""")
+        cur.execute("""DROP TRIGGER quotes_stats_ai""")
+        cur.execute("""DROP TRIGGER IF EXISTS quotes_trigram_ai""")
+
+    def _indexInserted(self, cur, kind, last):
+        """Indexes and counts at once the quotes whose id is greater than
+        last and restores the triggers dropped by _dropInsertTriggers."""
+        new = self._quoteText(self._hasPackedIndexes(cur), 'new')
+        if kind == 'fts5':
+            cur.execute("""INSERT INTO quotes_fts (rowid, text)
+            SELECT id, quotetext(text) FROM quotes WHERE id > ?""", (last,))
+        else:
+            cur.execute("""INSERT INTO quotes_fts (docid, text)
+            SELECT id, text FROM quotes WHERE id > ?""", (last,))
+            new = 'new.text'
+        cur.execute(self.insertTriggers[kind].format(new))
+        self._addStats(cur, last)
+        cur.execute(self._statsInsertTrigger())
+        if self._hasTrigramIndex(cur):
+            cur.execute("""INSERT INTO quotes_trigram (rowid, text)
+            SELECT id, quotetext(text) FROM quotes WHERE id > ?""", (last,))
+            cur.execute(self.trigramInsertTrigger.format(new))
+
+    def _hasTrigramIndex(self, cur):
+        cur.execute("""SELECT name FROM sqlite_master
+        WHERE name = 'quotes_trigram'""")
+        return cur.fetchone() is not None
+
+    def _upgrade(self, db):
+        """Creates the schema or migrates it from older versions in
+        place."""
         cur = db.cursor()
-        cur.execute("""CREATE VIRTUAL TABLE quotes USING fts4(
-        text TEXT,
-        nick TEXT,
-        ts INTEGER
-        )""")
-        db.commit()
+        cur.execute("""PRAGMA user_version""")
+        version = cur.fetchone()[0]
+        if version >= self.schemaVersion and not self._missingTrigram(cur):
+            return
 
-        return db
+        cur.execute("""SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name = 'quotes'""")
+        if version == 0 and cur.fetchone() is not None:
+            version = 1
+
+        cur.execute("""BEGIN""")
+        try:
+            if version == 1:
+                cur.execute("""ALTER TABLE quotes RENAME TO quotes_v1""")
+            if version < 2:
+                cur.execute("""CREATE TABLE quotes (
+                id INTEGER PRIMARY KEY,
+                text TEXT NOT NULL,
+                nick TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                hash INTEGER
+                )""")
+                cur.execute("""CREATE INDEX quotes_nick
+                ON quotes (nick COLLATE NOCASE)""")
+                cur.execute("""CREATE INDEX quotes_ts ON quotes (ts)""")
+                cur.execute(self.hashIndex)
+            if version == 1:
+                cur.execute("""INSERT INTO quotes (id, text, nick, ts, hash)
+                SELECT rowid, text, nick, ts, quotehash(text)
+                FROM quotes_v1""")
+                cur.execute("""DROP TABLE quotes_v1""")
+            if 2 <= version < 5:
+                self._dropFts(cur)
+                self._addHashes(cur)
+            if version < 5:
+                self._createFts(cur)
+            if version < 3:
+                self._createStats(cur)
+            if self._missingTrigram(cur):
+                self._createTrigram(cur, self._hasPackedIndexes(cur))
+            cur.execute("""PRAGMA user_version = %d""" % self.schemaVersion)
+            cur.execute("""COMMIT""")
+        except:
+            _rollback(cur)
+            raise
+
+    def _matchQuery(self, kind, text):
+        """Turns text into a full-text query matching the quotes that
+        contain all its words, the last one as a prefix if it has at least
+        2 letters, so the prefix indexes are used."""
+        words = re.findall(r'\w+', text, re.U)
+        if not words:
+            return None
+        if len(words[-1]) < 2:
+            return ' '.join(['"%s"' % w for w in words])
+        if kind == 'fts5':
+            return ' '.join(['"%s"' % w for w in words]) + '*'
+        return ' '.join(['"%s"' % w for w in words[:-1]] +
+                        ['"%s*"' % words[-1]])
 
     def getQuoteById(self, channel, qid):
-        db = self._getDb(channel)
-        cur = db.cursor()
-        cur.execute("""SELECT rowid, text, nick, ts FROM quotes
-        WHERE rowid = ? LIMIT 1""", (qid,))
-        return cur.fetchone()
+        key = (self._channel(channel), qid)
+        q = self._cacheGet(key)
+        if q is None:
+            generation = self.cache.generation
+            q = self._selectQuoteById(channel, qid)
+            if q is not None:
+                self.cache.set(key, q, generation)
+        return q
+
+    def getQuoteLast(self, channel):
+        # The last quote is cached with None as id.
+        key = (self._channel(channel), None)
+        q = self._cacheGet(key)
+        if q is None:
+            generation = self.cache.generation
+            q = self._selectQuoteLast(channel)
+            if q is not None:
+                self.cache.set(key, q, generation)
+        return q
+
+    def insertQuote(self, channel, text, nick, ts):
+        """Inserts the quote and returns its id. Unlike addQuote it doesn't
+        look for the same text among the stored quotes, a duplicate is only
+        removed later by dedupeQuotes."""
+        return self._addQuote(channel, text, nick, ts, False)[0]
+
+    def addQuote(self, channel, text, nick, ts):
+        """Inserts the quote unless one with the same text, ignoring case,
+        whitespace and a leading timestamp, is already stored. Returns the
+        id of the new quote or of the stored one and whether it was
+        inserted."""
+        return self._addQuote(channel, text, nick, ts, True)
+
+    def _addQuote(self, channel, text, nick, ts, unique):
+        generation = self.cache.generation
+        (qid, inserted) = self._insertQuote(channel, text, nick, ts, unique)
+        if inserted:
+            channel = self._channel(channel)
+            self.cache.set((channel, qid), (qid, text, nick, ts), generation)
+            self.cache.invalidate((channel, None))
+        return (qid, inserted)
+
+    def dedupeQuotes(self, channel):
+        """Deletes the quotes of channel with the same text as an older one,
+        ignoring case, whitespace and a leading timestamp, and returns how
+        many were deleted. Only the quotes sharing their content hash with
+        another are read, in a single pass over its index."""
+        if not os.path.exists(self._channelFilename(channel, False)):
+            return 0
+
+        def dedupe(cur, kind):
+            duplicates = []
+            previous = None
+            for (i, h, text) in self._selectHashCollisions(cur, channel):
+                if h != previous:
+                    (previous, seen) = (h, set())
+                text = _normalizeQuote(text)
+                if text in seen:
+                    duplicates.append((i,))
+                else:
+                    seen.add(text)
+            cur.executemany("""DELETE FROM quotes WHERE id = ?""",
+                            duplicates)
+            return len(duplicates)
+        try:
+            return self._write(channel, dedupe)
+        finally:
+            self.cache.clear()
+
+    def _selectHashCollisions(self, cur, channel):
+        """Returns cur reading the (id, hash, text) of the quotes of channel
+        whose content hash is shared with another, by hash and oldest
+        first."""
+        cur.execute("""SELECT id, hash, quotetext(text) FROM quotes
+        WHERE hash IN (SELECT hash FROM quotes GROUP BY hash
+                       HAVING count(*) > 1)
+        ORDER BY hash, id""")
+        return cur
+
+    def _findDuplicate(self, cur, channel, text):
+        """Returns the id of the oldest quote of channel with the same text
+        as text, ignoring case, whitespace and a leading timestamp, or
+        None."""
+        cur.execute("""SELECT id, quotetext(text) FROM quotes WHERE hash = ?
+        ORDER BY id""", (_quoteHash(text),))
+        return self._sameText(cur.fetchall(), text)
+
+    def _sameText(self, rows, text):
+        # Different texts may share a hash, though it is unlikely.
+        text = _normalizeQuote(text)
+        for (qid, other) in rows:
+            if _normalizeQuote(other) == text:
+                return qid
+        return None
+
+    def _threshold(self, cur, kind):
+        """Returns the length from which the quotes are stored compressed,
+        or 0 if they can't be: FTS4 indexes read the stored texts. The
+        first time it isn't 0, the FTS5 indexes are rebuilt to read the
+        texts through quotes_plain."""
+        if kind != 'fts5':
+            return 0
+        threshold = conf.supybot.plugins.Quotes.compressThreshold()
+        if threshold and not self._hasPackedIndexes(cur):
+            self._dropFts(cur)
+            self._createFts(cur, packed=True)
+            if self.trigram:
+                self._createTrigram(cur, packed=True)
+        return threshold
+
+    def compressQuotes(self, channel):
+        """Stores the quotes of channel of at least compressThreshold
+        characters compressed and the others as text, like quotes are stored
+        when added, reading them by batches in a single transaction. Returns
+        the number of quotes rewritten and the size of the stored texts in
+        bytes before and after."""
+        if not os.path.exists(self._channelFilename(channel, False)):
+            return (0, 0, 0)
+
+        def compress(cur, kind):
+            threshold = self._threshold(cur, kind)
+            before = self._textSize(cur, channel)
+            count = 0
+            last = 0
+            while True:
+                rows = self._selectStored(cur, channel, threshold, last)
+                if not rows:
+                    break
+                changed = []
+                for (i, text) in rows:
+                    packed = _pack(text, threshold)
+                    if isinstance(packed, _blob) != isinstance(text, _blob):
+                        changed.append((packed, i))
+                cur.executemany("""UPDATE quotes SET text = ? WHERE id = ?""",
+                                changed)
+                count += len(changed)
+                last = rows[-1][0]
+            return (count, before, self._textSize(cur, channel))
+        return self._write(channel, compress)
+
+    def _textSize(self, cur, channel):
+        cur.execute("""SELECT coalesce(sum(length(CAST(text AS BLOB))), 0)
+        FROM quotes""")
+        return cur.fetchone()[0]
+
+    def _selectStored(self, cur, channel, threshold, last):
+        """Returns the (id, stored text) of the next quotes of channel after
+        the id last that are compressed or long enough to be."""
+        cur.execute("""SELECT id, text FROM quotes
+        WHERE id > ? AND (typeof(text) = 'blob' OR (? AND length(text) >= ?))
+        ORDER BY id LIMIT ?""", (last, threshold, threshold,
+                                 self.compressBatch))
+        return cur.fetchall()
+
+    def importQuotes(self, channel, quotes):
+        """Inserts the (text, nick, ts) tuples of the iterable quotes in a
+        single transaction and returns how many were inserted. The
+        full-text index is built once at the end instead of on each
+        insert. Quotes already stored are inserted again, like with
+        insertQuote, until dedupeQuotes removes them."""
+        try:
+            return self._importQuotes(channel, quotes)
+        finally:
+            self.cache.invalidate((self._channel(channel), None))
+
+    def delQuoteById(self, channel, qid):
+        try:
+            self._deleteQuoteById(channel, qid)
+        finally:
+            channel = self._channel(channel)
+            self.cache.invalidate((channel, qid), (channel, None))
+
+    def _cacheGet(self, key):
+        self.cache.configure(conf.supybot.plugins.Quotes.quoteCacheSize())
+        return self.cache.get(key)
+
+    def _selectQuoteById(self, channel, qid):
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return None
+            cur = db.cursor()
+            cur.execute("""SELECT rowid, quotetext(text), nick, ts FROM quotes
+            WHERE rowid = ? LIMIT 1""", (qid,))
+            return cur.fetchone()
 
     def getQuoteRandom(self, channel):
-        db = self._getDb(channel)
-        cur = db.cursor()
-        cur.execute("""SELECT rowid, text, nick, ts FROM quotes
-        ORDER BY RANDOM() LIMIT 1""")
-        return cur.fetchone()
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return None
+            cur = db.cursor()
+            cur.execute("""SELECT (SELECT min(rowid) FROM quotes),
+            (SELECT max(rowid) FROM quotes)""")
+            (first, last) = cur.fetchone()
+            if first is None:
+                return None
 
-    def getQuoteLast(self, channel):
-        db = self._getDb(channel)
-        cur = db.cursor()
-        cur.execute("""SELECT rowid, text, nick, ts FROM quotes
-        ORDER BY rowid DESC LIMIT 1""")
-        return cur.fetchone()
+            # Deleted quotes leave gaps in the ids, try random ids until one
+            # exists so every quote has the same chance. If the table is too
+            # sparse, take the next existing id.
+            for i in range(self.randomTries):
+                qid = random.randint(first, last)
+                cur.execute("""SELECT rowid, quotetext(text), nick, ts
+                FROM quotes WHERE rowid = ? LIMIT 1""", (qid,))
+                q = cur.fetchone()
+                if q is not None:
+                    return q
+
+            cur.execute("""SELECT rowid, quotetext(text), nick, ts FROM quotes
+            WHERE rowid >= ? ORDER BY rowid LIMIT 1""", (qid,))
+            return cur.fetchone()
+
+    def _selectQuoteLast(self, channel):
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return None
+            cur = db.cursor()
+            cur.execute("""SELECT rowid, quotetext(text), nick, ts FROM quotes
+            ORDER BY rowid DESC LIMIT 1""")
+            return cur.fetchone()
 
     def searchQuote(self, channel, text):
-        db = self._getDb(channel)
-        cur = db.cursor()
-        cur.execute("""SELECT rowid FROM quotes
-        WHERE text MATCH ?""", ('*' + text + '*',))
-        return [str(i[0]) for i in cur.fetchall()]
+        with self._reader(channel) as (kind, db):
+            query = self._matchQuery(kind, text)
+            if db is None or query is None:
+                return []
+            cur = db.cursor()
+            cur.execute("""SELECT rowid FROM quotes_fts
+            WHERE quotes_fts MATCH ?""", (query,))
+            return [str(i[0]) for i in cur.fetchall()]
 
-    def insertQuote(self, channel, text, nick, ts):
-        db = self._getDb(channel)
-        cur = db.cursor()
-        cur.execute("""INSERT INTO quotes (text, nick, ts)
-        VALUES (?, ?, ?)""", (text, nick, ts,))
-        db.commit()
-        return cur.lastrowid
+    def searchQuotes(self, channel, text, limit, offset=0):
+        """Returns the total number of quotes matching text and the (id,
+        snippet) of limit of them starting at offset, best ranked first.
+        Matching words are highlighted in bold in the snippets."""
+        with self._reader(channel) as (kind, db):
+            query = self._matchQuery(kind, text)
+            if db is None or query is None:
+                return (0, [])
+            cur = db.cursor()
+            cur.execute("""SELECT count(*) FROM quotes_fts
+            WHERE quotes_fts MATCH ?""", (query,))
+            total = cur.fetchone()[0]
+            if not total or offset >= total:
+                return (total, [])
+            if kind == 'fts5':
+                cur.execute("""SELECT rowid,
+                snippet(quotes_fts, 0, '\x02', '\x02', '...', 16)
+                FROM quotes_fts WHERE quotes_fts MATCH ?
+                ORDER BY rank LIMIT ? OFFSET ?""", (query, limit, offset))
+            else:
+                cur.execute("""SELECT docid,
+                snippet(quotes_fts, '\x02', '\x02', '...', 0, 16)
+                FROM quotes_fts WHERE quotes_fts MATCH ?
+                ORDER BY bm25fts4(matchinfo(quotes_fts, 'pcnalx')), docid
+                LIMIT ? OFFSET ?""", (query, limit, offset))
+            return (total, cur.fetchall())
 
-    def delQuoteById(self, channel, qid):
-        db = self._getDb(channel)
+    def fuzzySearchQuotes(self, channel, text, limit, offset=0):
+        """Returns the number of quotes containing the words of text of at
+        least 3 letters, parts of them or words spelt alike, up to
+        fuzzyResults, and the (id, text) of limit of them starting at
+        offset, most similar first."""
+        return self._fuzzySearch(channel, text, limit, offset)
+
+    def _fuzzySearch(self, channel, text, limit, offset):
+        grams = _trigrams(text)
+        words = re.findall(r'\w{3,}', text, re.U)
+        with self._reader(channel) as (kind, db):
+            if db is None or not grams:
+                return (0, [])
+            cur = db.cursor()
+            cap = conf.supybot.plugins.Quotes.fuzzyResults()
+            # The quotes sharing the most trigrams with text are ranked
+            # first, reading at most fuzzyBudget index entries: trigrams
+            # found in more than their share of it are left out.
+            share = max(conf.supybot.plugins.Quotes.fuzzyBudget() //
+                        len(grams), 1)
+            kept = []
+            for gram in grams:
+                cur.execute("""SELECT count(*) FROM (SELECT 1
+                FROM quotes_trigram WHERE quotes_trigram MATCH ?
+                LIMIT ?)""", ('"%s"' % gram, share + 1))
+                if 0 < cur.fetchone()[0] <= share:
+                    kept.append('"%s"' % gram)
+            if kept:
+                rows = self._matchTrigrams(cur, channel, ' OR '.join(kept),
+                                           False, cap)
+            else:
+                # Every trigram is too common to rank the quotes, show the
+                # newest ones containing all the words.
+                rows = self._matchTrigrams(cur, channel,
+                                           ' '.join(['"%s"' % w
+                                                     for w in words]),
+                                           True, cap)
+        scored = [(_similarity(grams, r[-1]), i, r)
+                  for (i, r) in enumerate(rows)]
+        results = [r for (score, i, r) in sorted(scored,
+                                                 key=lambda x: (-x[0], x[1]))
+                   if score >= self.minSimilarity]
+        return (len(results), results[offset:offset + limit])
+
+    def _matchTrigrams(self, cur, channel, query, newest, limit):
+        """Returns the (id, text) of limit quotes matching query in the
+        trigram index, best ranked or newest first."""
+        cur.execute("""SELECT rowid, text FROM quotes_trigram
+        WHERE quotes_trigram MATCH ? ORDER BY %s LIMIT ?""" %
+                    ('rowid DESC' if newest else 'rank'), (query, limit))
+        return cur.fetchall()
+
+    def getQuotesByNick(self, channel, nick, limit, offset=0):
+        """Returns the number of quotes of nick and the (id, text, ts) of
+        limit of them starting at offset, newest first."""
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return (0, [])
+            cur = db.cursor()
+            cur.execute("""SELECT coalesce(sum(count), 0) FROM quotes_stats
+            WHERE nick = ?""", (nick,))
+            total = cur.fetchone()[0]
+            if not total or offset >= total:
+                return (total, [])
+            cur.execute("""SELECT id, quotetext(text), ts FROM quotes
+            WHERE nick = ? COLLATE NOCASE ORDER BY id DESC
+            LIMIT ? OFFSET ?""", (nick, limit, offset))
+            return (total, cur.fetchall())
+
+    def getQuotesBetween(self, channel, since, until, limit, offset=0):
+        """Returns the number of quotes whose timestamp is from since to
+        until, excluded, and the (id, text, nick, ts) of limit of them
+        starting at offset, oldest first. A None bound is ignored."""
+        (since, until) = _bounds(since, until)
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return (0, [])
+            cur = db.cursor()
+            cur.execute("""SELECT count(*) FROM quotes
+            WHERE ts >= ? AND ts < ?""", (since, until))
+            total = cur.fetchone()[0]
+            if not total or offset >= total:
+                return (total, [])
+            cur.execute("""SELECT id, quotetext(text), nick, ts FROM quotes
+            WHERE ts >= ? AND ts < ? ORDER BY ts, id
+            LIMIT ? OFFSET ?""", (since, until, limit, offset))
+            return (total, cur.fetchall())
+
+    def getQuoteStats(self, channel, top, months):
+        """Returns the number of quotes, the (nick, count) of the top nicks
+        with most quotes and the (month, count) of the last months with
+        quotes, newest first. Months are YYYY-MM in UTC."""
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return (0, [], [])
+            cur = db.cursor()
+            cur.execute("""SELECT coalesce(sum(count), 0)
+            FROM quotes_stats""")
+            total = cur.fetchone()[0]
+            cur.execute("""SELECT nick, sum(count) AS n FROM quotes_stats
+            GROUP BY nick ORDER BY n DESC, nick LIMIT ?""", (top,))
+            nicks = cur.fetchall()
+            cur.execute("""SELECT month, sum(count) FROM quotes_stats
+            GROUP BY month ORDER BY month DESC LIMIT ?""", (months,))
+            return (total, nicks, cur.fetchall())
+
+    def _insertQuote(self, channel, text, nick, ts, unique):
+        def insert(cur, kind):
+            if unique:
+                qid = self._findDuplicate(cur, channel, text)
+                if qid is not None:
+                    return (qid, False)
+            cur.execute("""INSERT INTO quotes (text, nick, ts, hash)
+            VALUES (?, ?, ?, ?)""", (_pack(text, self._threshold(cur, kind)),
+                                     nick, ts, _quoteHash(text)))
+            return (cur.lastrowid, True)
+        return self._write(channel, insert)
+
+    def _importQuotes(self, channel, quotes):
+        def insert(cur, kind):
+            # Before the triggers are dropped, the indexes may be rebuilt.
+            threshold = self._threshold(cur, kind)
+            cur.execute("""SELECT coalesce(max(id), 0) FROM quotes""")
+            last = cur.fetchone()[0]
+            self._dropInsertTriggers(cur)
+            cur.executemany("""INSERT INTO quotes (text, nick, ts, hash)
+            VALUES (quotepack(?1, %d), ?2, ?3, quotehash(?1))""" % threshold,
+                            quotes)
+            cur.execute("""SELECT count(*) FROM quotes WHERE id > ?""",
+                        (last,))
+            count = cur.fetchone()[0]
+            self._indexInserted(cur, kind, last)
+            return count
+        return self._write(channel, insert)
+
+    def iterQuotes(self, channel):
+        """Yields the (id, text, nick, ts) of every quote in id order,
+        reading them from the database as they are consumed."""
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return
+            cur = db.cursor()
+            cur.execute("""SELECT id, quotetext(text), nick, ts FROM quotes
+            ORDER BY id""")
+            for q in cur:
+                yield q
+
+    def _deleteQuoteById(self, channel, qid):
+        def delete(cur, kind):
+            cur.execute("""DELETE FROM quotes WHERE rowid = ?""", (qid,))
+        self._write(channel, delete)
+
+
+class SingleSqliteQuotesDB(SqliteQuotesDB):
+    """Stores the quotes of every channel in a single database, where each
+    quote has a channel and its id within the channel."""
+    # Version 1 had no quote counts, version 2 no prefix and trigram
+    # indexes and version 3 no content hashes.
+    schemaVersion = 4
+    consolidated = True
+    statsColumns = (('channel', 'TEXT NOT NULL'),
+                    ('nick', 'TEXT NOT NULL COLLATE NOCASE'))
+    hashIndex = """CREATE INDEX quotes_hash ON quotes (channel, hash)"""
+
+    def _channelFilename(self, channel, create):
+        return self.filename
+
+    def _databaseFiles(self, directory):
+        path = os.path.join(directory, os.path.basename(self.filename))
+        return [path] if os.path.isfile(path) else []
+
+    def _upgrade(self, db):
         cur = db.cursor()
-        cur.execute("""DELETE FROM quotes WHERE rowid = ?""", (qid,))
-        db.commit()
+        cur.execute("""PRAGMA user_version""")
+        version = cur.fetchone()[0]
+        if version >= self.schemaVersion and not self._missingTrigram(cur):
+            return
+
+        cur.execute("""BEGIN""")
+        try:
+            if version < 1:
+                cur.execute("""CREATE TABLE quotes (
+                id INTEGER PRIMARY KEY,
+                channel TEXT NOT NULL,
+                qid INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                nick TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                hash INTEGER,
+                UNIQUE (channel, qid)
+                )""")
+                cur.execute("""CREATE INDEX quotes_nick
+                ON quotes (channel, nick COLLATE NOCASE)""")
+                cur.execute("""CREATE INDEX quotes_ts
+                ON quotes (channel, ts)""")
+                cur.execute(self.hashIndex)
+            if 1 <= version < 4:
+                self._dropFts(cur)
+                self._addHashes(cur)
+            if version < 4:
+                self._createFts(cur)
+            if version < 2:
+                self._createStats(cur)
+            if self._missingTrigram(cur):
+                self._createTrigram(cur, self._hasPackedIndexes(cur))
+            cur.execute("""PRAGMA user_version = %d""" % self.schemaVersion)
+            cur.execute("""COMMIT""")
+        except:
+            _rollback(cur)
+            raise
+
+    def _selectQuoteById(self, channel, qid):
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return None
+            cur = db.cursor()
+            cur.execute("""SELECT qid, quotetext(text), nick, ts FROM quotes
+            WHERE channel = ? AND qid = ?""", (self._channel(channel), qid))
+            return cur.fetchone()
+
+    def getQuoteRandom(self, channel):
+        channel = self._channel(channel)
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return None
+            cur = db.cursor()
+            cur.execute("""SELECT
+            (SELECT min(qid) FROM quotes WHERE channel = ?),
+            (SELECT max(qid) FROM quotes WHERE channel = ?)""",
+                        (channel, channel))
+            (first, last) = cur.fetchone()
+            if first is None:
+                return None
+
+            # Same as SqliteQuotesDB.getQuoteRandom.
+            for i in range(self.randomTries):
+                qid = random.randint(first, last)
+                cur.execute("""SELECT qid, quotetext(text), nick, ts
+                FROM quotes WHERE channel = ? AND qid = ?""", (channel, qid))
+                q = cur.fetchone()
+                if q is not None:
+                    return q
+
+            cur.execute("""SELECT qid, quotetext(text), nick, ts FROM quotes
+            WHERE channel = ? AND qid >= ? ORDER BY qid LIMIT 1""",
+                        (channel, qid))
+            return cur.fetchone()
+
+    def _selectQuoteLast(self, channel):
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return None
+            cur = db.cursor()
+            cur.execute("""SELECT qid, quotetext(text), nick, ts FROM quotes
+            WHERE channel = ? ORDER BY qid DESC LIMIT 1""",
+                        (self._channel(channel),))
+            return cur.fetchone()
+
+    def searchQuote(self, channel, text):
+        with self._reader(channel) as (kind, db):
+            query = self._matchQuery(kind, text)
+            if db is None or query is None:
+                return []
+            cur = db.cursor()
+            # CROSS JOIN makes SQLite match the index first instead of
+            # matching it again for every quote of the channel.
+            cur.execute("""SELECT quotes.qid FROM quotes_fts
+            CROSS JOIN quotes ON quotes.id = quotes_fts.rowid
+            WHERE quotes_fts MATCH ? AND quotes.channel = ?
+            ORDER BY quotes.qid""", (query, self._channel(channel)))
+            return [str(i[0]) for i in cur.fetchall()]
+
+    def _search(self, channel, text, limit, offset):
+        """Returns the number of quotes matching text in channel, or in
+        every channel if it is None, and the (channel, id, snippet) of limit
+        of them starting at offset, best ranked first."""
+        with self._reader(channel) as (kind, db):
+            query = self._matchQuery(kind, text)
+            if db is None or query is None:
+                return (0, [])
+            if channel is None:
+                where = ''
+                args = (query,)
+            else:
+                where = 'AND quotes.channel = ?'
+                args = (query, self._channel(channel))
+            cur = db.cursor()
+            cur.execute("""SELECT count(*) FROM quotes_fts
+            CROSS JOIN quotes ON quotes.id = quotes_fts.rowid
+            WHERE quotes_fts MATCH ? %s""" % where, args)
+            total = cur.fetchone()[0]
+            if not total or offset >= total:
+                return (total, [])
+            if kind == 'fts5':
+                cur.execute("""SELECT quotes.channel, quotes.qid,
+                snippet(quotes_fts, 0, '\x02', '\x02', '...', 16)
+                FROM quotes_fts
+                CROSS JOIN quotes ON quotes.id = quotes_fts.rowid
+                WHERE quotes_fts MATCH ? %s
+                ORDER BY quotes_fts.rank LIMIT ? OFFSET ?""" % where,
+                            args + (limit, offset))
+            else:
+                cur.execute("""SELECT quotes.channel, quotes.qid,
+                snippet(quotes_fts, '\x02', '\x02', '...', 0, 16)
+                FROM quotes_fts
+                CROSS JOIN quotes ON quotes.id = quotes_fts.docid
+                WHERE quotes_fts MATCH ? %s
+                ORDER BY bm25fts4(matchinfo(quotes_fts, 'pcnalx')), quotes.id
+                LIMIT ? OFFSET ?""" % where, args + (limit, offset))
+            return (total, cur.fetchall())
+
+    def searchQuotes(self, channel, text, limit, offset=0):
+        (total, results) = self._search(channel, text, limit, offset)
+        return (total, [r[1:] for r in results])
+
+    def searchAllQuotes(self, text, limit, offset=0):
+        """Like searchQuotes in every channel, the results are (channel, id,
+        snippet)."""
+        return self._search(None, text, limit, offset)
+
+    def _matchTrigrams(self, cur, channel, query, newest, limit):
+        """Like SqliteQuotesDB._matchTrigrams, in every channel if channel
+        is None, with the channel first in the results."""
+        if channel is None:
+            where = ''
+            args = (query, limit)
+        else:
+            where = 'AND quotes.channel = ?'
+            args = (query, self._channel(channel), limit)
+        cur.execute("""SELECT quotes.channel, quotes.qid,
+        quotetext(quotes.text) FROM quotes_trigram
+        CROSS JOIN quotes ON quotes.id = quotes_trigram.rowid
+        WHERE quotes_trigram MATCH ? %s ORDER BY %s LIMIT ?""" %
+                    (where, 'quotes.id DESC' if newest
+                     else 'quotes_trigram.rank'), args)
+        if channel is None:
+            return cur.fetchall()
+        return [r[1:] for r in cur.fetchall()]
 
-QuotesDB = plugins.DB('Quotes', {'sqlite3': SqliteQuotesDB})
+    def fuzzySearchAllQuotes(self, text, limit, offset=0):
+        """Like fuzzySearchQuotes in every channel, the results are
+        (channel, id, text)."""
+        return self._fuzzySearch(None, text, limit, offset)
+
+    def getQuotesByNick(self, channel, nick, limit, offset=0):
+        channel = self._channel(channel)
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return (0, [])
+            cur = db.cursor()
+            cur.execute("""SELECT coalesce(sum(count), 0) FROM quotes_stats
+            WHERE channel = ? AND nick = ?""", (channel, nick))
+            total = cur.fetchone()[0]
+            if not total or offset >= total:
+                return (total, [])
+            cur.execute("""SELECT qid, quotetext(text), ts FROM quotes
+            WHERE channel = ? AND nick = ? COLLATE NOCASE ORDER BY id DESC
+            LIMIT ? OFFSET ?""", (channel, nick, limit, offset))
+            return (total, cur.fetchall())
+
+    def getQuotesBetween(self, channel, since, until, limit, offset=0):
+        channel = self._channel(channel)
+        (since, until) = _bounds(since, until)
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return (0, [])
+            cur = db.cursor()
+            cur.execute("""SELECT count(*) FROM quotes
+            WHERE channel = ? AND ts >= ? AND ts < ?""",
+                        (channel, since, until))
+            total = cur.fetchone()[0]
+            if not total or offset >= total:
+                return (total, [])
+            cur.execute("""SELECT qid, quotetext(text), nick, ts FROM quotes
+            WHERE channel = ? AND ts >= ? AND ts < ? ORDER BY ts, id
+            LIMIT ? OFFSET ?""", (channel, since, until, limit, offset))
+            return (total, cur.fetchall())
+
+    def getQuoteStats(self, channel, top, months):
+        channel = self._channel(channel)
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return (0, [], [])
+            cur = db.cursor()
+            cur.execute("""SELECT coalesce(sum(count), 0) FROM quotes_stats
+            WHERE channel = ?""", (channel,))
+            total = cur.fetchone()[0]
+            cur.execute("""SELECT nick, sum(count) AS n FROM quotes_stats
+            WHERE channel = ? GROUP BY nick ORDER BY n DESC, nick
+            LIMIT ?""", (channel, top))
+            nicks = cur.fetchall()
+            cur.execute("""SELECT month, sum(count) FROM quotes_stats
+            WHERE channel = ? GROUP BY month ORDER BY month DESC
+            LIMIT ?""", (channel, months))
+            return (total, nicks, cur.fetchall())
+
+    def _bulkInsert(self, cur, kind, quotes, ignore=False):
+        """Inserts the (channel, id, text, nick, ts) of quotes, indexing them
+        all at once, and returns how many were inserted. With ignore, quotes
+        whose id is already used in their channel are skipped."""
+        threshold = self._threshold(cur, kind)
+        cur.execute("""SELECT coalesce(max(id), 0) FROM quotes""")
+        last = cur.fetchone()[0]
+        self._dropInsertTriggers(cur)
+        cur.executemany("""INSERT %s INTO quotes
+        (channel, qid, text, nick, ts, hash)
+        VALUES (?1, ?2, quotepack(?3, %d), ?4, ?5, quotehash(?3))""" %
+                        ('OR IGNORE' if ignore else '', threshold), quotes)
+        cur.execute("""SELECT count(*) FROM quotes WHERE id > ?""", (last,))
+        count = cur.fetchone()[0]
+        self._indexInserted(cur, kind, last)
+        return count
+
+    def _insertQuote(self, channel, text, nick, ts, unique):
+        channel = self._channel(channel)
+
+        def insert(cur, kind):
+            if unique:
+                qid = self._findDuplicate(cur, channel, text)
+                if qid is not None:
+                    return (qid, False)
+            cur.execute("""SELECT coalesce(max(qid), 0) + 1 FROM quotes
+            WHERE channel = ?""", (channel,))
+            qid = cur.fetchone()[0]
+            cur.execute("""INSERT INTO quotes
+            (channel, qid, text, nick, ts, hash) VALUES (?, ?, ?, ?, ?, ?)""",
+                        (channel, qid,
+                         _pack(text, self._threshold(cur, kind)), nick, ts,
+                         _quoteHash(text)))
+            return (qid, True)
+        return self._write(channel, insert)
+
+    def _findDuplicate(self, cur, channel, text):
+        cur.execute("""SELECT qid, quotetext(text) FROM quotes
+        WHERE channel = ? AND hash = ? ORDER BY id""",
+                    (channel, _quoteHash(text)))
+        return self._sameText(cur.fetchall(), text)
+
+    def _textSize(self, cur, channel):
+        cur.execute("""SELECT coalesce(sum(length(CAST(text AS BLOB))), 0)
+        FROM quotes WHERE channel = ?""", (self._channel(channel),))
+        return cur.fetchone()[0]
+
+    def _selectStored(self, cur, channel, threshold, last):
+        cur.execute("""SELECT id, text FROM quotes
+        WHERE channel = ? AND id > ?
+        AND (typeof(text) = 'blob' OR (? AND length(text) >= ?))
+        ORDER BY id LIMIT ?""", (self._channel(channel), last, threshold,
+                                 threshold, self.compressBatch))
+        return cur.fetchall()
+
+    def _selectHashCollisions(self, cur, channel):
+        channel = self._channel(channel)
+        cur.execute("""SELECT id, hash, quotetext(text) FROM quotes
+        WHERE channel = ? AND hash IN (SELECT hash FROM quotes
+                                       WHERE channel = ? GROUP BY hash
+                                       HAVING count(*) > 1)
+        ORDER BY hash, id""", (channel, channel))
+        return cur
+
+    def _importQuotes(self, channel, quotes):
+        channel = self._channel(channel)
+
+        def insert(cur, kind):
+            cur.execute("""SELECT coalesce(max(qid), 0) FROM quotes
+            WHERE channel = ?""", (channel,))
+            last = cur.fetchone()[0]
+            return self._bulkInsert(cur, kind,
+                                    ((channel, last + i + 1) + tuple(q)
+                                     for (i, q) in enumerate(quotes)))
+        return self._write(channel, insert)
+
+    def iterQuotes(self, channel):
+        with self._reader(channel) as (kind, db):
+            if db is None:
+                return
+            cur = db.cursor()
+            cur.execute("""SELECT qid, quotetext(text), nick, ts FROM quotes
+            WHERE channel = ? ORDER BY qid""", (self._channel(channel),))
+            for q in cur:
+                yield q
+
+    def _deleteQuoteById(self, channel, qid):
+        channel = self._channel(channel)
+
+        def delete(cur, kind):
+            cur.execute("""DELETE FROM quotes WHERE channel = ? AND qid = ?""",
+                        (channel, qid))
+        self._write(channel, delete)
+
+    def mergeChannelDbs(self, filename='Quotes.sqlite3.db'):
+        """Copies the quotes of the per-channel databases named filename in
+        the data directory, keeping their ids. Quotes whose id is already
+        used in their channel are skipped. Returns the number of quotes
+        found and merged by channel."""
+        data = conf.supybot.directories.data()
+        merged = {}
+        for name in sorted(os.listdir(data)):
+            path = os.path.join(data, name, os.path.basename(filename))
+            if not os.path.isfile(path):
+                continue
+            source = sqlite3.connect(path)
+            source.text_factory = str
+            try:
+                (found,) = source.execute("""SELECT count(*)
+                FROM quotes""").fetchone()
+                # Both the current and the FTS4-only schemas have these.
+                quotes = source.execute("""SELECT rowid, text, nick, ts
+                FROM quotes ORDER BY rowid""")
+                count = self._write(name, lambda cur, kind: self._bulkInsert(
+                    cur, kind, ((name,) + tuple(q) for q in quotes),
+                    ignore=True))
+            finally:
+                source.close()
+            merged[name] = (found, count)
+        self.cache.clear()
+        return merged
+
+
+QuotesDB = plugins.DB('Quotes', {'sqlite3': SqliteQuotesDB,
+                                 'sqlite3single': SingleSqliteQuotesDB})
+
+
+def guessFormat(filename):
+    """Guesses the import/export format of filename from its extension."""
+    ext = os.path.splitext(filename)[1].lower()
+    if filename.lower().endswith('.flat.db'):
+        return 'quote'
+    elif ext in ('.json', '.jsonl'):
+        return 'json'
+    elif ext == '.csv':
+        return 'csv'
+    elif ext in ('.db', '.sqlite', '.sqlite3'):
+        return 'sqlite'
+    return 'text'
+
+
+def parseDate(text, end=False):
+    """Returns the UTC timestamp of the beginning of the day, month or year
+    text is (YYYY-MM-DD, YYYY-MM or YYYY), or with end the beginning of the
+    next one. Raises ValueError for other texts."""
+    for fmt in ('%Y-%m-%d', '%Y-%m', '%Y'):
+        try:
+            d = datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        try:
+            if end and fmt == '%Y-%m-%d':
+                d += timedelta(days=1)
+            elif end and fmt == '%Y-%m':
+                d = d.replace(year=d.year + d.month // 12,
+                              month=d.month % 12 + 1)
+            elif end:
+                d = d.replace(year=d.year + 1)
+        except (ValueError, OverflowError):
+            # The end of year 9999 doesn't fit in a datetime.
+            raise ValueError('%s is too far away' % text)
+        return calendar.timegm(d.timetuple())
+    raise ValueError('%s is not a date' % text)
+
+
+def _jsonObjects(fd):
+    """Yields the objects of the JSON lines of fd. Raises ValueError for
+    lines that aren't a JSON object."""
+    for (n, line) in enumerate(fd, 1):
+        if not line.strip():
+            continue
+        try:
+            q = json.loads(line)
+        except ValueError as e:
+            raise ValueError('bad line %s: %s' % (n, e))
+        if not isinstance(q, dict):
+            raise ValueError('bad line %s: not a JSON object' % n)
+        yield q
+
+
+def readQuotes(filename, fmt, nick, ts):
+    """Yields the (text, nick, ts) of the quotes in filename as they are
+    read. Quotes without author or date get the given nick and ts.
+
+    Formats are 'text' (one quote per line), 'json' (one object with text,
+    nick and ts keys per line), 'csv' (with a text,nick,ts header), 'sqlite'
+    (a QuoteGrabs or Quotes database) and 'quote' (a Quote.flat.db database
+    of Limnoria's Quote plugin)."""
+    if fmt == 'sqlite':
+        if not os.path.exists(filename):
+            raise IOError('No such file: %s' % filename)
+        db = sqlite3.connect(filename)
+        db.text_factory = str
+        try:
+            tables = [t[0] for t in db.execute("""SELECT name
+            FROM sqlite_master WHERE type = 'table'""")]
+            if 'quotegrabs' in tables:
+                cur = db.execute("""SELECT quote, nick, added_at
+                FROM quotegrabs ORDER BY id""")
+            elif 'quotes' in tables:
+                cur = db.execute("""SELECT text, nick, ts
+                FROM quotes ORDER BY rowid""")
+            else:
+                raise ValueError('%s is not a quotes database' % filename)
+            for q in cur:
+                yield q
+        finally:
+            db.close()
+        return
+
+    if fmt == 'quote':
+        # A first line with the next id, then id:at,by,text lines of CSV
+        # records of repr()s. Deleted records have an id of dashes.
+        with io.open(filename, encoding='utf-8', errors='replace') as fd:
+            fd.readline()
+            for line in fd:
+                (qid, _, record) = line.rstrip('\r\n').partition(':')
+                if not record or qid.startswith('-'):
+                    continue
+                (at, by, text) = [utils.safeEval(v) for v in
+                                  next(csv.reader([record]))]
+                # Registered users are stored by their id.
+                yield (text, plugins.getUserName(by), int(at))
+        return
+
+    with io.open(filename, encoding='utf-8', errors='replace',
+                 newline='') as fd:
+        if fmt == 'text':
+            for line in fd:
+                line = line.rstrip('\r\n')
+                if line.strip():
+                    yield (line, nick, ts)
+            return
+        elif fmt == 'json':
+            rows = _jsonObjects(fd)
+        else:
+            rows = csv.DictReader(fd)
+        for q in rows:
+            if not q.get('text'):
+                continue
+            yield (q['text'], q.get('nick') or nick, int(q.get('ts') or ts))
+
+
+def writeQuotes(filename, fmt, quotes):
+    """Writes the (id, text, nick, ts) of the iterable quotes to filename as
+    they are read and returns how many were written."""
+    count = 0
+    with io.open(filename, 'w', encoding='utf-8', newline='') as fd:
+        if fmt == 'csv':
+            writer = csv.writer(fd)
+            writer.writerow(('id', 'text', 'nick', 'ts'))
+        for (qid, text, nick, ts) in quotes:
+            if fmt == 'json':
+                fd.write(json.dumps({'id': qid, 'text': text, 'nick': nick,
+                                     'ts': ts}) + '\n')
+            elif fmt == 'csv':
+                writer.writerow((qid, text, nick, ts))
+            else:
+                fd.write(text.replace('\n', ' ') + '\n')
+            count += 1
+    return count
+
+
+def _day(ts):
+    """Formats the UTC day of the timestamp ts."""
+    return datetime.utcfromtimestamp(ts).strftime('%Y-%m-%d')
 
 
 class Quotes(callbacks.Plugin):
@@ -134,16 +1996,116 @@ class Quotes(callbacks.Plugin):
         self.__parent = super(Quotes, self)
         self.__parent.__init__(irc)
         self.db = QuotesDB()
+        schedule.addPeriodicEvent(self.db.closeIdle, 60, 'Quotes.closeIdle',
+                                  now=False)
+        self._maintenanceLock = threading.Lock()
+        interval = self.registryValue('maintenanceInterval')
+        if interval:
+            schedule.addPeriodicEvent(self._startMaintenance, interval,
+                                      'Quotes.maintenance', now=False)
+        self._snapshotLock = threading.Lock()
+        interval = self.registryValue('snapshotInterval')
+        if self.db.replica:
+            schedule.addPeriodicEvent(self.db.refreshSnapshots,
+                                      self.registryValue('refreshInterval'),
+                                      'Quotes.refreshSnapshots', now=False)
+        elif interval and self.db.snapshots:
+            schedule.addPeriodicEvent(self._startSnapshots, interval,
+                                      'Quotes.snapshots', now=False)
 
     def die(self):
         self.__parent.die()
+        for name in ('Quotes.closeIdle', 'Quotes.maintenance',
+                     'Quotes.snapshots', 'Quotes.refreshSnapshots'):
+            try:
+                schedule.removePeriodicEvent(name)
+            except KeyError:
+                pass
         self.db.close()
 
+    def _startMaintenance(self):
+        # Scheduled events run in the main thread, don't block it.
+        t = threading.Thread(target=self._scheduledMaintenance,
+                             name='Quotes maintenance')
+        t.daemon = True
+        t.start()
+
+    def _scheduledMaintenance(self):
+        try:
+            self._maintain(idle=self.registryValue('maintenanceIdle'))
+        except sqlite3.Error:
+            log.exception('Quotes: scheduled maintenance failed:')
+
+    def _maintain(self, channel=None, idle=0):
+        """Runs the maintenance of the databases and logs its results, unless
+        it is already running. Returns the results or None."""
+        if not self._maintenanceLock.acquire(False):
+            return None
+        try:
+            results = self.db.maintain(channel, idle)
+        finally:
+            self._maintenanceLock.release()
+        for (filename, r) in sorted(results.items()):
+            log.info('Quotes: maintenance of %s: optimize %.1f ms, vacuum '
+                     '%.1f ms (%s pages freed), check %.1f ms', filename,
+                     r['optimize'] * 1000, r['vacuum'] * 1000, r['freed'],
+                     r['check'] * 1000)
+            for problem in r['problems']:
+                log.error('Quotes: %s is damaged: %s', filename, problem)
+        return results
+
+    def _startSnapshots(self):
+        # Like the maintenance, don't block the main thread.
+        t = threading.Thread(target=self._scheduledSnapshots,
+                             name='Quotes snapshots')
+        t.daemon = True
+        t.start()
+
+    def _scheduledSnapshots(self):
+        try:
+            self._publishSnapshots()
+        except (IOError, OSError, sqlite3.Error):
+            log.exception('Quotes: publishing the snapshots failed:')
+
+    def _publishSnapshots(self):
+        """Publishes the snapshots of the databases changed since their last
+        one, unless it is already being done. Returns their filenames or
+        None."""
+        if not self._snapshotLock.acquire(False):
+            return None
+        try:
+            published = self.db.publishSnapshots()
+        finally:
+            self._snapshotLock.release()
+        for filename in published:
+            log.info('Quotes: published the snapshot %s', filename)
+        return published
+
+    def _dataFilename(self, irc, filename):
+        """Returns the path of filename in the data directory, or gives an
+        error if it is outside of it."""
+        data = os.path.realpath(conf.supybot.directories.data())
+        path = conf.supybot.directories.data.dirize(filename)
+        if (os.path.isabs(filename) or
+                not os.path.realpath(path).startswith(data + os.sep)):
+            irc.error(format(_("%s is not in the data directory."), filename),
+                      Raise=True)
+        return path
+
+    def _checkWritable(self, irc):
+        if self.db.replica:
+            irc.error(_("This bot serves read-only snapshots of the quotes, "
+                        "change them with the bot publishing the "
+                        "snapshots."), Raise=True)
+
     def addquote(self, irc, msg, args, optlist, text):
         """[--channel <#channel>] <text>
         Inserts a quote in the database. If it gives an error saying '"x" is
         not valid command' try again with the text between quotes ("text"). If
-        --channel is supplied the quote is stored in that channel database."""
+        --channel is supplied the quote is stored in that channel database.
+        A quote already stored is handled according to
+        supybot.plugins.Quotes.duplicates."""
+        self._checkWritable(irc)
         channel = msg.args[0]
         for (option, arg) in optlist:
             if option == 'channel':
@@ -152,8 +2114,21 @@ class Quotes(callbacks.Plugin):
                               Raise=True)
                 channel = arg
 
-        qid = self.db.insertQuote(channel, text, msg.nick, int(time.time()))
-        irc.reply(format(_("Quote inserted with id: %s"), qid))
+        duplicates = self.registryValue('duplicates', channel)
+        if duplicates == 'allow':
+            qid = self.db.insertQuote(channel, text, msg.nick,
+                                      int(time.time()))
+            inserted = True
+        else:
+            (qid, inserted) = self.db.addQuote(channel, text, msg.nick,
+                                               int(time.time()))
+        if inserted:
+            irc.reply(format(_("Quote inserted with id: %s"), qid))
+        elif duplicates == 'link':
+            irc.reply(format(_("Quote already stored with id: %s"), qid))
+        else:
+            irc.error(format(_("This quote is already stored with id: %s"),
+                             qid))
 
     addquote = wrap(addquote,
                     [getopts({'channel': 'somethingWithoutSpaces'}), 'text'])
@@ -163,6 +2138,7 @@ class Quotes(callbacks.Plugin):
         Delete the quote number 'id', only by the creator of the quote in
         the first 5 minutes or by an admin. If --channel is supplied the
         quote is fetched from that channel database."""
+        self._checkWritable(irc)
         channel = msg.args[0]
         for (option, arg) in optlist:
             if option == 'channel':
@@ -248,30 +2224,233 @@ class Quotes(callbacks.Plugin):
                      [getopts({'channel': 'somethingWithoutSpaces'})])
 
     def findquote(self, irc, msg, args, optlist, text):
-        """[--channel <#channel>] [<id>]
-        Search quotes containing 'text'. If --channel is supplied
-        the quote is fetched from that channel database."""
+        """[--channel <#channel>|--all] [--fuzzy] [--page <n>] [--limit <n>] <text>
+        Search quotes containing the words of 'text', the last one can be
+        the beginning of a word. With --fuzzy the words of at least 3
+        letters can also be any part of a word or be misspelt, and the
+        quotes sharing the most with them are shown first. Results are
+        sorted by relevance and shown by pages of --limit quotes
+        (supybot.plugins.Quotes.searchLimit by default). If --channel is
+        supplied the quote is fetched from that channel database. --all
+        searches every channel, it needs the sqlite3single database."""
         channel = msg.args[0]
+        page = 1
+        limit = None
+        everywhere = False
+        fuzzy = False
         for (option, arg) in optlist:
             if option == 'channel':
                 if not ircutils.isChannel(arg):
                     irc.error(format(_('%s is not a valid channel.'), arg),
                               Raise=True)
                 channel = arg
+            elif option == 'page':
+                page = arg
+            elif option == 'limit':
+                limit = arg
+            elif option == 'all':
+                everywhere = True
+            elif option == 'fuzzy':
+                fuzzy = True
 
-        qlist = self.db.searchQuote(channel, text)
+        if everywhere and not self.db.consolidated:
+            irc.error(_("Searching every channel needs all the quotes in a "
+                        "single database, add sqlite3single before sqlite3 "
+                        "in supybot.databases and use mergequotes."),
+                      Raise=True)
+        if fuzzy and not self.db.trigram:
+            irc.error(_("Fuzzy searches need SQLite 3.34 or newer."),
+                      Raise=True)
+        if fuzzy and not re.search(r'\w{3}', text, re.U):
+            irc.error(_("Fuzzy searches need words of at least 3 letters."),
+                      Raise=True)
 
-        if len(qlist) > 0:
-            irc.reply(format("Quotes containing '%s': %s",
-                             text, ', '.join(qlist)))
-            for i in qlist[-3:]:
-                q = self.db.getQuoteById(channel, i)
-                irc.reply(format("#%s: %s", q[0], q[1]), noLengthCheck=True)
+        limit = self._limit(channel, limit)
+        offset = (page - 1) * limit
+
+        if fuzzy and everywhere:
+            (total, results) = self.db.fuzzySearchAllQuotes(text, limit,
+                                                            offset)
+        elif fuzzy:
+            (total, results) = self.db.fuzzySearchQuotes(channel, text, limit,
+                                                         offset)
+        elif everywhere:
+            (total, results) = self.db.searchAllQuotes(text, limit, offset)
         else:
+            (total, results) = self.db.searchQuotes(channel, text, limit,
+                                                    offset)
+
+        if total == 0:
             irc.error(format(_("There is no quote that contains '%s'"), text))
+        else:
+            self._replyPage(irc, format(_("%n %s '%s'"), (total, 'quote'),
+                                        _("like") if fuzzy
+                                        else _("containing"), text),
+                            total, page, limit,
+                            [format("%s #%s: %s", *r) if everywhere
+                             else format("#%s: %s", *r) for r in results])
 
     findquote = wrap(findquote,
-                     [getopts({'channel': 'somethingWithoutSpaces'}), 'text'])
+                     [getopts({'channel': 'somethingWithoutSpaces',
+                               'all': '',
+                               'fuzzy': '',
+                               'page': 'positiveInt',
+                               'limit': 'positiveInt'}), 'text'])
+
+    def _limit(self, channel, limit):
+        """Returns the number of results by page, limit if it is given."""
+        if limit is None:
+            limit = self.registryValue('searchLimit', channel)
+        return min(limit, self.registryValue('maxSearchLimit'))
+
+    def _replyPage(self, irc, header, total, page, limit, lines):
+        """Replies the lines of a page of results after header."""
+        pages = (total + limit - 1) // limit
+        if not lines:
+            irc.error(format(_("There is no page %s, the last one is %s."),
+                             page, pages), Raise=True)
+        irc.reply(format(_("%s (page %s of %s):"), header, page, pages))
+        for line in lines:
+            irc.reply(line, noLengthCheck=True)
+
+    def quotesby(self, irc, msg, args, optlist, nick):
+        """[--channel <#channel>] [--page <n>] [--limit <n>] <nick>
+        Lists the quotes stored by 'nick', newest first, by pages of --limit
+        quotes (supybot.plugins.Quotes.searchLimit by default). If --channel
+        is supplied the quotes are fetched from that channel database."""
+        channel = msg.args[0]
+        page = 1
+        limit = None
+        for (option, arg) in optlist:
+            if option == 'channel':
+                if not ircutils.isChannel(arg):
+                    irc.error(format(_('%s is not a valid channel.'), arg),
+                              Raise=True)
+                channel = arg
+            elif option == 'page':
+                page = arg
+            elif option == 'limit':
+                limit = arg
+
+        limit = self._limit(channel, limit)
+        (total, results) = self.db.getQuotesByNick(channel, nick, limit,
+                                                   (page - 1) * limit)
+
+        if total == 0:
+            irc.error(format(_("There is no quote by %s in %s's database."),
+                             nick, channel))
+        else:
+            self._replyPage(irc, format(_("%n by %s"), (total, 'quote'), nick),
+                            total, page, limit,
+                            [format("#%s (%s): %s", qid, _day(ts), text)
+                             for (qid, text, ts) in results])
+
+    quotesby = wrap(quotesby,
+                    [getopts({'channel': 'somethingWithoutSpaces',
+                              'page': 'positiveInt',
+                              'limit': 'positiveInt'}),
+                     'somethingWithoutSpaces'])
+
+    def quotesbetween(self, irc, msg, args, optlist):
+        """[--channel <#channel>] [--since <date>] [--until <date>] [--page <n>] [--limit <n>]
+        Lists the quotes stored from --since to --until, both included,
+        oldest first. Dates are YYYY-MM-DD, YYYY-MM or YYYY in UTC, at
+        least one of them must be given. Results are shown by pages of
+        --limit quotes (supybot.plugins.Quotes.searchLimit by default). If
+        --channel is supplied the quotes are fetched from that channel
+        database."""
+        channel = msg.args[0]
+        page = 1
+        limit = None
+        since = until = None
+        for (option, arg) in optlist:
+            if option == 'channel':
+                if not ircutils.isChannel(arg):
+                    irc.error(format(_('%s is not a valid channel.'), arg),
+                              Raise=True)
+                channel = arg
+            elif option == 'page':
+                page = arg
+            elif option == 'limit':
+                limit = arg
+            elif option in ('since', 'until'):
+                try:
+                    ts = parseDate(arg, end=option == 'until')
+                except ValueError:
+                    irc.error(format(_("%s is not a valid date, use "
+                                       "YYYY-MM-DD, YYYY-MM or YYYY."), arg),
+                              Raise=True)
+                if option == 'since':
+                    since = (arg, ts)
+                else:
+                    until = (arg, ts)
+
+        if since is None and until is None:
+            irc.error(_("Give --since, --until or both."), Raise=True)
+        if since is None:
+            period = format(_("until %s"), until[0])
+        elif until is None:
+            period = format(_("since %s"), since[0])
+        else:
+            period = format(_("from %s to %s"), since[0], until[0])
+
+        limit = self._limit(channel, limit)
+        (total, results) = self.db.getQuotesBetween(
+            channel, since and since[1], until and until[1], limit,
+            (page - 1) * limit)
+
+        if total == 0:
+            irc.error(format(_("There is no quote %s in %s's database."),
+                             period, channel))
+        else:
+            self._replyPage(irc, format(_("%n %s"), (total, 'quote'), period),
+                            total, page, limit,
+                            [format("#%s (%s, %s): %s", qid, _day(ts), nick,
+                                    text)
+                             for (qid, text, nick, ts) in results])
+
+    quotesbetween = wrap(quotesbetween,
+                         [getopts({'channel': 'somethingWithoutSpaces',
+                                   'since': 'something',
+                                   'until': 'something',
+                                   'page': 'positiveInt',
+                                   'limit': 'positiveInt'})])
+
+    def quotestats(self, irc, msg, args, optlist):
+        """[--channel <#channel>] [--top <n>] [--months <n>]
+        Shows the number of quotes, the --top nicks that stored the most
+        quotes (5 by default) and the quotes stored in each of the last
+        --months months with quotes (6 by default, UTC). If --channel is
+        supplied the stats are those of that channel database."""
+        channel = msg.args[0]
+        top = 5
+        months = 6
+        for (option, arg) in optlist:
+            if option == 'channel':
+                if not ircutils.isChannel(arg):
+                    irc.error(format(_('%s is not a valid channel.'), arg),
+                              Raise=True)
+                channel = arg
+            elif option == 'top':
+                top = arg
+            elif option == 'months':
+                months = arg
+
+        (total, nicks, counts) = self.db.getQuoteStats(channel, top, months)
+
+        if total == 0:
+            irc.error(format(_("There is no quotes in %s's database."),
+                             channel))
+        else:
+            irc.reply(format(_("%n in %s's database. Top quoters: %s. "
+                               "Last months: %s."), (total, 'quote'), channel,
+                             ', '.join(['%s (%s)' % n for n in nicks]),
+                             ', '.join(['%s (%s)' % m for m in counts])))
+
+    quotestats = wrap(quotestats,
+                      [getopts({'channel': 'somethingWithoutSpaces',
+                                'top': 'positiveInt',
+                                'months': 'positiveInt'})])
 
     def quoteinfo(self, irc, msg, args, optlist, qid):
         """[--channel <#channel>] <id>
@@ -298,6 +2477,283 @@ class Quotes(callbacks.Plugin):
     quoteinfo = wrap(quoteinfo,
                      [getopts({'channel': 'somethingWithoutSpaces'}), 'int'])
 
+    def importquotes(self, irc, msg, args, optlist, filename):
+        """[--channel <#channel>] [--format text|json|csv|sqlite|quote] <file>
+        Imports the quotes of <file>, relative to the data directory. The
+        format is guessed from the extension if --format is not given: text
+        files hold one quote per line, JSON files one object with text, nick
+        and ts keys per line, CSV files have a text,nick,ts header, SQLite
+        files are QuoteGrabs or Quotes databases and .flat.db files are
+        databases of the Quote plugin. If --channel is supplied the quotes
+        are stored in that channel database."""
+        self._checkWritable(irc)
+        channel = msg.args[0]
+        fmt = None
+        for (option, arg) in optlist:
+            if option == 'channel':
+                if not ircutils.isChannel(arg):
+                    irc.error(format(_('%s is not a valid channel.'), arg),
+                              Raise=True)
+                channel = arg
+            elif option == 'format':
+                fmt = arg
+
+        filename = self._dataFilename(irc, filename)
+        if fmt is None:
+            fmt = guessFormat(filename)
+
+        start = time.time()
+        try:
+            count = self.db.importQuotes(channel, readQuotes(
+                filename, fmt, msg.nick, int(time.time())))
+        except (IOError, OSError, ValueError, KeyError, TypeError,
+                csv.Error, sqlite3.Error) as e:
+            irc.error(format(_("Could not import %s: %s"), filename, e),
+                      Raise=True)
+        elapsed = max(time.time() - start, 0.001)
+        irc.reply(format(_("Imported %n into %s in %.1f seconds (%s "
+                           "quotes/s)."), (count, 'quote'), channel, elapsed,
+                         int(count / elapsed)))
+
+    importquotes = thread(wrap(importquotes,
+                               ['admin',
+                                getopts({'channel': 'somethingWithoutSpaces',
+                                         'format': ('literal',
+                                                    ('text', 'json', 'csv',
+                                                     'sqlite', 'quote'))}),
+                                'something']))
+
+    def exportquotes(self, irc, msg, args, optlist, filename):
+        """[--channel <#channel>] [--format text|json|csv] <file>
+        Exports the quotes to <file>, relative to the data directory. The
+        format is guessed from the extension if --format is not given, see
+        importquotes. If --channel is supplied the quotes are read from that
+        channel database."""
+        channel = msg.args[0]
+        fmt = None
+        for (option, arg) in optlist:
+            if option == 'channel':
+                if not ircutils.isChannel(arg):
+                    irc.error(format(_('%s is not a valid channel.'), arg),
+                              Raise=True)
+                channel = arg
+            elif option == 'format':
+                fmt = arg
+
+        filename = self._dataFilename(irc, filename)
+        if fmt is None:
+            fmt = guessFormat(filename)
+        if fmt in ('sqlite', 'quote'):
+            irc.error(_("Quotes can only be exported to text, JSON or CSV "
+                        "files, copy the channel database instead."),
+                      Raise=True)
+
+        start = time.time()
+        try:
+            count = writeQuotes(filename, fmt, self.db.iterQuotes(channel))
+        except (IOError, OSError, sqlite3.Error) as e:
+            irc.error(format(_("Could not export %s: %s"), filename, e),
+                      Raise=True)
+        elapsed = max(time.time() - start, 0.001)
+        irc.reply(format(_("Exported %n from %s in %.1f seconds (%s "
+                           "quotes/s)."), (count, 'quote'), channel, elapsed,
+                         int(count / elapsed)))
+
+    exportquotes = thread(wrap(exportquotes,
+                               ['admin',
+                                getopts({'channel': 'somethingWithoutSpaces',
+                                         'format': ('literal',
+                                                    ('text', 'json',
+                                                     'csv'))}),
+                                'something']))
+
+    def mergequotes(self, irc, msg, args):
+        """takes no arguments
+        Copies the quotes of the per-channel sqlite3 databases in the single
+        sqlite3single database, keeping their ids. Quotes whose id is already
+        used in the channel are skipped, so it can be run again safely."""
+        self._checkWritable(irc)
+        if not self.db.consolidated:
+            irc.error(_("The sqlite3single database is not in use, add it "
+                        "before sqlite3 in supybot.databases and reload the "
+                        "plugin."), Raise=True)
+        start = time.time()
+        merged = self.db.mergeChannelDbs()
+        found = sum(f for (f, m) in merged.values())
+        count = sum(m for (f, m) in merged.values())
+        irc.reply(format(_("Merged %n from %n in %.1f seconds, %s already "
+                           "present."), (count, 'quote'),
+                         (len(merged), 'channel database'),
+                         time.time() - start, found - count))
+
+    mergequotes = thread(wrap(mergequotes, ['admin']))
+
+    def dedupequotes(self, irc, msg, args, optlist):
+        """[--channel <#channel>]
+        Deletes the quotes with the same text as an older one, ignoring
+        case, whitespace and a leading timestamp. If --channel is supplied
+        the quotes are deleted from that channel database."""
+        self._checkWritable(irc)
+        channel = msg.args[0]
+        for (option, arg) in optlist:
+            if option == 'channel':
+                if not ircutils.isChannel(arg):
+                    irc.error(format(_('%s is not a valid channel.'), arg),
+                              Raise=True)
+                channel = arg
+
+        start = time.time()
+        try:
+            count = self.db.dedupeQuotes(channel)
+        except sqlite3.Error as e:
+            irc.error(format(_("Could not dedupe %s: %s"), channel, e),
+                      Raise=True)
+        irc.reply(format(_("Deleted %n from %s in %.1f seconds."),
+                         (count, 'duplicate quote'), channel,
+                         time.time() - start))
+
+    dedupequotes = thread(wrap(dedupequotes,
+                               ['admin',
+                                getopts({'channel':
+                                         'somethingWithoutSpaces'})]))
+
+    def compressquotes(self, irc, msg, args, optlist):
+        """[--channel <#channel>]
+        Rewrites the quotes so that those of at least
+        supybot.plugins.Quotes.compressThreshold characters are stored
+        compressed and the others as text. If --channel is supplied the
+        quotes of that channel database are rewritten. Run maintain
+        afterwards to give the freed space back."""
+        self._checkWritable(irc)
+        channel = msg.args[0]
+        for (option, arg) in optlist:
+            if option == 'channel':
+                if not ircutils.isChannel(arg):
+                    irc.error(format(_('%s is not a valid channel.'), arg),
+                              Raise=True)
+                channel = arg
+
+        start = time.time()
+        try:
+            (count, before, after) = self.db.compressQuotes(channel)
+        except sqlite3.Error as e:
+            irc.error(format(_("Could not compress %s: %s"), channel, e),
+                      Raise=True)
+        irc.reply(format(_("Rewrote %n of %s in %.1f seconds, their texts "
+                           "now take %.1f KiB instead of %.1f KiB."),
+                         (count, 'quote'), channel, time.time() - start,
+                         after / 1024.0, before / 1024.0))
+
+    compressquotes = thread(wrap(compressquotes,
+                                 ['admin',
+                                  getopts({'channel':
+                                           'somethingWithoutSpaces'})]))
+
+    def maintain(self, irc, msg, args, optlist):
+        """[--channel <#channel>]
+        Merges the full-text index segments, gives the free pages back to the
+        file system and checks the integrity of the databases changed since
+        their last maintenance, or of the database of --channel. This is
+        also done every supybot.plugins.Quotes.maintenanceInterval seconds."""
+        channel = None
+        for (option, arg) in optlist:
+            if option == 'channel':
+                if not ircutils.isChannel(arg):
+                    irc.error(format(_('%s is not a valid channel.'), arg),
+                              Raise=True)
+                channel = arg
+
+        start = time.time()
+        try:
+            results = self._maintain(channel)
+        except sqlite3.Error as e:
+            irc.error(format(_("Maintenance failed: %s"), e), Raise=True)
+        if results is None:
+            irc.error(_("The maintenance is already running."), Raise=True)
+        problems = sum(len(r['problems']) for r in results.values())
+        irc.reply(format(_("Maintained %n in %.1f seconds, %n freed, %n "
+                           "found."), (len(results), 'database'),
+                         time.time() - start,
+                         (sum(r['freed'] for r in results.values()), 'page'),
+                         (problems, 'problem')))
+
+    maintain = thread(wrap(maintain,
+                           ['admin',
+                            getopts({'channel': 'somethingWithoutSpaces'})]))
+
+    def snapshot(self, irc, msg, args):
+        """takes no arguments
+        Publishes the snapshots of the databases changed since their last
+        one in supybot.plugins.Quotes.snapshotDirectory, where replicas read
+        them. This is also done every
+        supybot.plugins.Quotes.snapshotInterval seconds."""
+        self._checkWritable(irc)
+        if not self.db.snapshots:
+            irc.error(_("Snapshots need Python 3.7 or newer."), Raise=True)
+        start = time.time()
+        try:
+            published = self._publishSnapshots()
+        except (IOError, OSError, sqlite3.Error) as e:
+            irc.error(format(_("Could not publish the snapshots: %s"), e),
+                      Raise=True)
+        if published is None:
+            irc.error(_("The snapshots are already being published."),
+                      Raise=True)
+        irc.reply(format(_("Published %n in %.1f seconds."),
+                         (len(published), 'snapshot'), time.time() - start))
+
+    snapshot = thread(wrap(snapshot, ['admin']))
+
+    def snapshotinfo(self, irc, msg, args):
+        """takes no arguments
+        Shows the number of snapshots of the databases, the age of the
+        oldest and the newest one and how many were published or, by a
+        replica, refreshed."""
+        (count, oldest, newest) = self.db.snapshotInfo()
+        if self.db.replica:
+            role = format(_("replica, %n refreshed"),
+                          (self.db.refreshed, 'snapshot'))
+        else:
+            role = format(_("%n published"), (self.db.published, 'snapshot'))
+        if not count:
+            irc.reply(format(_("No snapshot yet (%s)."), role))
+        else:
+            irc.reply(format(_("%n, the newest %n old and the oldest %n old "
+                               "(%s)."), (count, 'snapshot'),
+                             (int(newest), 'second'), (int(oldest), 'second'),
+                             role))
+
+    snapshotinfo = wrap(snapshotinfo, ['admin'])
+
+    def dbstats(self, irc, msg, args):
+        """takes no arguments
+        Shows the number of channel databases open, their idle reader
+        connections and how many were opened and closed for being the least
+        recently used or idle."""
+        stats = self.db.stats()
+        irc.reply(format(_("%s/%s databases open (%s in use, %n) - %s "
+                           "opened, %s evicted, %s closed idle"),
+                         stats['open'],
+                         conf.supybot.plugins.Quotes.maxOpen(),
+                         stats['busy'], (stats['readers'], 'idle reader'),
+                         stats['opened'], stats['evicted'],
+                         stats['expired']))
+
+    dbstats = wrap(dbstats, ['admin'])
+
+    def quotecachestats(self, irc, msg, args):
+        """takes no arguments
+        Shows the quote cache usage and its hit/miss/eviction counters."""
+        c = self.db.cache
+        lookups = c.hits + c.misses
+        irc.reply(format(_("%s/%s quotes cached - %s hits / %s misses "
+                           "(%.1f%% hit ratio) - %s evictions"),
+                         len(c), c.size, c.hits, c.misses,
+                         (100.0 * c.hits / lookups) if lookups else 0.0,
+                         c.evictions))
+
+    quotecachestats = wrap(quotecachestats, ['admin'])
+
 Class = Quotes
 
 
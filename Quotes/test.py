@@ -28,11 +28,1029 @@
 
 ###
 
+import io
+import os
+import json
+import time
+import shutil
+import sqlite3
+import threading
+
 from supybot.test import *
 
+import supybot.plugins as plugins
+
+from . import benchmark
+from .plugin import SqliteQuotesDB, SingleSqliteQuotesDB, parseDate
+
+
+def fillQuotes(db, channel, size):
+    """Inserts size synthetic quotes in channel's database."""
+    db.importQuotes(channel, (('<nick%s> synthetic quote number %s about %s' %
+                               (i % 97, i, ('irc', 'bots', 'python')[i % 3]),
+                               'nick%s' % (i % 97), 1400000000 + i * 60)
+                              for i in range(size)))
+
+
+def makeLegacyDb(db, channel, size):
+    """Creates channel's database with the version 1 schema, a single FTS4
+    table, holding size synthetic quotes."""
+    return benchmark.makeLegacyDb(
+        plugins.makeChannelFilename(db.filename, channel),
+        (('<nick%s> synthetic quote number %s about %s' %
+          (i % 97, i, ('irc', 'bots', 'python')[i % 3]),
+          'nick%s' % (i % 97), 1400000000 + i * 60) for i in range(size)))
+
+
+class QuotesDBTestCase(SupyTestCase):
+    channel = '#dbtest'
+    dbClass = SqliteQuotesDB
+
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize(
+            'QuotesTest.sqlite3.db')
+        self.db = self.dbClass(self.filename)
+
+    def tearDown(self):
+        self.db.close()
+        # Channel databases of these tests are in #db* directories and
+        # single ones in QuotesTest.* files.
+        data = conf.supybot.directories.data()
+        for name in os.listdir(data):
+            if name.startswith('#db'):
+                shutil.rmtree(os.path.join(data, name))
+            elif name.startswith('QuotesTest.'):
+                os.remove(os.path.join(data, name))
+        SupyTestCase.tearDown(self)
+
+    def _openDb(self, channel):
+        db = self.db._open(channel)
+        self.db._release(db)
+        return db
+
+
+class QuotesDBTests(object):
+    """Tests of the database API shared by all the backends."""
+    def testInsertGet(self):
+        qid = self.db.insertQuote(self.channel, 'foo bar', 'nick', 1234)
+        self.assertEqual(self.db.getQuoteById(self.channel, qid),
+                         (qid, 'foo bar', 'nick', 1234))
+        self.assertEqual(self.db.getQuoteLast(self.channel)[0], qid)
+        self.db.delQuoteById(self.channel, qid)
+        self.assertEqual(self.db.getQuoteById(self.channel, qid), None)
+
+    def testRandomEmpty(self):
+        self.assertEqual(self.db.getQuoteRandom(self.channel), None)
+
+    def testRandomGaps(self):
+        ids = [self.db.insertQuote(self.channel, 'quote %s' % i, 'nick', i)
+               for i in range(20)]
+        for qid in ids[1:-1]:
+            if qid % 4:
+                self.db.delQuoteById(self.channel, qid)
+        left = set(qid for qid in ids if not (qid % 4) or
+                   qid in (ids[0], ids[-1]))
+        seen = set(self.db.getQuoteRandom(self.channel)[0]
+                   for i in range(300))
+        self.assertEqual(seen, left)
+
+    def _testSearch(self):
+        for text in ('Hello world', 'hello there', 'Goodbye world',
+                     'unrelated'):
+            self.db.insertQuote(self.channel, text, 'nick', 0)
+        self.assertEqual(self.db.searchQuote(self.channel, 'hello'),
+                         ['1', '2'])
+        self.assertEqual(self.db.searchQuote(self.channel, 'world hel'),
+                         ['1'])
+        self.assertEqual(self.db.searchQuote(self.channel, 'wor'),
+                         ['1', '3'])
+        self.assertEqual(self.db.searchQuote(self.channel, '"OR*'), [])
+        self.assertEqual(self.db.searchQuote(self.channel, '*'), [])
+        self.db.delQuoteById(self.channel, 1)
+        self.assertEqual(self.db.searchQuote(self.channel, 'hello'), ['2'])
+
+    def testSearch(self):
+        self._testSearch()
+
+    def testSearchFts4(self):
+        self.db.fts5 = False
+        self._testSearch()
+        self.assertEqual(self._openDb(self.channel).ftsKind, 'fts4')
+
+    def _testSearchRanked(self):
+        for text in ('python is a snake and a language',
+                     'unrelated quote',
+                     'python python python',
+                     'I like python'):
+            self.db.insertQuote(self.channel, text, 'nick', 0)
+        (total, results) = self.db.searchQuotes(self.channel, 'python', 2)
+        self.assertEqual(total, 3)
+        self.assertEqual([r[0] for r in results], [3, 4])
+        self.assertEqual(results[0][1],
+                         '\x02python\x02 \x02python\x02 \x02python\x02')
+        (total, results) = self.db.searchQuotes(self.channel, 'python', 2, 2)
+        self.assertEqual(total, 3)
+        self.assertEqual([r[0] for r in results], [1])
+        self.assertEqual(self.db.searchQuotes(self.channel, 'python', 2, 4),
+                         (3, []))
+        self.assertEqual(self.db.searchQuotes(self.channel, 'perl', 2),
+                         (0, []))
+
+    def testSearchRanked(self):
+        self._testSearchRanked()
+
+    def testSearchRankedFts4(self):
+        self.db.fts5 = False
+        self._testSearchRanked()
+
+    def _testImport(self):
+        self.db.insertQuote(self.channel, 'existing quote', 'nick', 0)
+        self.assertEqual(self.db.importQuotes(self.channel, (
+            ('imported quote %s' % i, 'nick%s' % i, i) for i in range(10))),
+            10)
+        self.assertEqual(self.db.getQuoteById(self.channel, 11),
+                         (11, 'imported quote 9', 'nick9', 9))
+        self.assertEqual(len(self.db.searchQuote(self.channel, 'quote')), 11)
+        self.assertEqual(self.db.searchQuote(self.channel, 'imported 3'),
+                         ['5'])
+        self.db.insertQuote(self.channel, 'later quote', 'nick', 0)
+        self.assertEqual(self.db.searchQuote(self.channel, 'later'), ['12'])
+        self.assertEqual(list(self.db.iterQuotes(self.channel))[-1],
+                         (12, 'later quote', 'nick', 0))
+
+    def testImport(self):
+        self._testImport()
+
+    def testImportFts4(self):
+        self.db.fts5 = False
+        self._testImport()
+
+    def testImportRollback(self):
+        def quotes():
+            yield ('first', 'nick', 0)
+            raise ValueError('broken file')
+        self.assertRaises(ValueError, self.db.importQuotes, self.channel,
+                          quotes())
+        self.assertEqual(self.db.getQuoteLast(self.channel), None)
+        self.db.insertQuote(self.channel, 'after rollback', 'nick', 0)
+        self.assertEqual(self.db.searchQuote(self.channel, 'rollback'),
+                         ['1'])
+
+    def testWriteErrors(self):
+        def fail(cur):
+            cur.execute("""DELETE FROM quotes""")
+            raise ValueError('failed write')
+        self.assertEqual(self.db.insertQuote(self.channel, 'kept', 'nick', 0),
+                         1)
+        qfile = self._openDb(self.channel)
+        self.assertRaises(ValueError, qfile.write, fail)
+        self.assertEqual(self.db.getQuoteLast(self.channel)[1], 'kept')
+        self.assertEqual(self.db.insertQuote(self.channel, 'kept', 'nick', 0),
+                         2)
+        self.assertEqual(self.db.searchQuote(self.channel, 'kept'),
+                         ['1', '2'])
+
+    def testStress(self):
+        threads = 16
+        adds = 50
+        ids = []
+        errors = []
+
+        def work(n):
+            try:
+                for i in range(adds):
+                    ids.append(self.db.insertQuote(
+                        self.channel, 'stress quote %s by %s' % (i, n),
+                        'nick%s' % n, i))
+                    q = self.db.getQuoteRandom(self.channel)
+                    assert q is not None
+                    self.db.searchQuote(self.channel, 'stress')
+            except Exception as e:
+                errors.append(e)
+
+        start = time.time()
+        L = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+        for t in L:
+            t.start()
+        for t in L:
+            t.join()
+        elapsed = time.time() - start
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(ids), list(range(1, threads * adds + 1)))
+        self.assertEqual(len(self.db.searchQuote(self.channel, 'stress')),
+                         threads * adds)
+        qfile = self._openDb(self.channel)
+        self.assertEqual(qfile.writes, threads * adds)
+        print('\nStress: %s threads added %s quotes in %.2f s with %s '
+              'commits' % (threads, threads * adds, elapsed, qfile.batches))
+
+    def testCache(self):
+        qid = self.db.insertQuote(self.channel, 'cached', 'nick', 1)
+        cache = self.db.cache
+        self.assertEqual(self.db.getQuoteById(self.channel, qid),
+                         (qid, 'cached', 'nick', 1))
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(self.db.getQuoteLast(self.channel)[0], qid)
+        self.assertEqual(self.db.getQuoteLast(self.channel.upper())[0], qid)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+        # Reading cached quotes doesn't touch the database.
+        qfile = self._openDb(self.channel)
+        qfile.writer.execute("""UPDATE quotes SET text = 'changed'""")
+        self.assertEqual(self.db.getQuoteById(self.channel, qid)[1], 'cached')
+        self.assertEqual(self.db.getQuoteLast(self.channel)[1], 'cached')
+
+        other = self.db.insertQuote(self.channel, 'other', 'nick', 2)
+        self.assertEqual(self.db.getQuoteLast(self.channel)[0], other)
+        self.db.delQuoteById(self.channel, other)
+        self.assertEqual(self.db.getQuoteById(self.channel, other), None)
+        self.assertEqual(self.db.getQuoteLast(self.channel),
+                         (qid, 'changed', 'nick', 1))
+        self.db.importQuotes(self.channel, [('imported', 'nick', 3)])
+        self.assertEqual(self.db.getQuoteLast(self.channel)[1], 'imported')
+
+        with conf.supybot.plugins.Quotes.quoteCacheSize.context(0):
+            self.db.getQuoteById(self.channel, qid)
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(self.db.getQuoteById(self.channel, qid)[1],
+                             'changed')
+
+    def testMaintain(self):
+        self.assertEqual(self.db.maintain(), {})
+        fillQuotes(self.db, self.channel, 500)
+        for qid in range(1, 400):
+            self.db.delQuoteById(self.channel, qid)
+        filename = self._openDb(self.channel).filename
+        self.assertEqual(self.db.maintain(idle=60), {})
+        results = self.db.maintain()
+        self.assertEqual(list(results), [filename])
+        self.assertTrue(results[filename]['freed'] > 0)
+        self.assertEqual(results[filename]['problems'], [])
+        self.assertEqual(self.db.maintain(), {})
+        self.assertEqual(len(self.db.searchQuote(self.channel, 'synthetic')),
+                         101)
+        self.assertEqual(list(self.db.maintain(self.channel)), [filename])
+
+    def testFuzzySearch(self):
+        if not self.dbClass.trigram:
+            return
+        for text in ('the netsplit happened again', 'coffee before deploy',
+                     'unrelated words here', 'Netsplits everywhere'):
+            self.db.insertQuote(self.channel, text, 'nick', 0)
+        self.db.importQuotes(self.channel, [('imported deployment', 'nick',
+                                             0)])
+        search = lambda text: [r[0] for r in self.db.fuzzySearchQuotes(
+            self.channel, text, 10)[1]]
+        self.assertEqual(sorted(search('netslpit')), [1, 4])
+        self.assertEqual(sorted(search('SPLIT')), [1, 4])
+        self.assertEqual(search('cofee'), [2])
+        self.assertEqual(search('deploy'), [2, 5])
+        self.assertEqual(search('zzzqqq'), [])
+        self.assertEqual(self.db.fuzzySearchQuotes(self.channel, 'e', 10),
+                         (0, []))
+        (total, results) = self.db.fuzzySearchQuotes(self.channel,
+                                                     'netsplit', 1, 1)
+        self.assertEqual((total, len(results)), (2, 1))
+        with conf.supybot.plugins.Quotes.fuzzyBudget.context(1):
+            # Only the trigrams found in a single quote are read.
+            self.assertEqual(search('netsplit'), [1])
+            # All of them are too common, the newest quotes containing the
+            # word are taken instead.
+            self.assertEqual(search('tspli'), [4, 1])
+        self.db.delQuoteById(self.channel, 1)
+        self.assertEqual(search('netsplit'), [4])
+
+    def testDuplicates(self):
+        self.assertEqual(self.db.addQuote(self.channel, '<foo> hello world',
+                                          'nick', 0), (1, True))
+        for text in ('<FOO>  hello world ', '[12:34] <foo> hello world',
+                     '2014-01-01 12:34:56 <foo>\thello world'):
+            self.assertEqual(self.db.addQuote(self.channel, text, 'nick', 0),
+                             (1, False))
+        self.assertEqual(self.db.addQuote(self.channel, '12:34', 'nick', 0),
+                         (2, True))
+        self.assertEqual(self.db.addQuote('#dbother', '<foo> hello world',
+                                          'nick', 0), (1, True))
+        self.assertEqual(self.db.insertQuote(self.channel, '<foo> hello world',
+                                             'nick', 0), 3)
+        self.db.importQuotes(self.channel, [('<foo> hello world', 'nick', 0),
+                                            ('12:34', 'nick', 0),
+                                            ('new', 'nick', 0)])
+        self.assertEqual(self.db.dedupeQuotes(self.channel), 3)
+        self.assertEqual([q[0] for q in self.db.iterQuotes(self.channel)],
+                         [1, 2, 6])
+        self.assertEqual(self.db.getQuoteById(self.channel, 3), None)
+        self.assertEqual(self.db.searchQuote(self.channel, 'hello'), ['1'])
+        self.assertEqual(self.db.dedupeQuotes(self.channel), 0)
+        self.assertEqual(len(list(self.db.iterQuotes('#dbother'))), 1)
+        self.assertEqual(self.db.dedupeQuotes('#dbnowhere'), 0)
+
+    def testHashMigrate(self):
+        for text in ('Same quote', 'same  quote', 'other'):
+            self.db.insertQuote(self.channel, text, 'nick', 0)
+        conn = self._openDb(self.channel).writer
+        conn.execute("""UPDATE quotes SET hash = NULL""")
+        # The last version without content hashes.
+        conn.execute("""PRAGMA user_version = %d""" %
+                     (3 if self.dbClass.consolidated else 4))
+        self.db.close()
+        self.db = self.dbClass(self.db.filename)
+        self.assertEqual(self.db.addQuote(self.channel, 'SAME QUOTE', 'nick',
+                                          0), (1, False))
+        self.assertEqual(self.db.dedupeQuotes(self.channel), 1)
+        self.assertEqual(self.db.searchQuote(self.channel, 'quote'), ['1'])
+
+    def testCompress(self):
+        if not self.dbClass.fts5:
+            return
+        text = ' '.join('word%s' % (i % 20) for i in range(200))
+        threshold = conf.supybot.plugins.Quotes.compressThreshold
+        with threshold.context(100):
+            self.db.insertQuote(self.channel, text + ' netsplit', 'nick', 1234)
+            self.db.insertQuote(self.channel, 'short netsplit', 'nick', 0)
+            self.db.importQuotes(self.channel, [(text + ' imported netsplit',
+                                                 'nick', 0)])
+        conn = self._openDb(self.channel).writer
+        types = lambda: [r[0] for r in conn.execute("""SELECT typeof(text)
+        FROM quotes ORDER BY id""")]
+        self.assertEqual(types(), ['blob', 'text', 'blob'])
+        self.assertEqual(self.db.getQuoteById(self.channel, 1),
+                         (1, text + ' netsplit', 'nick', 1234))
+        self.assertEqual(self.db.getQuoteLast(self.channel)[1],
+                         text + ' imported netsplit')
+        self.assertTrue(self.db.getQuoteRandom(self.channel)[1] in
+                        (text + ' netsplit', 'short netsplit',
+                         text + ' imported netsplit'))
+        self.assertEqual(sorted(self.db.searchQuote(self.channel,
+                                                    'imported')), ['3'])
+        (total, results) = self.db.searchQuotes(self.channel, 'netsplit', 3)
+        self.assertEqual(total, 3)
+        self.assertTrue(all('\x02netsplit\x02' in r[1] for r in results))
+        if self.dbClass.trigram:
+            self.assertEqual(sorted(r[0] for r in self.db.fuzzySearchQuotes(
+                self.channel, 'imprted', 10)[1]), [3])
+        self.assertEqual([q[1] for q in self.db.iterQuotes(self.channel)],
+                         [text + ' netsplit', 'short netsplit',
+                          text + ' imported netsplit'])
+        self.assertEqual(self.db.addQuote(self.channel, text + ' NETSPLIT',
+                                          'nick', 0), (1, False))
+
+        # Without a threshold the quotes are stored uncompressed again.
+        (count, before, after) = self.db.compressQuotes(self.channel)
+        self.assertEqual(count, 2)
+        self.assertTrue(after > before)
+        self.assertEqual(types(), ['text', 'text', 'text'])
+        with threshold.context(100):
+            self.assertEqual(self.db.compressQuotes(self.channel)[:1], (2,))
+            self.assertEqual(types(), ['blob', 'text', 'blob'])
+            size = self.db.compressQuotes(self.channel)[2]
+            self.assertEqual(self.db.compressQuotes(self.channel),
+                             (0, size, size))
+        self.assertEqual(sorted(self.db.searchQuote(self.channel,
+                                                    'netsplit')),
+                         ['1', '2', '3'])
+        self.db.delQuoteById(self.channel, 1)
+        self.assertEqual(sorted(self.db.searchQuote(self.channel,
+                                                    'netsplit')), ['2', '3'])
+        self.assertEqual(self.db.compressQuotes('#dbnowhere'), (0, 0, 0))
+
+    def testCompressLayout(self):
+        self.db.insertQuote(self.channel, 'old quote ' * 50, 'nick', 0)
+        filename = self._openDb(self.channel).filename
+        if self.dbClass.consolidated:
+            sql = """INSERT INTO quotes (channel, qid, text, nick, ts)
+            VALUES ('%s', ?, ?, 'other', 0)""" % self.channel
+        else:
+            sql = """INSERT INTO quotes (id, text, nick, ts)
+            VALUES (?, ?, 'other', 0)"""
+        # Until quotes are compressed, other tools can write the quotes
+        # without the plugin's SQL functions.
+        conn = sqlite3.connect(filename)
+        try:
+            conn.execute(sql, (2, 'external quote'))
+            conn.commit()
+            self.assertEqual(sorted(self.db.searchQuote(self.channel,
+                                                        'quote')), ['1', '2'])
+            if not self.dbClass.fts5:
+                return
+            with conf.supybot.plugins.Quotes.compressThreshold.context(100):
+                self.assertEqual(self.db.compressQuotes(self.channel)[0], 1)
+                self.db.insertQuote(self.channel, 'new quote ' * 50, 'nick',
+                                    0)
+            self.assertEqual(sorted(self.db.searchQuote(self.channel,
+                                                        'quote')),
+                             ['1', '2', '3'])
+            if self.dbClass.trigram:
+                self.assertEqual([r[0] for r in self.db.fuzzySearchQuotes(
+                    self.channel, 'extrnal', 10)[1]], [2])
+            # Now the indexes read the texts with quotetext().
+            self.assertRaises(sqlite3.OperationalError, conn.execute, sql,
+                              (4, 'another quote'))
+        finally:
+            conn.close()
+
+    def testSnapshots(self):
+        if not self.dbClass.snapshots:
+            return
+        config = conf.supybot.plugins.Quotes
+        # Removed by tearDown like the channel databases.
+        with config.snapshotDirectory.context('#dbsnapshots'):
+            for channel in ('#dbone', '#dbtwo'):
+                self.db.insertQuote(channel, 'first of %s' % channel, 'nick',
+                                    1)
+            self.assertEqual(self.db.snapshotInfo(), (0, None, None))
+            self.assertEqual(len(self.db.publishSnapshots()),
+                             1 if self.dbClass.consolidated else 2)
+            self.assertEqual(self.db.publishSnapshots(), [])
+            with config.replica.context(True):
+                replica = self.dbClass(self.db.filename)
+            try:
+                self.assertEqual(replica.getQuoteLast('#dbone'),
+                                 (1, 'first of #dbone', 'nick', 1))
+                self.assertEqual(replica.searchQuote('#dbtwo', 'first'),
+                                 ['1'])
+                self.assertEqual(replica.getQuoteRandom('#dbnowhere'), None)
+                self.assertRaises(sqlite3.OperationalError,
+                                  replica.insertQuote, '#dbone', 'quote',
+                                  'nick', 2)
+                self.assertEqual(replica.maintain(), {})
+
+                self.db.insertQuote('#dbone', 'second', 'nick', 2)
+                self.assertEqual(replica.refreshSnapshots(), 0)
+                self.assertEqual(replica.getQuoteLast('#dbone')[1],
+                                 'first of #dbone')
+                published = self.db.publishSnapshots()
+                self.assertEqual(len(published), 1)
+                self.assertFalse(os.path.exists(published[0] + '-wal'))
+                self.assertEqual(replica.refreshSnapshots(), 1)
+                self.assertEqual(replica.getQuoteLast('#dbone')[1], 'second')
+                (count, oldest, newest) = replica.snapshotInfo()
+                self.assertEqual(count, 1 if self.dbClass.consolidated
+                                 else 2)
+                self.assertTrue(0 <= newest <= oldest)
+                self.assertEqual((replica.refreshed, self.db.published),
+                                 (1, 2 if self.dbClass.consolidated else 3))
+            finally:
+                replica.close()
+
+    def testQuotesByNick(self):
+        for (i, nick) in enumerate(('alice', 'bob', 'Alice', 'alice')):
+            self.db.insertQuote(self.channel, 'quote %s' % i, nick, i)
+        self.assertEqual(self.db.getQuotesByNick(self.channel, 'ALICE', 2),
+                         (3, [(4, 'quote 3', 3), (3, 'quote 2', 2)]))
+        self.assertEqual(self.db.getQuotesByNick(self.channel, 'alice', 2, 2),
+                         (3, [(1, 'quote 0', 0)]))
+        self.assertEqual(self.db.getQuotesByNick(self.channel, 'alice', 2, 4),
+                         (3, []))
+        self.db.delQuoteById(self.channel, 4)
+        self.assertEqual(self.db.getQuotesByNick(self.channel, 'alice', 5)[0],
+                         2)
+        self.assertEqual(self.db.getQuotesByNick(self.channel, 'carol', 5),
+                         (0, []))
+
+    def testQuotesBetween(self):
+        self.assertEqual(parseDate('2020'), 1577836800)
+        self.assertEqual(parseDate('2020-12', end=True), parseDate('2021'))
+        self.assertEqual(parseDate('2020-02-28', end=True),
+                         parseDate('2020-02-29'))
+        self.assertRaises(ValueError, parseDate, 'soon')
+
+        for date in ('2020-01-01', '2020-01-31', '2020-02-01', '2021-06-15'):
+            self.db.insertQuote(self.channel, date, 'nick', parseDate(date))
+        jan = parseDate('2020-01')
+        feb = parseDate('2020-02')
+        self.assertEqual(self.db.getQuotesBetween(self.channel, jan, feb, 5),
+                         (2, [(1, '2020-01-01', 'nick', jan),
+                              (2, '2020-01-31', 'nick', feb - 86400)]))
+        self.assertEqual(self.db.getQuotesBetween(self.channel, feb, None, 1,
+                                                  1)[1][0][1], '2021-06-15')
+        self.assertEqual(self.db.getQuotesBetween(self.channel, None, jan, 5),
+                         (0, []))
+        self.assertEqual(self.db.getQuotesBetween(self.channel, None, None,
+                                                  5)[0], 4)
+
+    def testQuoteStats(self):
+        for (i, nick) in enumerate(('alice', 'bob', 'Alice', 'carol')):
+            self.db.insertQuote(self.channel, 'quote %s' % i, nick,
+                                parseDate('2020-0%s' % (i % 2 + 1)))
+        self.db.importQuotes(self.channel,
+                             [('imported', 'bob', parseDate('2020-03')),
+                              ('imported', 'BOB', parseDate('2020-03'))])
+        self.db.delQuoteById(self.channel, 4)
+        self.assertEqual(self.db.getQuoteStats(self.channel, 2, 2),
+                         (5, [('bob', 3), ('alice', 2)],
+                          [('2020-03', 2), ('2020-02', 1)]))
+        self.assertEqual(self.db.getQuoteStats(self.channel, 5, 5)[2],
+                         [('2020-03', 2), ('2020-02', 1), ('2020-01', 2)])
+        self.db.insertQuote(self.channel.upper(), 'other', 'dave', 0)
+
+        # The counts kept by the triggers match the quotes.
+        counts = {}
+        for (qid, text, nick, ts) in self.db.iterQuotes(self.channel):
+            counts[nick.lower()] = counts.get(nick.lower(), 0) + 1
+        (total, nicks, months) = self.db.getQuoteStats(self.channel, 10, 10)
+        self.assertEqual(total, sum(counts.values()))
+        self.assertEqual(dict((n.lower(), c) for (n, c) in nicks), counts)
 
-class QuotesTestCase(PluginTestCase):
+    def testStatsMigrate(self):
+        fillQuotes(self.db, self.channel, 300)
+        conn = self._openDb(self.channel).writer
+        conn.execute("""DROP TABLE quotes_stats""")
+        for trigger in ('quotes_stats_ai', 'quotes_stats_ad',
+                        'quotes_stats_au'):
+            conn.execute("""DROP TRIGGER %s""" % trigger)
+        # The last version without quote counts.
+        conn.execute("""PRAGMA user_version = %d""" %
+                     (1 if self.dbClass.consolidated else 2))
+        self.db.close()
+        self.db = self.dbClass(self.db.filename)
+        (total, nicks, months) = self.db.getQuoteStats(self.channel, 1, 1)
+        self.assertEqual(total, 300)
+        self.assertEqual(nicks, [('nick0', 4)])
+        self.db.insertQuote(self.channel, 'new', 'nick0', 0)
+        self.assertEqual(self.db.getQuotesByNick(self.channel, 'nick0', 1)[0],
+                         5)
+
+    def testReadOnlyPaths(self):
+        channel = '#dbnowhere'
+        self.assertEqual(self.db.getQuoteById(channel, 1), None)
+        self.assertEqual(self.db.getQuoteRandom(channel), None)
+        self.assertEqual(self.db.getQuoteLast(channel), None)
+        self.assertEqual(self.db.searchQuote(channel, 'foo'), [])
+        self.assertEqual(self.db.searchQuotes(channel, 'foo', 5), (0, []))
+        self.assertEqual(list(self.db.iterQuotes(channel)), [])
+        self.assertEqual(self.db.getQuotesByNick(channel, 'nick', 5), (0, []))
+        self.assertEqual(self.db.getQuotesBetween(channel, 0, None, 5),
+                         (0, []))
+        self.assertEqual(self.db.getQuoteStats(channel, 5, 5), (0, [], []))
+        self.assertFalse(os.path.exists(
+            conf.supybot.directories.data.dirize(channel)))
+        self.assertEqual(self.db.stats()['opened'], 0)
+
+
+class SqliteQuotesDBTestCase(QuotesDBTestCase, QuotesDBTests):
+    def testSchema(self):
+        conn = self._openDb(self.channel).writer
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0],
+                         SqliteQuotesDB.schemaVersion)
+        self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0],
+                         'wal')
+        self.assertEqual(self._openDb(self.channel).ftsKind,
+                         SqliteQuotesDB.fts5 and 'fts5' or 'fts4')
+        tables = dict(conn.execute("""SELECT name, sql FROM sqlite_master
+        WHERE type = 'table'"""))
+        self.assertTrue('prefix' in tables['quotes_fts'])
+        self.assertEqual('quotes_trigram' in tables, SqliteQuotesDB.trigram)
+
+    def testMigrate(self):
+        legacy = makeLegacyDb(self.db, self.channel, 0)
+        for (text, ts) in (('first quote', 1), ('second one', 2),
+                           ('third quote', 3)):
+            legacy.execute("""INSERT INTO quotes (text, nick, ts)
+            VALUES (?, 'nick', ?)""", (text, ts))
+        legacy.execute("""DELETE FROM quotes WHERE rowid = 2""")
+        legacy.commit()
+        legacy.close()
+
+        self.assertEqual(self.db.getQuoteById(self.channel, 3),
+                         (3, 'third quote', 'nick', 3))
+        self.assertEqual(self.db.getQuoteById(self.channel, 2), None)
+        self.assertEqual(self.db.searchQuote(self.channel, 'quote'),
+                         ['1', '3'])
+        self.assertEqual(self.db.insertQuote(self.channel, 'new quote',
+                                             'nick', 4), 4)
+        self.assertEqual(self.db.searchQuote(self.channel, 'quote'),
+                         ['1', '3', '4'])
+
+    def testEviction(self):
+        maxOpen = conf.supybot.plugins.Quotes.maxOpen
+        with conf.supybot.plugins.Quotes.maxOpen.context(3):
+            for i in range(5):
+                self.db.insertQuote('#db%s' % i, 'quote %s' % i, 'nick', 0)
+            self.assertEqual(self.db.stats()['open'], 3)
+            self.assertEqual(self.db.stats()['evicted'], 2)
+            # Using #db2 makes #db3 the least recently used one.
+            self.assertEqual(self.db.getQuoteRandom('#db2')[1], 'quote 2')
+            self.assertEqual(self.db.getQuoteRandom('#db0')[1], 'quote 0')
+            self.assertEqual(list(self.db.dbs),
+                             [self.db._channelFilename('#db%s' % i, False)
+                              for i in (4, 2, 0)])
+            # A database in use is closed once given back.
+            db = self.db._open('#db4')
+            for channel in ('#db1', '#db3', '#db2'):
+                self.db.getQuoteRandom(channel)
+            self.assertTrue(db.evicted)
+            self.assertEqual(db.writer.execute('SELECT count(*) FROM quotes')
+                             .fetchone()[0], 1)
+            self.db._release(db)
+            self.assertRaises(sqlite3.ProgrammingError, db.writer.execute,
+                              'SELECT 1')
+        self.assertEqual(maxOpen(), 50)
+
+    def testUpgradeLock(self):
+        self.db.insertQuote('#dbfast', 'fast quote', 'nick', 0)
+        upgrade = self.db._upgrade
+        started = threading.Event()
+        finish = threading.Event()
+
+        def slowUpgrade(conn):
+            # Only the first database opened, #dbslow, is slow.
+            if not started.is_set():
+                started.set()
+                finish.wait(10)
+            upgrade(conn)
+
+        self.db._upgrade = slowUpgrade
+        t = threading.Thread(target=self.db.insertQuote,
+                             args=('#dbslow', 'slow quote', 'nick', 0))
+        t.start()
+        try:
+            self.assertTrue(started.wait(10))
+            # The other channels are still served during the upgrade.
+            self.assertEqual(self.db.getQuoteRandom('#dbfast')[1],
+                             'fast quote')
+            self.db.insertQuote('#dbother', 'other quote', 'nick', 0)
+            self.assertTrue(t.is_alive())
+        finally:
+            finish.set()
+            t.join()
+            del self.db._upgrade
+        self.assertEqual(self.db.getQuoteRandom('#dbslow')[1], 'slow quote')
+
+    def testIdleTimeout(self):
+        self.db.insertQuote('#db1', 'quote', 'nick', 0)
+        self.db.insertQuote('#db2', 'quote', 'nick', 0)
+        self.db.dbs[self.db._channelFilename('#db1', False)].lastUsed -= 700
+        self.db.closeIdle()
+        self.assertEqual(self.db.stats()['open'], 1)
+        self.assertEqual(self.db.stats()['expired'], 1)
+        with conf.supybot.plugins.Quotes.idleTimeout.context(0):
+            self.db.dbs[self.db._channelFilename('#db2', False)].lastUsed = 0
+            self.db.closeIdle()
+            self.assertEqual(self.db.stats()['open'], 1)
+        self.assertEqual(self.db.getQuoteRandom('#db1')[1], 'quote')
+
+    def testMaintainLegacy(self):
+        makeLegacyDb(self.db, self.channel, 300).close()
+        for qid in range(1, 200):
+            self.db.delQuoteById(self.channel, qid)
+        db = self._openDb(self.channel)
+        self.assertEqual(db.writer.execute('PRAGMA auto_vacuum').fetchone(),
+                         (0,))
+        results = self.db.maintain()
+        self.assertTrue(results[db.filename]['freed'] > 0)
+        self.assertEqual(db.writer.execute('PRAGMA auto_vacuum').fetchone(),
+                         (2,))
+        self.assertEqual(self.db.searchQuote(self.channel, 'python'),
+                         [str(i) for i in range(201, 301, 3)])
+
+    def testMaintainDamaged(self):
+        self.assertEqual(self.db.maintain('#dbnowhere'), {})
+        self.db.insertQuote(self.channel, 'indexed', 'nick', 0)
+        db = self._openDb(self.channel)
+        db.writer.execute("""DROP TRIGGER quotes_au""")
+        db.writer.execute("""UPDATE quotes SET text = 'changed'""")
+        results = self.db.maintain()
+        self.assertEqual(len(results[db.filename]['problems']), 1)
+
+
+class SingleSqliteQuotesDBTestCase(QuotesDBTestCase, QuotesDBTests):
+    dbClass = SingleSqliteQuotesDB
+
+    def setUp(self):
+        QuotesDBTestCase.setUp(self)
+        self.db.close()
+        self.db = self.dbClass(conf.supybot.directories.data.dirize(
+            'QuotesTest.sqlite3single.db'))
+
+    def testSchema(self):
+        conn = self._openDb(self.channel).writer
+        self.assertEqual(conn.execute('PRAGMA user_version').fetchone()[0],
+                         SingleSqliteQuotesDB.schemaVersion)
+
+    def testChannels(self):
+        for channel in ('#dbone', '#DBTwo'):
+            for i in range(3):
+                self.assertEqual(self.db.insertQuote(
+                    channel, 'quote %s of %s' % (i, channel), 'nick', 0),
+                    i + 1)
+        self.db.delQuoteById('#dbone', 3)
+        self.assertEqual(self.db.getQuoteLast('#dbone')[:2],
+                         (2, 'quote 1 of #dbone'))
+        self.assertEqual(self.db.getQuoteById('#dbtwo', 3)[:2],
+                         (3, 'quote 2 of #DBTwo'))
+        self.assertEqual(self.db.searchQuote('#dbtwo', 'quote'),
+                         ['1', '2', '3'])
+        self.assertEqual(self.db.searchQuotes('#dbone', 'quote 1', 5),
+                         (1, [(2, '\x02quote\x02 \x021\x02 of #dbone')]))
+        self.assertEqual(self.db.importQuotes('#dbone',
+                                              [('imported', 'n', 0)]), 1)
+        self.assertEqual(self.db.getQuoteLast('#dbone')[:2], (3, 'imported'))
+        (total, results) = self.db.searchAllQuotes('quote 2', 5)
+        self.assertEqual(total, 1)
+        self.assertEqual(results[0][:2], ('#dbtwo', 3))
+        (total, results) = self.db.searchAllQuotes('quote', 2, 2)
+        self.assertEqual(total, 5)
+        self.assertEqual(len(results), 2)
+
+    def testMerge(self):
+        perChannel = SqliteQuotesDB(self.filename)
+        for i in range(4):
+            perChannel.insertQuote('#dbone', 'one %s' % i, 'nick', i)
+        perChannel.delQuoteById('#dbone', 2)
+        perChannel.close()
+        makeLegacyDb(perChannel, '#dbtwo', 3).close()
+        self.db.insertQuote('#dbtwo', 'already there', 'nick', 0)
+
+        merged = self.db.mergeChannelDbs(os.path.basename(self.filename))
+        self.assertEqual(merged, {'#dbone': (3, 3), '#dbtwo': (3, 2)})
+        self.assertEqual(self.db.getQuoteById('#dbone', 4),
+                         (4, 'one 3', 'nick', 3))
+        self.assertEqual(self.db.getQuoteById('#dbone', 2), None)
+        self.assertEqual(self.db.getQuoteById('#dbtwo', 1)[1],
+                         'already there')
+        self.assertEqual(self.db.searchQuote('#dbtwo', 'synthetic'),
+                         ['2', '3'])
+        self.assertEqual(self.db.insertQuote('#dbone', 'new', 'nick', 0), 5)
+        merged = self.db.mergeChannelDbs(os.path.basename(self.filename))
+        self.assertEqual(merged, {'#dbone': (3, 0), '#dbtwo': (3, 0)})
+
+
+class QuotesBenchmarkTestCase(QuotesDBTestCase):
+    """Runs the load generator of benchmark.py on both backends. It is
+    configured by environment variables:
+
+    QUOTES_BENCHMARK_SIZE: quotes in each channel (default 1000).
+    QUOTES_BENCHMARK_CHANNELS: number of channels (default 1).
+    QUOTES_BENCHMARK_COUNT: calls of each operation (default 200).
+    QUOTES_BENCHMARK_THREADS: comma-separated thread counts (default 1,4).
+    QUOTES_BENCHMARK_CACHE: quoteCacheSize during the run (default 0).
+    QUOTES_BENCHMARK_COMPRESS: compressThreshold of compressQuotes
+    (default 200).
+    QUOTES_BENCHMARK_OUTPUT: file where the results are written as JSON
+    lines, one per backend, thread count and operation."""
+    def testBenchmark(self):
+        env = os.environ.get
+        size = int(env('QUOTES_BENCHMARK_SIZE', 1000))
+        channels = int(env('QUOTES_BENCHMARK_CHANNELS', 1))
+        count = int(env('QUOTES_BENCHMARK_COUNT', 200))
+        threads = [int(n) for n in
+                   env('QUOTES_BENCHMARK_THREADS', '1,4').split(',')]
+        cache = int(env('QUOTES_BENCHMARK_CACHE', 0))
+        compress = int(env('QUOTES_BENCHMARK_COMPRESS', 200))
+
+        results = []
+        with conf.supybot.plugins.Quotes.quoteCacheSize.context(cache):
+            for (backend, cls) in (('sqlite3', SqliteQuotesDB),
+                                   ('sqlite3single', SingleSqliteQuotesDB)):
+                db = cls(conf.supybot.directories.data.dirize(
+                    'QuotesTest.%s.db' % backend))
+                try:
+                    results.extend(benchmark.run(db, backend, size, count,
+                                                 threads, channels,
+                                                 compress=compress))
+                finally:
+                    db.close()
+
+        operations = sum(benchmark.supported(cls, operation)
+                         for cls in (SqliteQuotesDB, SingleSqliteQuotesDB)
+                         for operation in benchmark.operations)
+        self.assertEqual(len(results), len(threads) * operations)
+        for r in results:
+            self.assertTrue(r['count'] > 0)
+            self.assertTrue(r['p50_ms'] <= r['p90_ms'] <= r['p99_ms'] <=
+                            r['max_ms'])
+            if r['operation'] in benchmark.perChannel:
+                self.assertEqual(r['count'], channels)
+            elif r['operation'] != 'delQuoteById':
+                self.assertEqual(r['count'], count)
+
+        if env('QUOTES_BENCHMARK_OUTPUT'):
+            with open(env('QUOTES_BENCHMARK_OUTPUT'), 'a') as fd:
+                for r in results:
+                    fd.write(json.dumps(r, sort_keys=True) + '\n')
+        print('\n' + benchmark.formatResults(results))
+
+
+class QuotesTestCase(ChannelPluginTestCase):
     plugins = ('Quotes',)
 
+    def tearDown(self):
+        data = conf.supybot.directories.data()
+        for name in os.listdir(data):
+            if name.startswith('quotes.'):
+                os.remove(os.path.join(data, name))
+        ChannelPluginTestCase.tearDown(self)
+
+    def _dataFile(self, name):
+        return conf.supybot.directories.data.dirize(name)
+
+    def testImportExport(self):
+        with open(self._dataFile('quotes.txt'), 'w') as fd:
+            fd.write('first quote\n\nsecond quote\n')
+        self.assertRegexp('importquotes quotes.txt',
+                          r'Imported 2 quotes into #test in .* quotes/s')
+        self.assertResponse('quote 2', '#2: second quote')
+
+        self.assertRegexp('exportquotes quotes.json', 'Exported 2 quotes')
+        self.assertRegexp('exportquotes --format csv quotes.out',
+                          'Exported 2 quotes')
+        self.assertRegexp('importquotes --channel #other quotes.json',
+                          'Imported 2 quotes into #other')
+        self.assertRegexp('importquotes --channel #other --format csv '
+                          'quotes.out', 'Imported 2 quotes into #other')
+        self.assertResponse('quote --channel #other 4', '#4: second quote')
+        self.assertRegexp('quoteinfo --channel #other 4',
+                          'Quote stored by test')
+
+        db = sqlite3.connect(self._dataFile('quotes.db'))
+        db.execute("""CREATE TABLE quotegrabs (id INTEGER PRIMARY KEY,
+        nick BLOB, hostmask TEXT, added_by TEXT, added_at TIMESTAMP,
+        quote TEXT)""")
+        db.execute("""INSERT INTO quotegrabs VALUES (1, 'grabbed', 'h', 'b',
+        1234, '<grabbed> hello')""")
+        db.commit()
+        db.close()
+        self.assertRegexp('importquotes quotes.db', 'Imported 1 quote ')
+        self.assertRegexp('quoteinfo 3', 'Quote stored by grabbed')
+
+        os.mkdir(self._dataFile('#old'))
+        with io.open(self._dataFile('#old/Quote.flat.db'), 'w',
+                     encoding='utf-8') as fd:
+            fd.write(u"4\n1:1234.5,'someone',\"'<someone> stock, quote'\"\n"
+                     u"-:1240.0,'someone','deleted quote'\n"
+                     u"3:1250.0,'other',\"u'\\xe9t\\xe9'\"\n")
+        self.assertRegexp('importquotes #old/Quote.flat.db',
+                          'Imported 2 quotes ')
+        self.assertResponse('quote 4', '#4: <someone> stock, quote')
+        self.assertRegexp('quoteinfo 4', 'Quote stored by someone')
+        self.assertResponse('quote 5', u'#5: \xe9t\xe9')
+
+        with open(self._dataFile('bad.json'), 'w') as fd:
+            fd.write('{"text": "fine"}\n["not", "an", "object"]\n')
+        self.assertRegexp('importquotes bad.json',
+                          'bad line 2: not a JSON object')
+        self.assertError('quote 6')
+        self.assertError('importquotes nonexistent.txt')
+        self.assertError('exportquotes quotes.sqlite')
+        self.assertError('exportquotes Quote.flat.db')
+        for filename in ('../quotes.txt', '#old/../../quotes.txt',
+                         conf.supybot.directories.data.dirize('quotes.txt')):
+            self.assertError('importquotes %s' % filename)
+            self.assertError('exportquotes %s' % filename)
+
+    def testFindQuoteAll(self):
+        self.assertError('findquote --all foo')
+        self.assertError('mergequotes')
+        self.assertNotError('addquote foo bar')
+        self.assertNotError('addquote --channel #other foo baz')
+        cb = self.irc.getCallback('Quotes')
+        cb.db.close()
+        cb.db = SingleSqliteQuotesDB(conf.supybot.directories.data.dirize(
+            'Quotes.sqlite3single.db'))
+        self.assertRegexp('mergequotes', 'Merged 2 quotes from 2 channel '
+                          'databases in .* seconds, 0 already present.')
+        self.assertResponse('findquote --all foo',
+                            "2 quotes containing 'foo' (page 1 of 1):")
+        self.assertRegexp(' ', r'^#(test|other) #1: \x02foo\x02 ba[rz]$')
+        self.assertRegexp(' ', r'^#(test|other) #1: \x02foo\x02 ba[rz]$')
+        self.assertResponse('quote --channel #other 1', '#1: foo baz')
+
+    def testCacheStats(self):
+        self.assertNotError('addquote foo')
+        self.assertNotError('quote 1')
+        self.assertNotError('quoteinfo 1')
+        self.assertResponse('quotecachestats', '1/500 quotes cached - '
+                            '2 hits / 0 misses (100.0% hit ratio) - '
+                            '0 evictions')
+
+    def testMaintain(self):
+        self.assertResponse('maintain', 'Maintained 0 databases in 0.0 '
+                            'seconds, 0 pages freed, 0 problems found.')
+        self.assertNotError('addquote foo')
+        self.assertRegexp('maintain', '^Maintained 1 database in ')
+        self.assertRegexp('maintain --channel #test',
+                          '^Maintained 1 database in .* 0 problems found.')
+
+    def testDbStats(self):
+        self.assertNotError('addquote foo')
+        self.assertNotError('quote')
+        self.assertError('quote --channel #nonexistent')
+        self.assertRegexp('dbstats', r'^1/50 databases open \(0 in use, '
+                          r'1 idle reader\) - 1 opened, 0 evicted, '
+                          r'0 closed idle$')
+
+    def testAddQuote(self):
+        self.assertRegexp('addquote foo bar', 'Quote inserted with id: 1')
+        self.assertResponse('quote 1', '#1: foo bar')
+        self.assertResponse('quote', '#1: foo bar')
+        self.assertResponse('lastquote', '#1: foo bar')
+        self.assertRegexp('quoteinfo 1', 'Quote stored by test')
+        self.assertNotError('delquote 1')
+        self.assertError('quote 1')
+
+    def testAddQuoteDuplicate(self):
+        self.assertRegexp('addquote foo bar', 'Quote inserted with id: 1')
+        duplicates = conf.supybot.plugins.Quotes.duplicates
+        with duplicates.context('reject'):
+            self.assertRegexp('addquote "[12:34] Foo  bar"', 'already stored '
+                              'with id: 1')
+        with duplicates.context('link'):
+            self.assertResponse('addquote FOO bar',
+                                'Quote already stored with id: 1')
+        self.assertRegexp('addquote foo bar', 'Quote inserted with id: 2')
+        self.assertResponse('dedupequotes', 'Deleted 1 duplicate quote from '
+                            '#test in 0.0 seconds.')
+        self.assertError('quote 2')
+
+    def testFindQuote(self):
+        for i in range(7):
+            self.assertNotError('addquote quote number %s' % i)
+        self.assertError('findquote nothing')
+        self.assertResponse('findquote --limit 3 quote',
+                            "7 quotes containing 'quote' (page 1 of 3):")
+        self.assertRegexp(' ', r'^#\d: \x02quote\x02 number \d$')
+        self.assertRegexp(' ', r'^#\d: ')
+        self.assertRegexp(' ', r'^#\d: ')
+        self.assertError('findquote --limit 3 --page 2 number 6')
+        self.assertResponse('findquote --page 2 --limit 6 quo',
+                            "7 quotes containing 'quo' (page 2 of 2):")
+        self.assertRegexp(' ', r'^#\d: \x02quote\x02 number \d$')
+        self.assertRegexp('help findquote', r'\[--limit <n>\] <text>\x02\) -- '
+                          r'Search quotes')
+
+    def testFindQuoteFuzzy(self):
+        if not SingleSqliteQuotesDB.trigram:
+            return
+        self.assertNotError('addquote the netsplit happened again')
+        self.assertNotError('addquote coffee before deploy')
+        self.assertError('findquote --fuzzy ab')
+        self.assertError('findquote --fuzzy zzzqqq')
+        self.assertResponse('findquote --fuzzy netslpit',
+                            "1 quote like 'netslpit' (page 1 of 1):")
+        self.assertResponse(' ', '#1: the netsplit happened again')
+
+    def testCompressQuotes(self):
+        self.assertNotError('addquote %s' % ('long quote ' * 15))
+        self.assertNotError('addquote short')
+        with conf.supybot.plugins.Quotes.compressThreshold.context(100):
+            self.assertRegexp('compressquotes', r'^Rewrote (1 quote|0 '
+                              r'quotes) of #test in ')
+        self.assertResponse('quote 1', '#1: %s' % ('long quote ' * 15).strip())
+
+    def testSnapshot(self):
+        if not SqliteQuotesDB.snapshots:
+            return
+        self.assertResponse('snapshotinfo', 'No snapshot yet (0 snapshots '
+                            'published).')
+        self.assertNotError('addquote foo')
+        self.assertRegexp('snapshot', r'^Published 1 snapshot in ')
+        self.assertRegexp('snapshotinfo', r'^1 snapshot, the newest \d+ '
+                          r'seconds? old and the oldest \d+ seconds? old '
+                          r'\(1 snapshot published\)\.$')
+        cb = self.irc.getCallback('Quotes')
+        cb.db.replica = True
+        try:
+            self.assertError('addquote bar')
+            self.assertError('snapshot')
+            self.assertResponse('quote 1', '#1: foo')
+        finally:
+            cb.db.replica = False
+            shutil.rmtree(conf.supybot.directories.data.dirize('snapshots'))
+
+    def testQuotesBy(self):
+        for i in range(3):
+            self.assertNotError('addquote quote number %s' % i)
+        self.assertError('quotesby nobody')
+        self.assertResponse('quotesby --limit 2 TEST',
+                            "3 quotes by TEST (page 1 of 2):")
+        self.assertRegexp(' ', r'^#3 \(\d{4}-\d\d-\d\d\): quote number 2$')
+        self.assertRegexp(' ', r'^#2 ')
+        self.assertError('quotesby --page 3 --limit 2 test')
+
+    def testQuotesBetween(self):
+        self.assertRegexp('help quotesbetween', r'\[--page <n>\] '
+                          r'\[--limit <n>\]\x02\) -- Lists the quotes')
+        self.assertNotError('addquote first')
+        self.assertNotError('addquote second')
+        self.assertError('quotesbetween')
+        self.assertError('quotesbetween --since yesterday')
+        self.assertError('quotesbetween --until 2000')
+        self.assertResponse('quotesbetween --since 2000-01 --limit 1',
+                            "2 quotes since 2000-01 (page 1 of 2):")
+        self.assertRegexp(' ', r'^#1 \(\d{4}-\d\d-\d\d, test\): first$')
+        self.assertError('quotesbetween --until 9999-12-31')
+        self.assertResponse('quotesbetween --since 2000 --until 9999-12-30',
+                            "2 quotes from 2000 to 9999-12-30 (page 1 of 1):")
+
+    def testQuoteStats(self):
+        self.assertError('quotestats')
+        self.assertNotError('addquote first')
+        self.assertNotError('addquote second')
+        self.assertRegexp('quotestats', r"^2 quotes in #test's database. "
+                          r"Top quoters: test \(2\). "
+                          r"Last months: \d{4}-\d\d \(2\)\.$")
+
 
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
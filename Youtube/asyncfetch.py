@@ -0,0 +1,191 @@
+###
+# Copyright (c) 2013, Sergio Conde
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#   * Redistributions of source code must retain the above copyright notice,
+#     this list of conditions, and the following disclaimer.
+#   * Redistributions in binary form must reproduce the above copyright notice,
+#     this list of conditions, and the following disclaimer in the
+#     documentation and/or other materials provided with the distribution.
+#   * Neither the name of the author of this software nor the name of
+#     contributors to this software may be used to endorse or promote products
+#     derived from this software without specific prior written consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+###
+
+import io
+import ssl
+import asyncio
+import threading
+from collections import deque
+from urllib.parse import urlparse
+from http.client import parse_headers
+
+import supybot.log as log
+
+
+class AsyncFetcher(object):
+    """Fetches URLs from an asyncio event loop running in its own thread, so
+    waiting for the API doesn't hold plugin threads. Concurrent fetches of
+    the same key share a single request."""
+    def __init__(self, concurrency, connectTimeout, readTimeout):
+        self.concurrency = concurrency
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.coalesced = 0
+        self._loop = None
+        self._thread = None
+        # Requests in flight and the futures of those waiting for a slot,
+        # only used from the loop.
+        self._active = 0
+        self._waiters = deque()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def configure(self, concurrency, connectTimeout, readTimeout):
+        """Changes the settings of the next requests. Once the loop runs,
+        they are changed from the loop, after the requests already
+        submitted."""
+        with self._lock:
+            if self._loop is None:
+                self._configure(concurrency, connectTimeout, readTimeout)
+            else:
+                self._loop.call_soon_threadsafe(self._configure, concurrency,
+                                                connectTimeout, readTimeout)
+
+    def _configure(self, concurrency, connectTimeout, readTimeout):
+        self.concurrency = concurrency
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        # A higher limit lets waiting requests in.
+        self._wake()
+
+    async def _acquire(self):
+        while self._active >= self.concurrency:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self._active += 1
+
+    def _release(self):
+        self._active -= 1
+        self._wake()
+
+    def _wake(self):
+        free = self.concurrency - self._active
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever,
+                                                name='Youtube fetcher')
+                self._thread.daemon = True
+                self._thread.start()
+            return self._loop
+
+    def close(self):
+        with self._lock:
+            if self._loop is not None:
+                asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop)
+                self._thread.join()
+                self._loop.close()
+                self._loop = None
+
+    async def _shutdown(self):
+        tasks = [t for t in asyncio.all_tasks()
+                 if t is not asyncio.current_task()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        asyncio.get_running_loop().stop()
+
+    def fetch(self, urls, callback):
+        """Fetches the dict of key -> url and calls callback, in a worker
+        thread, with a dict of key -> (status, charset, body) or the
+        exception raised fetching it."""
+        loop = self._start()
+        return asyncio.run_coroutine_threadsafe(self._fetchAll(urls, callback),
+                                                loop)
+
+    async def _fetchAll(self, urls, callback):
+        keys = list(urls)
+        results = await asyncio.gather(*[self._fetchOne(key, urls[key])
+                                         for key in keys],
+                                       return_exceptions=True)
+        asyncio.get_running_loop().run_in_executor(
+            None, self._callback, callback, dict(zip(keys, results)))
+
+    def _callback(self, callback, results):
+        try:
+            callback(results)
+        except Exception:
+            log.exception('Uncaught exception in Youtube fetch callback:')
+
+    async def _fetchOne(self, key, url):
+        future = self._pending.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = self._pending[key] = asyncio.ensure_future(self._get(url))
+        try:
+            return await future
+        finally:
+            del self._pending[key]
+
+    async def _get(self, url):
+        parts = urlparse(url)
+        useSsl = parts.scheme == 'https'
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        request = ('GET %s HTTP/1.0\r\nHost: %s\r\nConnection: close\r\n\r\n'
+                   % (path, parts.netloc))
+
+        await self._acquire()
+        try:
+            (reader, writer) = await asyncio.wait_for(
+                asyncio.open_connection(parts.hostname,
+                                        parts.port or (443 if useSsl else 80),
+                                        ssl=ssl.create_default_context()
+                                        if useSsl else None),
+                self.connectTimeout)
+            try:
+                writer.write(request.encode('ascii'))
+                data = await asyncio.wait_for(reader.read(), self.readTimeout)
+            finally:
+                writer.close()
+        finally:
+            self._release()
+
+        (head, _, body) = data.partition(b'\r\n\r\n')
+        (statusLine, _, headers) = head.partition(b'\r\n')
+        status = int(statusLine.split()[1])
+        headers = parse_headers(io.BytesIO(headers + b'\r\n\r\n'))
+        return (status, headers.get_content_charset(), body)
+
+
+# vim:set shiftwidth=4 softtabstop=4 expandtab textwidth=79:
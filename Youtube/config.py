@@ -64,6 +64,32 @@ conf.registerChannelValue(Youtube, 'youtubeSnarfer',
                           registry.Boolean(True,
                                            _("""Enable Youtube snarfer.""")))
 
+conf.registerChannelValue(Youtube, 'channelRate',
+                          registry.NonNegativeInteger(0, _("""Maximum number
+                          of videos looked up per minute in the channel. Videos
+                          over the limit wait in a queue. 0 means
+                          unlimited.""")))
+
+conf.registerChannelValue(Youtube, 'channelBurst',
+                          registry.PositiveInteger(5, _("""Number of videos
+                          that can be looked up at once in the channel before
+                          channelRate applies.""")))
+
+conf.registerGlobalValue(Youtube, 'globalRate',
+                         registry.NonNegativeInteger(0, _("""Maximum number of
+                         videos looked up per minute in all the channels. 0
+                         means unlimited.""")))
+
+conf.registerGlobalValue(Youtube, 'globalBurst',
+                         registry.PositiveInteger(20, _("""Number of videos
+                         that can be looked up at once before globalRate
+                         applies.""")))
+
+conf.registerGlobalValue(Youtube, 'queueSize',
+                         registry.NonNegativeInteger(50, _("""Maximum number of
+                         lookups waiting for the rate limits. When it is full
+                         the oldest lookup is dropped.""")))
+
 conf.registerChannelValue(Youtube, 'showUploader',
                           registry.Boolean(True,
                                            _("""Show video uploader.""")))
@@ -76,4 +102,66 @@ conf.registerChannelValue(Youtube, 'useRating',
                           registry.Boolean(False, _("""Use old rating system (x of 5.0) instead of
                           the like/dislike system.""")))
 
+conf.registerGlobalValue(Youtube, 'cacheSize',
+                         registry.NonNegativeInteger(1000, _("""Maximum number
+                         of videos whose info is kept in memory. 0 disables the
+                         cache.""")))
+
+conf.registerGlobalValue(Youtube, 'cacheTTL',
+                         registry.PositiveInteger(600, _("""Number of seconds
+                         the cached info of a video is used before fetching it
+                         again.""")))
+
+conf.registerGlobalValue(Youtube, 'store',
+                         registry.Boolean(False, _("""Keep the info of the
+                         videos in a SQLite database in the data directory so
+                         it survives restarts.""")))
+
+conf.registerGlobalValue(Youtube, 'storeStatsTTL',
+                         registry.PositiveInteger(3600, _("""Number of seconds
+                         the views, likes and rating of a stored video are
+                         served before fetching them again. Title, duration
+                         and the rest of the info are always served from the
+                         store.""")))
+
+conf.registerGlobalValue(Youtube, 'maxConnections',
+                         registry.PositiveInteger(4, _("""Maximum number of
+                         requests to Youtube's API in flight at the same
+                         time.""")))
+
+conf.registerGlobalValue(Youtube, 'connectTimeout',
+                         registry.PositiveFloat(5.0, _("""Number of seconds to
+                         wait for a connection to Youtube's API.""")))
+
+conf.registerGlobalValue(Youtube, 'readTimeout',
+                         registry.PositiveFloat(10.0, _("""Number of seconds to
+                         wait for an answer of Youtube's API.""")))
+
+conf.registerGlobalValue(Youtube, 'asyncFetch',
+                         registry.Boolean(False, _("""Fetch the info of the
+                         videos from an asyncio event loop running in its own
+                         thread instead of from the plugin threads. Requires
+                         Python 3.""")))
+
+conf.registerGlobalValue(Youtube, 'asyncConcurrency',
+                         registry.PositiveInteger(16, _("""Maximum number of
+                         requests to Youtube's API in flight at the same time
+                         when asyncFetch is enabled.""")))
+
+conf.registerGlobalValue(Youtube, 'negativeCacheTTL',
+                         registry.NonNegativeInteger(3600, _("""Number of
+                         seconds a private, deleted or nonexistent video isn't
+                         looked up again.""")))
+
+conf.registerGlobalValue(Youtube, 'failureThreshold',
+                         registry.PositiveInteger(5, _("""Number of failed
+                         requests in a row after which Youtube's API isn't
+                         called for failureBackoff seconds.""")))
+
+conf.registerGlobalValue(Youtube, 'failureBackoff',
+                         registry.PositiveInteger(60, _("""Number of seconds
+                         Youtube's API isn't called after failureThreshold
+                         failed requests. Then a single request is tried and
+                         the API is called again if it succeeds.""")))
+
 # vim:set shiftwidth=4 tabstop=4 expandtab textwidth=79:
@@ -28,22 +28,40 @@
 
 ###
 
+import re
 import sys
 import json
+import time
+import errno
+import socket
+import heapq
+import sqlite3
+import threading
+from collections import OrderedDict
 from datetime import timedelta
 from dateutil import parser, tz
 
+import supybot.conf as conf
 import supybot.log as log
 import supybot.utils as utils
+import supybot.schedule as schedule
 from supybot.commands import *
 import supybot.callbacks as callbacks
 
+try:
+    from . import asyncfetch
+except (ImportError, SyntaxError):
+    # asyncio is only available on Python 3.
+    asyncfetch = None
+
 if sys.version_info[0] < 3:
-    from urlparse import urlparse, parse_qs
-    from urllib2 import urlopen
+    from urlparse import urlparse
+    from httplib import HTTPConnection, HTTPSConnection, HTTPException
+    from httplib import BadStatusLine
 else:
-    from urllib.parse import urlparse, parse_qs
-    from urllib.request import urlopen
+    from urllib.parse import urlparse
+    from http.client import HTTPConnection, HTTPSConnection, HTTPException
+    from http.client import BadStatusLine
 
 try:
     from supybot.i18n import PluginInternationalization
@@ -54,6 +72,457 @@ except:
     internationalizeDocstring = lambda x: x
 
 
+class VideoCache(object):
+    """Thread-safe LRU cache of video reply fields with a time to live."""
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _evict(self):
+        while len(self._data) > self.size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def configure(self, size, ttl):
+        with self._lock:
+            self.size = size
+            self.ttl = ttl
+            self._evict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ts=None):
+        with self._lock:
+            self._data.pop(key, None)
+            if self.size > 0:
+                self._data[key] = (ts or time.time(), value)
+                self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class VideoStore(object):
+    """SQLite store of video info that survives restarts. The database is
+    opened on first use."""
+    volatile = ('viewCount', 'likeCount', 'ratingCount', 'rating')
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _getDb(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.filename, check_same_thread=False)
+            self._db.execute("""CREATE TABLE IF NOT EXISTS videos (
+            id TEXT PRIMARY KEY,
+            info TEXT,
+            ts INTEGER
+            )""")
+            self._db.commit()
+        return self._db
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def get(self, ytid):
+        """Returns a (info, ts) tuple or None if the video is not stored."""
+        with self._lock:
+            cur = self._getDb().cursor()
+            cur.execute("""SELECT info, ts FROM videos WHERE id = ?""",
+                        (ytid,))
+            row = cur.fetchone()
+        if row is None:
+            return None
+        return (json.loads(row[0]), row[1])
+
+    def update(self, vInfos):
+        """Stores the info of several videos in a single transaction."""
+        ts = int(time.time())
+        with self._lock:
+            db = self._getDb()
+            db.executemany("""INSERT OR REPLACE INTO videos (id, info, ts)
+            VALUES (?, ?, ?)""", [(ytid, json.dumps(vInfo), ts)
+                                  for (ytid, vInfo) in vInfos.items()])
+            db.commit()
+
+    @classmethod
+    def withoutStats(cls, vInfo):
+        """Returns a copy of vInfo without the fields that go stale."""
+        return dict((k, v) for (k, v) in vInfo.items()
+                    if k not in cls.volatile)
+
+
+class SingleFlight(object):
+    """Runs a function once per key at a time. Concurrent callers with the
+    same key wait for the running call and share its result."""
+    def __init__(self):
+        self.coalesced = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, f, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = [threading.Event(), None]
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call[0].wait()
+            return call[1]
+
+        try:
+            call[1] = f(*args)
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call[0].set()
+        return call[1]
+
+
+def _staleConnection(e):
+    """Whether the error e means the server closed an idle keep-alive
+    connection, rather than a slow or failing server."""
+    # RemoteDisconnected is a BadStatusLine.
+    if isinstance(e, BadStatusLine):
+        return True
+    return (isinstance(e, socket.error) and
+            e.errno in (errno.ECONNRESET, errno.EPIPE))
+
+
+class HTTPPool(object):
+    """Thread-safe pool of keep-alive HTTP connections with a cap on the
+    number of requests in flight."""
+    def __init__(self, maxConnections, connectTimeout, readTimeout):
+        self.maxConnections = maxConnections
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.inFlight = 0
+        self._idle = {}
+        self._cond = threading.Condition()
+
+    def configure(self, maxConnections, connectTimeout, readTimeout):
+        with self._cond:
+            self.maxConnections = maxConnections
+            self.connectTimeout = connectTimeout
+            self.readTimeout = readTimeout
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+    def _connect(self, key):
+        (scheme, host, port) = key
+        cls = HTTPSConnection if scheme == 'https' else HTTPConnection
+        conn = cls(host, port, timeout=self.connectTimeout)
+        conn.connect()
+        conn.sock.settimeout(self.readTimeout)
+        return conn
+
+    def _request(self, conn, path):
+        conn.request('GET', path, headers={'Connection': 'keep-alive'})
+        resp = conn.getresponse()
+        return (resp, resp.read())
+
+    def get(self, url):
+        """Returns the (status, charset, body) of a GET request to url."""
+        parts = urlparse(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+
+        with self._cond:
+            while self.inFlight >= self.maxConnections:
+                self._cond.wait()
+            self.inFlight += 1
+            idle = self._idle.get(key)
+            conn = idle.pop() if idle else None
+
+        try:
+            if conn is None:
+                conn = self._connect(key)
+                (resp, body) = self._request(conn, path)
+            else:
+                # The read timeout may have changed since it was connected.
+                conn.sock.settimeout(self.readTimeout)
+                try:
+                    (resp, body) = self._request(conn, path)
+                except (HTTPException, socket.error) as e:
+                    # Timeouts aren't retried, the server is just slow.
+                    if not _staleConnection(e):
+                        raise
+                    conn.close()
+                    conn = self._connect(key)
+                    (resp, body) = self._request(conn, path)
+        except:
+            if conn is not None:
+                conn.close()
+            with self._cond:
+                self.inFlight -= 1
+                self._cond.notify()
+            raise
+
+        if sys.version_info[0] < 3:
+            charset = resp.msg.getparam('charset')
+        else:
+            charset = resp.msg.get_content_charset()
+
+        with self._cond:
+            if resp.will_close:
+                conn.close()
+            else:
+                self._idle.setdefault(key, []).append(conn)
+            self.inFlight -= 1
+            self._cond.notify()
+
+        return (resp.status, charset, body)
+
+
+class CircuitBreaker(object):
+    """Stops calling a failing service. After threshold failures in a row
+    it opens for backoff seconds, then lets a single probe through
+    (half-open) that closes it again on success or reopens it on
+    failure."""
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold, backoff):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self.openedAt = 0
+        self._probeAt = 0
+        self._lock = threading.Lock()
+
+    def configure(self, threshold, backoff):
+        self.threshold = threshold
+        self.backoff = backoff
+
+    def retryIn(self):
+        """Returns the seconds until the next probe when open."""
+        return max(0, self.openedAt + self.backoff - time.time())
+
+    def allow(self):
+        now = time.time()
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if ((self.state == self.OPEN and
+                 now - self.openedAt >= self.backoff) or
+                    (self.state == self.HALF_OPEN and
+                     now - self._probeAt >= self.backoff)):
+                # A probe that never reported back doesn't block forever.
+                self.state = self.HALF_OPEN
+                self._probeAt = now
+                return True
+            self.rejected += 1
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        """Returns True if this failure opened the breaker."""
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    (self.state == self.CLOSED and
+                     self.failures >= self.threshold)):
+                self.state = self.OPEN
+                self.openedAt = time.time()
+                self.trips += 1
+                return True
+            return False
+
+
+class TokenBucket(object):
+    """Allows rate tokens per second with bursts of up to burst tokens. A
+    rate of 0 means unlimited."""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.time()
+
+    def configure(self, rate, burst):
+        if not self.rate:
+            # It was unlimited, start with a full bucket.
+            self.tokens = burst
+            self.last = time.time()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
+
+    def _refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def wait(self, now):
+        """Returns the seconds until a token is available."""
+        if not self.rate:
+            return 0
+        self._refill(now)
+        return max(0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+
+class LookupQueue(object):
+    """Rate limits lookups with a token bucket per key (channel) and a
+    global one. Lookups without tokens wait in a bounded queue where the
+    keys take turns, so a flooding channel can't starve the others."""
+    def __init__(self, size):
+        self.size = size
+        self.limited = 0
+        self.merged = 0
+        self.dropped = 0
+        self._buckets = {}
+        self._global = TokenBucket(0, 0)
+        self._heap = []
+        self._seq = 0
+        self._vtime = 0
+        self._next = {}
+        self._queued = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def queued(self, key):
+        """Returns the number of lookups of key waiting in the queue."""
+        with self._lock:
+            return self._queued.get(key, 0)
+
+    def wait(self):
+        """Returns the seconds until a queued lookup could get its tokens,
+        or None if the queue is empty."""
+        now = time.time()
+        with self._lock:
+            waits = [self._wait(self._buckets[e[2]], now) for e in self._heap]
+        return min(waits) if waits else None
+
+    def configure(self, size, rate, burst):
+        with self._lock:
+            self.size = size
+            self._global.configure(rate, burst)
+
+    def _bucket(self, key, rate, burst):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        else:
+            bucket.configure(rate, burst)
+        return bucket
+
+    def _wait(self, bucket, now):
+        return max(bucket.wait(now), self._global.wait(now))
+
+    def acquire(self, key, rate, burst):
+        """Takes a token for key. Returns False if there is none or if
+        there are lookups of key already waiting."""
+        now = time.time()
+        with self._lock:
+            bucket = self._bucket(key, rate, burst)
+            if self._queued.get(key) or self._wait(bucket, now):
+                return False
+            bucket.take()
+            self._global.take()
+            return True
+
+    def push(self, key, item):
+        """Queues item for key. A lookup already queued isn't queued again
+        and the oldest lookup is dropped if the queue is full."""
+        with self._lock:
+            self.limited += 1
+            for entry in self._heap:
+                if entry[2] == key and entry[3] == item:
+                    self.merged += 1
+                    return
+            if len(self._heap) >= self.size:
+                if not self.size:
+                    self.dropped += 1
+                    return
+                oldest = min(self._heap, key=lambda e: e[1])
+                self._heap.remove(oldest)
+                heapq.heapify(self._heap)
+                self._queued[oldest[2]] -= 1
+                self.dropped += 1
+            # Start-time fair queueing: each key gets its turn after the
+            # lookups it already has queued.
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(0, 1)
+            turn = max(self._next.get(key, 0), self._vtime)
+            self._next[key] = turn + 1
+            self._queued[key] = self._queued.get(key, 0) + 1
+            self._seq += 1
+            heapq.heappush(self._heap, (turn, self._seq, key, item))
+
+    def pop(self):
+        """Returns the queued (key, item) that have tokens now and the
+        seconds until the next one could, or None if the queue is empty."""
+        now = time.time()
+        ready = []
+        with self._lock:
+            skipped = []
+            wait = None
+            while self._heap:
+                entry = heapq.heappop(self._heap)
+                bucket = self._buckets[entry[2]]
+                w = self._wait(bucket, now)
+                if w:
+                    skipped.append(entry)
+                    wait = w if wait is None else min(wait, w)
+                    continue
+                bucket.take()
+                self._global.take()
+                self._vtime = max(self._vtime, entry[0])
+                self._queued[entry[2]] -= 1
+                ready.append((entry[2], entry[3]))
+            for entry in skipped:
+                heapq.heappush(self._heap, entry)
+            if not self._heap:
+                self._next.clear()
+                self._queued.clear()
+        return (ready, wait)
+
+
 @internationalizeDocstring
 class Youtube(callbacks.PluginRegexp):
     """Listens for Youtube URLs and retrieves video info."""
@@ -62,91 +531,410 @@ class Youtube(callbacks.PluginRegexp):
 
     _apiUrl = 'http://gdata.youtube.com/feeds/api/videos/{}?v=2&alt=jsonc'
 
+    def __init__(self, irc):
+        self.__parent = super(Youtube, self)
+        self.__parent.__init__(irc)
+        self._cache = VideoCache(self.registryValue('cacheSize'),
+                                 self.registryValue('cacheTTL'))
+        self._store = VideoStore(conf.supybot.directories.data
+                                 .dirize('Youtube.sqlite'))
+        self._http = HTTPPool(self.registryValue('maxConnections'),
+                              self.registryValue('connectTimeout'),
+                              self.registryValue('readTimeout'))
+        self._flights = SingleFlight()
+        self._templates = {}
+        self._missing = VideoCache(self.registryValue('cacheSize'),
+                                   self.registryValue('negativeCacheTTL'))
+        self._breaker = CircuitBreaker(self.registryValue('failureThreshold'),
+                                       self.registryValue('failureBackoff'))
+        self._queue = LookupQueue(self.registryValue('queueSize'))
+        self._queueIrcs = {}
+        self._drainEvent = None
+        self._drainAt = None
+        self._drainLock = threading.Lock()
+        self._async = None
+        if asyncfetch is not None:
+            self._async = asyncfetch.AsyncFetcher(
+                self.registryValue('asyncConcurrency'),
+                self.registryValue('connectTimeout'),
+                self.registryValue('readTimeout'))
+
+    def die(self):
+        self.__parent.die()
+        with self._drainLock:
+            if self._drainEvent is not None:
+                try:
+                    schedule.removeEvent(self._drainEvent)
+                except KeyError:
+                    pass
+        self._store.close()
+        self._http.close()
+        if self._async is not None:
+            self._async.close()
+
+    _youtubeRe = re.compile(
+        r'^https?://(?:'
+        r'(?:www\.|m\.|music\.)?youtube\.com/'
+        r'(?:watch/?\?(?:[^#]*?&)?v=|(?:embed|v|shorts|live)/)'
+        r'|(?:www\.)?youtube-nocookie\.com/(?:embed|v)/'
+        r'|youtube\.googleapis\.com/v/'
+        r'|youtu\.be/'
+        r')([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])', re.I)
+
     def _youtubeId(self, value):
-        query = urlparse(value)
-        yid = None
-        if query.hostname == 'youtu.be':
-            yid = query.path[1:]
-        elif query.hostname in ('www.youtube.com', 'youtube.com'):
-            if query.path == '/watch':
-                yid = parse_qs(query.query)['v'][0]
-            elif (query.path[:7] == '/embed/'
-                  or query.path[:3] == '/v/'):
-                yid = query.path.split('/')[2]
-        elif (query.hostname == 'm.youtube.com'
-              and query.path == '/watch'):
-            yid = parse_qs(query.query)['v'][0]
-        elif (query.hostname == 'youtube.googleapis.com'
-              and query.path[:3] == '/v/'):
-            yid = query.path.split('/')[2]
-        return yid
+        # Most snarfed URLs aren't from Youtube, reject them before running
+        # the regexp.
+        if 'youtu' not in value.lower():
+            return None
+        match = self._youtubeRe.match(value)
+        return match.group(1) if match else None
+
+    def _fetchVideo(self, ytid):
+        if not self._breaker.allow():
+            return None
+        try:
+            response = self._http.get(self._apiUrl.format(ytid))
+        except Exception as e:
+            response = e
+        return self._parseVideo(ytid, response)
+
+    def _apiFailed(self, message, *args):
+        log.error(message, *args)
+        if self._breaker.failure():
+            log.error("Youtube's API failed %s times in a row, not calling "
+                      "it for %s seconds.", self._breaker.failures,
+                      self._breaker.backoff)
+
+    def _parseVideo(self, ytid, response):
+        if isinstance(response, Exception):
+            self._apiFailed("Couldn't connect to Youtube's API.")
+            return None
+
+        (status, cntCharset, apiRes) = response
+        if status == 404:
+            # Deleted or nonexistent video.
+            self._breaker.success()
+            self._missing.set(ytid, True)
+            return None
+        if status >= 400:
+            # Rate limits, exhausted quotas and rejected keys say nothing
+            # about the video, don't remember it as missing.
+            self._apiFailed("Youtube's API answered with error %s.", status)
+            return None
+
+        if sys.version_info[0] >= 3:
+            apiRes = apiRes.decode(cntCharset or 'utf-8')
+
+        try:
+            apiRes = json.loads(apiRes)
+        except ValueError:
+            self._apiFailed("Youtube's API answered with invalid JSON.")
+            return None
+        vInfo = apiRes.get('data')
+
+        self._breaker.success()
+        if vInfo is None:
+            # Private or removed video.
+            self._missing.set(ytid, True)
+        return vInfo
+
+    def _fetchVideos(self, ytids):
+        """Fetches the info of several videos. The API only knows about one
+        video per request, so they are requested in turn over the pooled
+        connection. A video already being fetched by another thread isn't
+        requested again, its result is shared."""
+        self._http.configure(self.registryValue('maxConnections'),
+                             self.registryValue('connectTimeout'),
+                             self.registryValue('readTimeout'))
+        vInfos = {}
+        for ytid in ytids:
+            vInfo = self._flights.do(ytid, self._fetchVideo, ytid)
+            if vInfo is not None:
+                vInfos[ytid] = vInfo
+        return vInfos
+
+    def _lookupVideos(self, ytids):
+        """Looks the videos up in the cache and the store. Returns a dict
+        with the reply fields of the videos found, a dict with the stored
+        info too old to be served and the list of videos to fetch. Videos
+        known to be missing aren't fetched again."""
+        self._cache.configure(self.registryValue('cacheSize'),
+                              self.registryValue('cacheTTL'))
+        self._missing.configure(self.registryValue('cacheSize'),
+                                self.registryValue('negativeCacheTTL'))
+        self._breaker.configure(self.registryValue('failureThreshold'),
+                                self.registryValue('failureBackoff'))
+        useStore = self.registryValue('store')
+        statsTTL = self.registryValue('storeStatsTTL')
+
+        videos = {}
+        stored = {}
+        for ytid in ytids:
+            fields = self._cache.get(ytid)
+            if fields is None and useStore:
+                entry = self._store.get(ytid)
+                if entry is not None:
+                    if time.time() - entry[1] <= statsTTL:
+                        fields = self._prepareVideo(entry[0])
+                        self._cache.set(ytid, fields, entry[1])
+                    else:
+                        stored[ytid] = entry[0]
+            if fields is not None:
+                videos[ytid] = fields
+        missing = [ytid for ytid in ytids
+                   if ytid not in videos and not self._missing.get(ytid)]
+        return (videos, stored, missing)
+
+    def _addFetched(self, missing, videos, stored, fetched):
+        for (ytid, vInfo) in fetched.items():
+            videos[ytid] = self._prepareVideo(vInfo)
+            self._cache.set(ytid, videos[ytid])
+        if self.registryValue('store') and fetched:
+            self._store.update(fetched)
+        for ytid in missing:
+            if ytid not in fetched and ytid in stored:
+                # Titles and durations don't change, serve them even if
+                # the stats couldn't be refreshed.
+                videos[ytid] = self._prepareVideo(
+                    VideoStore.withoutStats(stored[ytid]))
+        return videos
+
+    def _getVideos(self, ytids):
+        """Returns a dict with the reply fields of the given videos. The
+        cache and the store are looked up first and the rest are fetched
+        together."""
+        (videos, stored, missing) = self._lookupVideos(ytids)
+        if missing:
+            self._addFetched(missing, videos, stored,
+                             self._fetchVideos(missing))
+        return videos
+
+    def _getVideosAsync(self, ytids, callback):
+        """Like _getVideos, but the videos missing from the cache and the
+        store are fetched by the asyncio fetcher and callback is called with
+        the dict once they arrive."""
+        (videos, stored, missing) = self._lookupVideos(ytids)
+        requests = dict((ytid, self._apiUrl.format(ytid)) for ytid in missing
+                        if self._breaker.allow())
+        if not requests:
+            callback(self._addFetched(missing, videos, stored, {}))
+            return
+
+        def done(responses):
+            fetched = {}
+            for (ytid, response) in responses.items():
+                vInfo = self._parseVideo(ytid, response)
+                if vInfo is not None:
+                    fetched[ytid] = vInfo
+            callback(self._addFetched(missing, videos, stored, fetched))
+
+        self._async.configure(self.registryValue('asyncConcurrency'),
+                              self.registryValue('connectTimeout'),
+                              self.registryValue('readTimeout'))
+        self._async.fetch(requests, done)
+
+    def _prepareVideo(self, vInfo):
+        """Renders every reply field of a video. It is done once, when the
+        video enters the cache, so replying is just joining the fields the
+        channel shows."""
+        fields = {'title': format("\x02YouTube\x02: %s", vInfo['title'])}
+
+        if 'contentRating' in vInfo:
+            fields['nsfw'] = " \x02[NSFW]\x02"
+
+        if 'duration' in vInfo:
+            fields['duration'] = format(" - %s", str(timedelta(
+                seconds=int(vInfo['duration']))))
+
+        if 'viewCount' in vInfo:
+            fields['views'] = format(_(" - %s views"),
+                                     "{:,}".format(vInfo['viewCount']))
+
+        if 'likeCount' in vInfo and 'ratingCount' in vInfo:
+            fields['likes'] = format(_(" - %s likes / %s dislikes"),
+                                     vInfo['likeCount'],
+                                     (int(vInfo['ratingCount']) -
+                                      int(vInfo['likeCount'])))
+
+        if 'rating' in vInfo:
+            fields['rating'] = format(_(" - %.1f/5.0 (%s ratings)"),
+                                      vInfo['rating'],
+                                      vInfo['ratingCount'])
+
+        if 'uploader' in vInfo:
+            fields['uploader'] = format(_(" - user: %s"),
+                                        vInfo['uploader'])
+
+        if 'uploaded' in vInfo:
+            fields['date'] = format(_(" - date: %s"),
+                                    parser.parse(vInfo['uploaded'])
+                                    .astimezone(tz.tzlocal()))
+
+        return fields
+
+    def _template(self, channel):
+        """Returns the fields shown in the channel. Templates are built once
+        per combination of the channel settings, so changing a setting
+        just picks another one."""
+        config = (self.registryValue('useRating', channel),
+                  self.registryValue('showUploader', channel),
+                  self.registryValue('showDate', channel))
+        template = self._templates.get(config)
+        if template is None:
+            template = ['title', 'nsfw', 'duration', 'views',
+                        'rating' if config[0] else 'likes']
+            if config[1]:
+                template.append('uploader')
+            if config[2]:
+                template.append('date')
+            template = self._templates[config] = tuple(template)
+        return template
+
+    def _formatVideo(self, fields, channel):
+        return ''.join([fields[f] for f in self._template(channel)
+                        if f in fields])
+
+    def _snarfVideos(self, irc, channel, ytids):
+        def reply(videos):
+            for ytid in ytids:
+                if ytid in videos:
+                    irc.reply(self._formatVideo(videos[ytid], channel),
+                              prefixNick=False)
+
+        if self._async is not None and self.registryValue('asyncFetch'):
+            self._getVideosAsync(ytids, reply)
+        else:
+            reply(self._getVideos(ytids))
+
+    def _limitLookups(self, irc, channel, ytids):
+        """Returns the videos that can be looked up now. The rest wait in
+        the queue until the rate limits allow them."""
+        self._queue.configure(self.registryValue('queueSize'),
+                              self.registryValue('globalRate') / 60.0,
+                              self.registryValue('globalBurst'))
+        rate = self.registryValue('channelRate', channel) / 60.0
+        burst = self.registryValue('channelBurst', channel)
+        key = (irc.network, channel)
+
+        now = []
+        for ytid in ytids:
+            if self._queue.acquire(key, rate, burst):
+                now.append(ytid)
+            else:
+                with self._drainLock:
+                    self._queueIrcs[key] = irc
+                    self._queue.push(key, ytid)
+
+        wait = self._queue.wait()
+        if wait is not None:
+            self._scheduleDrain(wait)
+        return now
+
+    def _scheduleDrain(self, wait):
+        at = time.time() + wait
+        with self._drainLock:
+            if self._drainEvent is not None:
+                if self._drainAt <= at:
+                    return
+                try:
+                    schedule.removeEvent(self._drainEvent)
+                except KeyError:
+                    pass
+            self._drainAt = at
+            self._drainEvent = schedule.addEvent(self._drain, at)
+
+    def _drain(self):
+        lookups = OrderedDict()
+        with self._drainLock:
+            self._drainEvent = None
+            (ready, wait) = self._queue.pop()
+            for (key, ytid) in ready:
+                lookups.setdefault(key, []).append(ytid)
+            ircs = dict((key, self._queueIrcs[key]) for key in lookups)
+            # Forget the channels with nothing queued anymore, or dropped.
+            for key in list(self._queueIrcs):
+                if not self._queue.queued(key):
+                    del self._queueIrcs[key]
+
+        for (key, ytids) in lookups.items():
+            # Scheduled events run in the main thread, don't block it.
+            t = threading.Thread(target=self._snarfVideos,
+                                 args=(ircs[key], key[1], ytids),
+                                 name='Youtube queued lookup')
+            t.daemon = True
+            t.start()
+
+        if wait is not None:
+            self._scheduleDrain(wait)
 
     def youtubeSnarfer(self, irc, msg, match):
         channel = msg.args[0]
         if not irc.isChannel(channel):
             return
+        # The first snarfed URL of a message handles all the others, so
+        # their info is looked up at once and replied in order.
+        if msg.tagged('youtubeSnarfed'):
+            return
+        msg.tag('youtubeSnarfed')
         if self.registryValue('youtubeSnarfer', channel):
-            ytid = self._youtubeId(match.group(0))
-            if ytid:
-                try:
-                    apiReq = urlopen(self._apiUrl.format(ytid))
-                except:
-                    log.error("Couldn't connect to Youtube's API.")
-                    apiReq = None
-
-                if apiReq:
-                    if sys.version_info[0] < 3:
-                        apiRes = apiReq.read()
-                    else:
-                        cntCharset = apiReq.headers.get_content_charset()
-                        apiRes = apiReq.read().decode(cntCharset)
-
-                    apiRes = json.loads(apiRes)
-
-                    if 'data' in apiRes:
-                        vInfo = apiRes['data']
-
-                        s = format("\x02YouTube\x02: %s", vInfo['title'])
-
-                        if 'contentRating' in vInfo:
-                            s += " \x02[NSFW]\x02"
-
-                        if 'duration' in vInfo:
-                            s += format(" - %s", str(timedelta(
-                                seconds=int(vInfo['duration']))))
-
-                        if 'viewCount' in vInfo:
-                            s += format(_(" - %s views"),
-                                        "{:,}".format(vInfo['viewCount']))
-
-                        if not self.registryValue('useRating', channel):
-                            if 'likeCount' in vInfo and 'ratingCount' in vInfo:
-                                s += format(_(" - %s likes / %s dislikes"),
-                                            vInfo['likeCount'],
-                                            (int(vInfo['ratingCount']) -
-                                             int(vInfo['likeCount'])))
-                        else:
-                            if 'rating' in vInfo:
-                                s += format(_(" - %.1f/5.0 (%s ratings)"),
-                                            vInfo['rating'],
-                                            vInfo['ratingCount'])
-
-                        if ('uploader' in vInfo
-                            and self.registryValue('showUploader', channel)):
-                            s += format(_(" - user: %s"),
-                                        vInfo['uploader'])
+            ytids = []
+            for m in match.re.finditer(match.string):
+                ytid = self._youtubeId(m.group(0))
+                if ytid and ytid not in ytids:
+                    ytids.append(ytid)
 
-                        if ('uploaded' in vInfo
-                            and self.registryValue('showDate', channel)):
-                            s += format(_(" - date: %s"),
-                                        parser.parse(vInfo['uploaded'])
-                                        .astimezone(tz.tzlocal()))
-
-                        irc.reply(s, prefixNick=False)
+            ytids = self._limitLookups(irc, channel, ytids)
+            if ytids:
+                self._snarfVideos(irc, channel, ytids)
 
     youtubeSnarfer = urlSnarfer(youtubeSnarfer)
     youtubeSnarfer.__doc__ = utils.web._httpUrlRe
 
+    def cachestats(self, irc, msg, args):
+        """takes no arguments
+        Shows the video info cache usage, its hit/miss/eviction counters and
+        the number of fetches shared between concurrent lookups."""
+        c = self._cache
+        lookups = c.hits + c.misses
+        irc.reply(format(_("%s/%s videos cached - %s hits / %s misses "
+                           "(%.1f%% hit ratio) - %s evictions - %s coalesced "
+                           "fetches"),
+                         len(c), c.size, c.hits, c.misses,
+                         (100.0 * c.hits / lookups) if lookups else 0.0,
+                         c.evictions, self._flights.coalesced +
+                         (self._async.coalesced if self._async else 0)))
+
+    cachestats = wrap(cachestats, ['admin'])
+
+    def ratestats(self, irc, msg, args):
+        """takes no arguments
+        Shows the number of lookups waiting for the rate limits and how many
+        were rate limited, merged with a queued one or dropped."""
+        q = self._queue
+        irc.reply(format(_("%s/%s lookups queued - %s rate limited, "
+                           "%s merged, %s dropped"),
+                         len(q), q.size, q.limited, q.merged, q.dropped))
+
+    ratestats = wrap(ratestats, ['admin'])
+
+    def apistatus(self, irc, msg, args):
+        """takes no arguments
+        Shows the state of the circuit breaker that stops calling Youtube's
+        API while it fails, and the number of videos known to be
+        missing."""
+        b = self._breaker
+        if b.state == b.OPEN:
+            state = format(_("open (next try in %s)"),
+                           utils.timeElapsed(int(b.retryIn()) or 1))
+        else:
+            state = b.state
+        irc.reply(format(_("API calls: %s - %s failures in a row - opened %n "
+                           "- %s lookups skipped - %s missing videos cached"),
+                         state, b.failures, (b.trips, _('time')),
+                         b.rejected, len(self._missing)))
+
+    apistatus = wrap(apistatus, ['admin'])
+
 Class = Youtube
 
 
@@ -28,14 +28,774 @@
 
 ###
 
+import os
+import sys
+import json
+import time
+import socket
+import threading
+
 from supybot.test import *
 
+from .plugin import VideoCache, VideoStore, SingleFlight, HTTPPool
+from .plugin import TokenBucket, LookupQueue, CircuitBreaker
+from .plugin import asyncfetch
+
+if sys.version_info[0] < 3:
+    from urlparse import urlparse, parse_qs
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urllib2 import urlopen
+else:
+    from urllib.parse import urlparse, parse_qs
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.request import urlopen
+
+
+class StubAPIHandler(BaseHTTPRequestHandler):
+    """Answers like Youtube's API with the video id as title."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.active += 1
+            self.server.maxActive = max(self.server.maxActive,
+                                        self.server.active)
+        time.sleep(self.server.delay)
+        ytid = self.path.split('?')[0].split('/')[-1]
+        status = self.server.status
+        if status != 200:
+            body = b'Internal error'
+        elif ytid in self.server.missing:
+            status = 404
+            body = json.dumps({'error': {'code': 404}}).encode('utf-8')
+        else:
+            data = dict(self.server.info, title=ytid)
+            body = json.dumps({'data': data}).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.server.lock:
+            self.server.active -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+class StubAPIServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubAPIHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.active = 0
+        self.maxActive = 0
+        self.delay = 0
+        self.status = 200
+        self.missing = set()
+        self.info = {}
+        self.apiUrl = ('http://127.0.0.1:%s/feeds/api/videos/{}?v=2&alt=jsonc'
+                       % self.server_address[1])
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def handle_error(self, request, client_address):
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def legacyYoutubeId(value):
+    """The urlparse/parse_qs based extractor, kept for the benchmark."""
+    query = urlparse(value)
+    yid = None
+    if query.hostname == 'youtu.be':
+        yid = query.path[1:]
+    elif query.hostname in ('www.youtube.com', 'youtube.com'):
+        if query.path == '/watch':
+            yid = parse_qs(query.query)['v'][0]
+        elif (query.path[:7] == '/embed/'
+              or query.path[:3] == '/v/'):
+            yid = query.path.split('/')[2]
+    elif (query.hostname == 'm.youtube.com'
+          and query.path == '/watch'):
+        yid = parse_qs(query.query)['v'][0]
+    elif (query.hostname == 'youtube.googleapis.com'
+          and query.path[:3] == '/v/'):
+        yid = query.path.split('/')[2]
+    return yid
+
+
+# Mix of the URLs seen in busy channels: mostly not Youtube.
+urlCorpus = [
+    'https://github.com/ProgVal/Limnoria/issues/1234',
+    'http://www.reddit.com/r/programming/comments/abc123/some_title/',
+    'https://twitter.com/someone/status/123456789012345678',
+    'http://imgur.com/gallery/AbCdE12',
+    'https://en.wikipedia.org/wiki/Internet_Relay_Chat',
+    'http://pastebin.com/raw.php?i=XyZ12345',
+    'https://docs.python.org/3/library/re.html#re.compile',
+    'http://www.google.com/search?q=limnoria+plugins&ie=utf-8',
+    'https://www.youtube.com/watch?v=KX2BQM0D01M',
+    'http://youtu.be/KX2BQM0D01M',
+    'http://www.youtube.com/watch?feature=player_embedded&v=KX2BQM0D01M#t=11',
+    'http://www.youtube.com/embed/KX2BQM0D01M',
+    'https://m.youtube.com/watch?v=KX2BQM0D01M&t=42s',
+    'https://www.youtube.com/user/GoogleDoodles/videos',
+]
+
+
+class YoutubeIdTestCase(PluginTestCase):
+    plugins = ('Youtube',)
+
+    def setUp(self):
+        PluginTestCase.setUp(self)
+        self.youtubeId = self.irc.getCallback('Youtube')._youtubeId
+
+    def testIds(self):
+        ytid = 'KX2BQM0D01M'
+        for url in ['http://youtu.be/KX2BQM0D01M',
+                    'https://youtu.be/KX2BQM0D01M?t=42',
+                    'http://www.youtube.com/watch?v=KX2BQM0D01M',
+                    'http://youtube.com/watch?v=KX2BQM0D01M',
+                    'https://www.youtube.com/watch?v=KX2BQM0D01M&t=1m39s',
+                    'https://www.youtube.com/watch?t=99&v=KX2BQM0D01M',
+                    'http://www.youtube.com/watch?v=KX2BQM0D01M'
+                    '&feature=player_embedded#t=113',
+                    'http://www.youtube.com/watch?feature=player_embedded'
+                    '&v=KX2BQM0D01M#t=11',
+                    'http://m.youtube.com/watch?v=KX2BQM0D01M',
+                    'https://music.youtube.com/watch?v=KX2BQM0D01M'
+                    '&list=RDAMVMKX2BQM0D01M',
+                    'http://www.youtube.com/v/KX2BQM0D01M',
+                    'http://www.youtube.com/embed/KX2BQM0D01M?start=10',
+                    'https://www.youtube-nocookie.com/embed/KX2BQM0D01M',
+                    'https://youtube-nocookie.com/embed/KX2BQM0D01M',
+                    'https://www.youtube.com/shorts/KX2BQM0D01M',
+                    'https://youtube.com/shorts/KX2BQM0D01M?feature=share',
+                    'https://www.youtube.com/live/KX2BQM0D01M?si=abc',
+                    'http://youtube.googleapis.com/v/KX2BQM0D01M',
+                    'HTTPS://WWW.YOUTUBE.COM/watch?v=KX2BQM0D01M']:
+            self.assertEqual(self.youtubeId(url), ytid, url)
+
+    def testNotIds(self):
+        for url in urlCorpus[:8] + [
+                'https://www.youtube.com/user/GoogleDoodles/videos',
+                'https://www.youtube.com/watch',
+                'https://www.youtube.com/watch?list=PL123',
+                'https://www.youtube.com/watch?xv=KX2BQM0D01M',
+                'https://www.youtube.com/embed/',
+                'https://youtu.be/KX2BQM0D01MX',
+                'https://youtu.be/short',
+                'https://notyoutube.com/watch?v=KX2BQM0D01M',
+                'https://www.youtube.com.evil.com/watch?v=KX2BQM0D01M',
+                'https://example.com/?u=https://youtu.be/KX2BQM0D01M']:
+            self.assertEqual(self.youtubeId(url), None, url)
+
+    def testBenchmark(self):
+        rounds = 2000
+        start = time.time()
+        for i in range(rounds):
+            for url in urlCorpus:
+                try:
+                    legacyYoutubeId(url)
+                except KeyError:
+                    pass
+        legacy = time.time() - start
+        start = time.time()
+        for i in range(rounds):
+            for url in urlCorpus:
+                self.youtubeId(url)
+        compiled = time.time() - start
+        n = rounds * len(urlCorpus)
+        print('\nYoutube id extraction: %.2f us/url with urlparse, '
+              '%.2f us/url compiled' % (legacy * 1e6 / n,
+                                        compiled * 1e6 / n))
+
+
+class VideoCacheTestCase(SupyTestCase):
+    def testLRU(self):
+        c = VideoCache(2, 60)
+        c.set('a', {'title': 'a'})
+        c.set('b', {'title': 'b'})
+        self.assertEqual(c.get('a'), {'title': 'a'})
+        c.set('c', {'title': 'c'})
+        self.assertEqual(c.get('b'), None)
+        self.assertEqual(c.get('a'), {'title': 'a'})
+        self.assertEqual((c.hits, c.misses, c.evictions), (2, 1, 1))
+
+    def testTTL(self):
+        c = VideoCache(2, 60)
+        c.set('a', {'title': 'a'})
+        c._data['a'] = (time.time() - 61, c._data['a'][1])
+        self.assertEqual(c.get('a'), None)
+        self.assertEqual(len(c), 0)
+
+    def testDisabled(self):
+        c = VideoCache(0, 60)
+        c.set('a', {'title': 'a'})
+        self.assertEqual(c.get('a'), None)
+
+
+class VideoStoreTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.filename = conf.supybot.directories.data.dirize(
+            'YoutubeTest.sqlite')
+        self.store = VideoStore(self.filename)
+
+    def tearDown(self):
+        self.store.close()
+        os.remove(self.filename)
+        SupyTestCase.tearDown(self)
+
+    def testStore(self):
+        vInfo = {'title': 'a', 'duration': 99, 'viewCount': 10}
+        self.assertEqual(self.store.get('a'), None)
+        self.store.update({'a': vInfo})
+        self.store.close()
+        self.assertEqual(self.store.get('a')[0], vInfo)
+        self.assertEqual(VideoStore.withoutStats(vInfo),
+                         {'title': 'a', 'duration': 99})
+
+
+class SingleFlightTestCase(SupyTestCase):
+    def testCoalesce(self):
+        flights = SingleFlight()
+        calls = []
+        results = []
+
+        def fetch(key):
+            calls.append(key)
+            time.sleep(0.2)
+            return {'title': key}
+
+        threads = [threading.Thread(
+            target=lambda: results.append(flights.do('a', fetch, 'a')))
+            for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(calls, ['a'])
+        self.assertEqual(results, [{'title': 'a'}] * 5)
+        self.assertEqual(flights.coalesced, 4)
+        self.assertEqual(flights.do('a', fetch, 'a'), {'title': 'a'})
+        self.assertEqual(calls, ['a', 'a'])
+
+
+class CircuitBreakerTestCase(SupyTestCase):
+    def testBreaker(self):
+        b = CircuitBreaker(2, 60)
+        self.assertTrue(b.allow())
+        self.assertFalse(b.failure())
+        b.success()
+        self.assertFalse(b.failure())
+        self.assertTrue(b.failure())
+        self.assertEqual(b.state, b.OPEN)
+        self.assertFalse(b.allow())
+        self.assertEqual(b.rejected, 1)
+
+        b.openedAt -= 60
+        self.assertTrue(b.allow())
+        self.assertEqual(b.state, b.HALF_OPEN)
+        self.assertFalse(b.allow())
+        self.assertTrue(b.failure())
+        self.assertEqual((b.state, b.trips), (b.OPEN, 2))
+
+        b.openedAt -= 60
+        self.assertTrue(b.allow())
+        b.success()
+        self.assertEqual((b.state, b.failures), (b.CLOSED, 0))
+        self.assertTrue(b.allow())
+
+
+class LookupQueueTestCase(SupyTestCase):
+    def testTokenBucket(self):
+        b = TokenBucket(10, 2)
+        now = b.last
+        self.assertEqual(b.wait(now), 0)
+        b.take()
+        b.take()
+        self.assertAlmostEqual(b.wait(now), 0.1)
+        self.assertEqual(b.wait(now + 0.11), 0)
+        self.assertEqual(TokenBucket(0, 1).wait(now), 0)
+
+    def testLimits(self):
+        q = LookupQueue(10)
+        q.configure(10, 0, 1)
+        self.assertTrue(q.acquire('#a', 1, 2))
+        self.assertTrue(q.acquire('#a', 1, 2))
+        self.assertFalse(q.acquire('#a', 1, 2))
+        self.assertTrue(q.acquire('#b', 1, 2))
+        q.configure(10, 1, 1)
+        self.assertTrue(q.acquire('#c', 1, 2))
+        self.assertFalse(q.acquire('#d', 1, 2))
+
+    def testQueue(self):
+        q = LookupQueue(3)
+        q.configure(3, 0, 1)
+        self.assertTrue(q.acquire('#a', 100, 1))
+        for ytid in ('a1', 'a2', 'a1', 'a3'):
+            q.push('#a', ytid)
+        q.push('#b', 'b1')
+        self.assertEqual((len(q), q.limited, q.merged, q.dropped),
+                         (3, 5, 1, 1))
+        # A lookup already waiting makes the next ones of the channel wait.
+        self.assertFalse(q.acquire('#a', 100, 1))
+        (ready, wait) = q.pop()
+        self.assertEqual(ready, [('#b', 'b1')])
+        self.assertTrue(0 < wait <= 0.01)
+        self.assertEqual((q.queued('#a'), q.queued('#b')), (2, 0))
+        time.sleep(0.02)
+        self.assertEqual(q.pop()[0], [('#a', 'a2')])
+        time.sleep(0.02)
+        self.assertEqual(q.pop(), ([('#a', 'a3')], None))
+        self.assertEqual(q.queued('#a'), 0)
+
+    def testFairness(self):
+        q = LookupQueue(10)
+        q.configure(10, 0, 1)
+        for i in range(3):
+            q.push('#a', 'a%s' % i)
+        q.push('#b', 'b0')
+        self.assertEqual([item for (key, item) in q.pop()[0]],
+                         ['a0', 'b0', 'a1', 'a2'])
+
+
+class HTTPPoolTestCase(SupyTestCase):
+    def setUp(self):
+        SupyTestCase.setUp(self)
+        self.server = StubAPIServer()
+        self.pool = HTTPPool(2, 5, 5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        SupyTestCase.tearDown(self)
+
+    def testKeepAlive(self):
+        for i in range(10):
+            (status, charset, body) = self.pool.get(
+                self.server.apiUrl.format('v%s' % i))
+            self.assertEqual(status, 200)
+            self.assertEqual(charset, 'utf-8')
+            self.assertEqual(json.loads(body.decode(charset)),
+                             {'data': {'title': 'v%s' % i}})
+        self.assertEqual(self.server.connections, 1)
+
+    def testReconnect(self):
+        self.pool.get(self.server.apiUrl.format('a'))
+        for conn in self.pool._idle.popitem()[1]:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+            self.pool._idle.setdefault(('http', '127.0.0.1',
+                                        self.server.server_address[1]),
+                                       []).append(conn)
+        self.assertEqual(self.pool.get(self.server.apiUrl.format('b'))[0],
+                         200)
+        self.assertEqual(self.server.connections, 2)
+
+    def testMaxConnections(self):
+        self.server.delay = 0.1
+        threads = [threading.Thread(target=self.pool.get,
+                                    args=(self.server.apiUrl.format(i),))
+                   for i in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.server.requests, 6)
+        self.assertEqual(self.server.maxActive, 2)
+        self.assertEqual(self.pool.inFlight, 0)
+
+    def testReadTimeout(self):
+        self.server.delay = 0.5
+        self.pool.configure(2, 5, 0.1)
+        self.assertRaises(socket.error, self.pool.get,
+                          self.server.apiUrl.format('a'))
+        self.assertEqual(self.pool.inFlight, 0)
+
+    def testReadTimeoutReused(self):
+        self.pool.get(self.server.apiUrl.format('a'))
+        self.server.delay = 0.5
+        self.pool.configure(2, 5, 0.1)
+        # The idle connection gets the new timeout and isn't retried.
+        self.assertRaises(socket.timeout, self.pool.get,
+                          self.server.apiUrl.format('b'))
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(self.pool.inFlight, 0)
+
+    def testLatency(self):
+        lookups = 200
+        start = time.time()
+        for i in range(lookups):
+            urlopen(self.server.apiUrl.format(i)).read()
+        unpooled = (time.time() - start) / lookups
+        start = time.time()
+        for i in range(lookups):
+            self.pool.get(self.server.apiUrl.format(i))
+        pooled = (time.time() - start) / lookups
+        print('\nPer lookup latency: %.3f ms without pooling, %.3f ms '
+              'pooled' % (unpooled * 1000, pooled * 1000))
+
+
+if asyncfetch is not None:
+    class AsyncFetcherTestCase(SupyTestCase):
+        def setUp(self):
+            SupyTestCase.setUp(self)
+            self.server = StubAPIServer()
+            self.fetcher = asyncfetch.AsyncFetcher(4, 5, 5)
+
+        def tearDown(self):
+            self.fetcher.close()
+            self.server.stop()
+            SupyTestCase.tearDown(self)
+
+        def _fetch(self, urls):
+            results = []
+            done = threading.Event()
+
+            def callback(responses):
+                results.append(responses)
+                done.set()
+
+            self.fetcher.fetch(urls, callback)
+            done.wait(10)
+            return results[0]
+
+        def testFetch(self):
+            responses = self._fetch({'a': self.server.apiUrl.format('a'),
+                                     'b': self.server.apiUrl.format('b')})
+            for key in ('a', 'b'):
+                (status, charset, body) = responses[key]
+                self.assertEqual(status, 200)
+                self.assertEqual(charset, 'utf-8')
+                self.assertEqual(json.loads(body.decode(charset)),
+                                 {'data': {'title': key}})
+
+        def testConcurrency(self):
+            self.server.delay = 0.1
+            self._fetch(dict((i, self.server.apiUrl.format(i))
+                             for i in range(12)))
+            self.assertEqual(self.server.requests, 12)
+            self.assertEqual(self.server.maxActive, 4)
+
+        def testConfigureInFlight(self):
+            self.server.delay = 0.3
+            events = [threading.Event(), threading.Event()]
+            self.fetcher.configure(2, 5, 5)
+            self.fetcher.fetch(dict((i, self.server.apiUrl.format(i))
+                                    for i in range(4)),
+                               lambda responses: events[0].set())
+            time.sleep(0.1)
+            # The requests in flight count against the new limit.
+            self.fetcher.configure(3, 5, 5)
+            self.fetcher.fetch(dict((i, self.server.apiUrl.format(i))
+                                    for i in range(4, 8)),
+                               lambda responses: events[1].set())
+            for e in events:
+                self.assertTrue(e.wait(10))
+            self.assertEqual(self.server.requests, 8)
+            self.assertEqual(self.server.maxActive, 3)
+
+        def testCoalesce(self):
+            self.server.delay = 0.2
+            events = [threading.Event(), threading.Event()]
+            for e in events:
+                self.fetcher.fetch({'a': self.server.apiUrl.format('a')},
+                                   lambda responses, e=e: e.set())
+            for e in events:
+                e.wait(10)
+            self.assertEqual(self.server.requests, 1)
+            self.assertEqual(self.fetcher.coalesced, 1)
+
+        def testReadTimeout(self):
+            self.server.delay = 0.5
+            self.fetcher.configure(4, 5, 0.1)
+            responses = self._fetch({'a': self.server.apiUrl.format('a')})
+            self.assertTrue(isinstance(responses['a'], Exception))
+
+        def testThroughput(self):
+            lookups = 100
+            self.server.delay = 0.05
+            urls = dict((i, self.server.apiUrl.format(i))
+                        for i in range(lookups))
+
+            pool = HTTPPool(16, 5, 5)
+            start = time.time()
+            threads = [threading.Thread(target=pool.get, args=(url,))
+                       for url in urls.values()]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            threaded = time.time() - start
+            pool.close()
+
+            self.fetcher.configure(16, 5, 5)
+            start = time.time()
+            self._fetch(urls)
+            async_ = time.time() - start
+            print('\n%s concurrent lookups, 16 in flight: %.0f/s with a '
+                  'thread each, %.0f/s with the asyncio fetcher (1 thread)'
+                  % (lookups, lookups / threaded, lookups / async_))
+
 
 class YoutubeTestCase(ChannelPluginTestCase):
     plugins = ('Youtube',)
     timeout = 10
     ytRegexp = '\x02YouTube\x02: Freddie Mercury Google Doodle ' \
                '- 0:01:39 - \d+ likes / \d+ dislikes - user: .+ - date: .+'
+
+    def _takeReplies(self):
+        replies = []
+        timeout = time.time() + self.timeout
+        while time.time() < timeout:
+            drivers.run()
+            m = self.irc.takeMsg()
+            if m is None:
+                time.sleep(0.1)
+            else:
+                replies.append(m.args[1])
+                timeout = time.time() + 0.5
+        return replies
+
+    def testCacheStats(self):
+        self.assertRegexp('cachestats', r'\d+/\d+ videos cached')
+
+    vInfo = {'title': 'Freddie Mercury Google Doodle', 'duration': 99,
+             'viewCount': 1234567, 'likeCount': 100, 'ratingCount': 110,
+             'rating': 4.8, 'uploader': 'GoogleDoodles',
+             'uploaded': '2011-09-04T20:19:44.000Z'}
+
+    def testFormatVideo(self):
+        cb = self.irc.getCallback('Youtube')
+        fields = cb._prepareVideo(self.vInfo)
+        self.assertTrue(cb._formatVideo(fields, self.channel).startswith(
+            '\x02YouTube\x02: Freddie Mercury Google Doodle - 0:01:39 - '
+            '1,234,567 views - 100 likes / 10 dislikes - user: '
+            'GoogleDoodles - date: 2011-'))
+        try:
+            conf.supybot.plugins.Youtube.useRating.setValue(True)
+            conf.supybot.plugins.Youtube.showDate.setValue(False)
+            self.assertEqual(cb._formatVideo(fields, self.channel),
+                             '\x02YouTube\x02: Freddie Mercury Google '
+                             'Doodle - 0:01:39 - 1,234,567 views - 4.8/5.0 '
+                             '(110 ratings) - user: GoogleDoodles')
+        finally:
+            conf.supybot.plugins.Youtube.useRating.setValue(False)
+            conf.supybot.plugins.Youtube.showDate.setValue(True)
+
+    def testFormatBenchmark(self):
+        cb = self.irc.getCallback('Youtube')
+        rounds = 2000
+        start = time.time()
+        for i in range(rounds):
+            cb._formatVideo(cb._prepareVideo(self.vInfo), self.channel)
+        rendered = time.time() - start
+        fields = cb._prepareVideo(self.vInfo)
+        start = time.time()
+        for i in range(rounds):
+            cb._formatVideo(fields, self.channel)
+        cached = time.time() - start
+        print('\nFormatting: %.0f replies/s rendering the info every time, '
+              '%.0f replies/s from cached fields'
+              % (rounds / rendered, rounds / cached))
+
+    def testYoutubeSnarferManyLinks(self):
+        cb = self.irc.getCallback('Youtube')
+        fetched = []
+
+        def fetchVideo(ytid):
+            fetched.append(ytid)
+            return {'title': ytid}
+
+        cb._fetchVideo = fetchVideo
+        try:
+            conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(True)
+            self.feedMsg('http://youtu.be/aaaaaaaaaaa http://example.com/ '
+                         'http://www.youtube.com/watch?v=bbbbbbbbbbb '
+                         'http://youtu.be/aaaaaaaaaaa',
+                         to=self.channel)
+            self.assertEqual(self._takeReplies(),
+                             ['\x02YouTube\x02: aaaaaaaaaaa',
+                              '\x02YouTube\x02: bbbbbbbbbbb'])
+            self.assertEqual(fetched, ['aaaaaaaaaaa', 'bbbbbbbbbbb'])
+        finally:
+            conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(False)
+            del cb._fetchVideo
+            cb._cache.clear()
+
+    def testYoutubeSnarferStubAPI(self):
+        cb = self.irc.getCallback('Youtube')
+        server = StubAPIServer()
+        cb._apiUrl = server.apiUrl
+        try:
+            conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(True)
+            self.assertSnarfResponse('http://youtu.be/ccccccccccc',
+                                     '\x02YouTube\x02: ccccccccccc')
+            self.assertSnarfResponse('http://www.youtube.com/watch?v='
+                                     'ccccccccccc',
+                                     '\x02YouTube\x02: ccccccccccc')
+            self.assertEqual(server.requests, 1)
+        finally:
+            conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(False)
+            del cb._apiUrl
+            cb._cache.clear()
+            server.stop()
+
+    def testYoutubeSnarferFailures(self):
+        cb = self.irc.getCallback('Youtube')
+        server = StubAPIServer()
+        cb._apiUrl = server.apiUrl
+        try:
+            conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(True)
+            conf.supybot.plugins.Youtube.failureThreshold.setValue(2)
+            server.missing.add('iiiiiiiiiii')
+            self.assertSnarfNoResponse('http://youtu.be/iiiiiiiiiii', 1)
+            self.assertSnarfNoResponse('http://www.youtube.com/watch?v='
+                                       'iiiiiiiiiii', 1)
+            self.assertEqual(server.requests, 1)
+
+            # A rate limited call counts as a failure, not a missing video.
+            server.status = 429
+            self.assertSnarfNoResponse('http://youtu.be/jjjjjjjjjjj', 1)
+            server.status = 500
+            for ytid in ('kkkkkkkkkkk', 'lllllllllll'):
+                self.assertSnarfNoResponse('http://youtu.be/' + ytid, 1)
+            self.assertEqual(server.requests, 3)
+            self.assertRegexp('apistatus', r'API calls: open \(next try in '
+                              r'.+\) - 2 failures in a row - opened 1 time '
+                              r'- 1 lookups skipped - 1 missing videos')
+
+            server.status = 200
+            cb._breaker.openedAt -= 60
+            self.assertSnarfResponse('http://youtu.be/mmmmmmmmmmm',
+                                     '\x02YouTube\x02: mmmmmmmmmmm')
+            self.assertRegexp('apistatus', 'API calls: closed - 0 failures')
+            self.assertSnarfResponse('http://youtu.be/jjjjjjjjjjj',
+                                     '\x02YouTube\x02: jjjjjjjjjjj')
+        finally:
+            conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(False)
+            conf.supybot.plugins.Youtube.failureThreshold.setValue(5)
+            del cb._apiUrl
+            cb._cache.clear()
+            cb._missing.clear()
+            server.stop()
+
+    def testYoutubeSnarferStore(self):
+        cb = self.irc.getCallback('Youtube')
+        server = StubAPIServer()
+        cb._apiUrl = server.apiUrl
+        # The snarfer throttles the same URL, the lookups use other forms.
+        urls = iter(['http://youtu.be/nnnnnnnnnnn',
+                     'http://www.youtube.com/watch?v=nnnnnnnnnnn',
+                     'http://youtube.com/watch?v=nnnnnnnnnnn',
+                     'http://m.youtube.com/watch?v=nnnnnnnnnnn'])
+        title = '\x02YouTube\x02: nnnnnnnnnnn'
+
+        def age(seconds):
+            db = cb._store._getDb()
+            db.execute("""UPDATE videos SET ts = ts - ?""", (seconds,))
+            db.commit()
+            cb._cache.clear()
+
+        try:
+            conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(True)
+            conf.supybot.plugins.Youtube.store.setValue(True)
+            server.info = {'viewCount': 10}
+            self.assertSnarfResponse(next(urls), title + ' - 10 views')
+            self.assertEqual(server.requests, 1)
+
+            # Fresh stored info is served without calling the API.
+            age(60)
+            server.info = {'viewCount': 20}
+            self.assertSnarfResponse(next(urls), title + ' - 10 views')
+            self.assertEqual(server.requests, 1)
+
+            # Stale stats are fetched again.
+            age(3600)
+            self.assertSnarfResponse(next(urls), title + ' - 20 views')
+            self.assertEqual(server.requests, 2)
+
+            # Without the API, the stored info is served without its stats.
+            age(3601)
+            server.status = 500
+            self.assertSnarfResponse(next(urls), title)
+            self.assertEqual(server.requests, 3)
+        finally:
+            conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(False)
+            conf.supybot.plugins.Youtube.store.setValue(False)
+            del cb._apiUrl
+            cb._cache.clear()
+            cb._breaker.success()
+            cb._store.close()
+            os.remove(cb._store.filename)
+            server.stop()
+
+    def testYoutubeSnarferRateLimit(self):
+        cb = self.irc.getCallback('Youtube')
+        cb._fetchVideo = lambda ytid: {'title': ytid}
+        try:
+            conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(True)
+            conf.supybot.plugins.Youtube.channelRate.setValue(600)
+            conf.supybot.plugins.Youtube.channelBurst.setValue(1)
+            self.feedMsg('http://youtu.be/fffffffffff '
+                         'http://youtu.be/ggggggggggg '
+                         'http://youtu.be/hhhhhhhhhhh',
+                         to=self.channel)
+            self.assertEqual(self._takeReplies(),
+                             ['\x02YouTube\x02: fffffffffff',
+                              '\x02YouTube\x02: ggggggggggg',
+                              '\x02YouTube\x02: hhhhhhhhhhh'])
+            self.assertRegexp('ratestats', r'0/50 lookups queued - '
+                              r'2 rate limited, 0 merged, 0 dropped')
+            self.assertEqual(cb._queueIrcs, {})
+        finally:
+            conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(False)
+            conf.supybot.plugins.Youtube.channelRate.setValue(0)
+            conf.supybot.plugins.Youtube.channelBurst.setValue(5)
+            del cb._fetchVideo
+            cb._cache.clear()
+
+    if asyncfetch is not None:
+        def testYoutubeSnarferAsync(self):
+            cb = self.irc.getCallback('Youtube')
+            server = StubAPIServer()
+            cb._apiUrl = server.apiUrl
+            try:
+                conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(True)
+                conf.supybot.plugins.Youtube.asyncFetch.setValue(True)
+                self.feedMsg('http://youtu.be/ddddddddddd '
+                             'http://youtu.be/eeeeeeeeeee',
+                             to=self.channel)
+                self.assertEqual(self._takeReplies(),
+                                 ['\x02YouTube\x02: ddddddddddd',
+                                  '\x02YouTube\x02: eeeeeeeeeee'])
+                self.assertEqual(server.requests, 2)
+            finally:
+                conf.supybot.plugins.Youtube.youtubeSnarfer.setValue(False)
+                conf.supybot.plugins.Youtube.asyncFetch.setValue(False)
+                del cb._apiUrl
+                cb._cache.clear()
+                server.stop()
+
     if network:
         def testYoutubeSnarferSort(self):
             try: